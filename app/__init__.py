@@ -4,6 +4,7 @@ from typing import Any, Coroutine
 
 from app.configurator import AppConfigurator
 from app.db import Base
+from app.supervisor import Supervisor
 
 
 PROJECT_DIR = Path(__file__).parent.parent
@@ -12,11 +13,19 @@ PROJECT_DIR = Path(__file__).parent.parent
 TEMPLATES_DIR = PROJECT_DIR.joinpath('templates')
 STATIC_DIR = PROJECT_DIR.joinpath('static')
 CONFIG_DIR = PROJECT_DIR.joinpath('config')
+CONFIG_PATH = CONFIG_DIR.joinpath('app_config.yaml')
 
 
 async def app_starter() -> Coroutine[Any, Any, None]:
-    config_path = CONFIG_DIR.joinpath('app_config.yaml')
-    configurator = AppConfigurator(config_path, Base)
+    configurator = AppConfigurator(CONFIG_PATH, Base)
     await configurator.configurate()
     sites_tasks = configurator.sites_start_tasks_create()
-    await asyncio.gather(*sites_tasks)
\ No newline at end of file
+    await asyncio.gather(*sites_tasks)
+
+
+def supervisor_required() -> bool:
+    return Supervisor.required(CONFIG_PATH)
+
+
+def supervisor_start() -> None:
+    Supervisor(CONFIG_PATH).run()
\ No newline at end of file
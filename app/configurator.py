@@ -2,17 +2,32 @@ import aiohttp_jinja2
 import asyncio
 import jinja2
 from aiohttp.web import Application, TCPSite, AppRunner
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 from pathlib import Path
 from sqlalchemy.orm import DeclarativeMeta
-from typing import Dict, Any, Coroutine, List
+from typing import Dict, Any, Callable, Coroutine, Iterable, List, Optional
 from yaml import load, SafeLoader
 
 import app
 import app.routes.tools as tls
 import app.yaml_env_parser as yml
-from app.db import DBHandler, File
+from app.db import DBHandler, File, OPTIONAL_INDEXES
+from app.jobs import FAILED, JobManager, kinds_register
+from app.metrics import Metrics
 from app.routes import routes_setup
+from app.uploads import UploadManager
+from app.uploads.blobs import BlobStore
+from app.uploads.codecs import CODECS, COMPRESS_TYPES, Codec, CompressionPolicy
+from app.watcher import StorageWatcher
+
+# Время жизни кэша кол-ва строк при нескольких процессах, секунд
+SHARED_COUNT_CACHE_TTL = 5.0
+
+def app_workers_get(app_val: Dict[str, Any]) -> int:
+    # Кол-во процессов приложения: "workers" в "app_settings", по умолчанию 1
+    return int((app_val.get('app_settings') or {}).get('workers', 1))
+
 
 class AppConfigGetter:
     def __init__(self, conf_file_path: tls.T) -> None:
@@ -32,13 +47,73 @@ class AppConfigGetter:
 
 
 class AppConfigurator:
-    def __init__(self, config_path: tls.T, base: DeclarativeMeta) -> None:
+    # Необязательные переменные из "app_vars" и их значения по умолчанию
+    APP_VARS_DEFAULTS = {
+        'page_size': 100,
+        'page_size_max': 1000,
+        'watch': False,
+        'watch_interval': 0.5,
+        'watch_poll_interval': 60,
+        'upload_part_size': 8388608,
+        'upload_ttl': 86400,
+        'upload_gc_interval': 3600,
+        'upload_buffer_size': 1048576,
+        'io_workers': 4,
+        'dedup': False,
+        'blob_gc_interval': 3600,
+        'compression': None,
+        'compression_level': None,
+        'compress_types': list(COMPRESS_TYPES),
+        'metrics': False,
+        'bulk_chunk_size': 500,
+        'jobs_concurrency': 1,
+        'jobs_history': 100,
+        'fast_start': False
+    }
+    
+    # Необязательные настройки DBHandler из "db_settings" и их типы
+    DB_OPTIONS = {
+        'sync_batch_size': int,
+        'insert_chunk_size': int,
+        'stat_workers': int,
+        'cache_size': int,
+        'cache_ttl': float,
+        'count_cache_size': int,
+        'count_cache_ttl': float,
+        'change_detect': bool,
+        'pool_size': int,
+        'max_overflow': int,
+        'pool_timeout': float,
+        'pool_recycle': float,
+        'pool_pre_ping': bool,
+        'sqlite_single_writer': bool,
+        'group_commit_window': float,
+        'group_commit_max': int,
+        'dir_manifest': bool
+    }
+    
+    def __init__(
+        self, 
+        config_path: tls.T, 
+        base: DeclarativeMeta, 
+        app_keys: Optional[Iterable[str]] = None, 
+        primary: bool = True, 
+        reuse_port: bool = False
+        ) -> None:
+        
+        # app_keys - какие приложения из файла конфигурации поднимать (по умолчанию все).
+        # В режиме нескольких процессов (см. app.supervisor) сверку, наблюдение за хранилищем и очистку
+        # ведет только основной процесс (primary), а порт открывается с SO_REUSEPORT.
         self.__base = base
         self.__config = AppConfigGetter(config_path).config
+        self.__app_keys = tuple(app_keys) if app_keys is not None else None
+        self.__primary = primary
+        self.__reuse_port = reuse_port
         self.__apps = None
         self.__save_dirs = {}
         self.__db_handlers = {}
         self.__sites = {}
+        self.__runners = {}
     
     def __parameter_get(self, source: Dict[str, Any], key: str, error_message: str) -> Any:
         try:
@@ -51,6 +126,9 @@ class AppConfigurator:
             
     def __apps_create(self) -> None:
         try:
+            if self.__app_keys is not None:
+                self.__config['applications'] = {key: self.__config['applications'][key] for key in self.__app_keys}
+            
             self.__apps = {key: Application() for key in self.__config['applications']}
         
         except KeyError:
@@ -101,15 +179,105 @@ class AppConfigurator:
         
         return url
           
+    def __db_options_make(self, app_val: Dict[str, Any], app_key: str) -> Dict[str, Any]:
+        db_settings = app_val['db_settings']
+        options = {key: cast(db_settings[key]) for key, cast in self.DB_OPTIONS.items() if key in db_settings}
+        extra_indexes = tuple(db_settings.get('extra_indexes') or ())
+        
+        if not set(extra_indexes) <= set(OPTIONAL_INDEXES):
+            print(f'Неверное значение для "extra_indexes" в {app_key}. Допускается: {", ".join(OPTIONAL_INDEXES)}.')
+            raise ValueError
+        
+        options['extra_indexes'] = extra_indexes
+        
+        if not isinstance(db_settings.get('sqlite_pragmas') or {}, dict):
+            print(f'Неверное значение для "sqlite_pragmas" в {app_key}: ожидается объект вида {{"synchronous": "FULL"}}.')
+            raise ValueError
+        
+        options['sqlite_pragmas'] = db_settings.get('sqlite_pragmas')
+        
+        # Кэш у каждого процесса свой и не сбрасывается записью из соседнего: с несколькими процессами кэш страниц
+        # включается только явно, а кол-во строк кэшируется на короткое время
+        if app_workers_get(app_val) > 1:
+            options.setdefault('cache_size', 0)
+            options.setdefault('count_cache_ttl', SHARED_COUNT_CACHE_TTL)
+        
+        return options
+    
     def __db_handlers_create(self) -> None:
         for app_key, app_val in self.__config['applications'].items():
             db_url = self.__db_url_make(app_val, app_key)
-            self.__db_handlers[app_key] = DBHandler(db_url)
+            self.__db_handlers[app_key] = DBHandler(db_url, **self.__db_options_make(app_val, app_key))
     
     def __app_vars_registrate(self) -> None:
         for item in zip(self.__apps.values(), self.__save_dirs.values(), self.__db_handlers.values()):
             item[0]['SAVE_DIR'] = item[1]
-            item[0]['DB_HANDLER'] = item[2]       
+            item[0]['DB_HANDLER'] = item[2]
+        
+        for app_key, app_val in self.__config['applications'].items():
+            app_vars = app_val['app_vars']
+            for var_key, default in self.APP_VARS_DEFAULTS.items():
+                self.__apps[app_key][var_key.upper()] = app_vars.get(var_key, default)
+    
+    def __watchers_create(self) -> None:
+        for application in self.__apps.values():
+            application['WATCHER'] = StorageWatcher(
+                application['SAVE_DIR'], 
+                application['DB_HANDLER'], 
+                application['JOBS'], 
+                float(application['WATCH_INTERVAL']), 
+                float(application['WATCH_POLL_INTERVAL'])
+                ) if application['WATCH'] and self.__primary else None
+    
+    def __uploads_create(self) -> None:
+        # Запись загружаемых файлов идет в отдельном ограниченном пуле, а не в пуле по умолчанию
+        for application in self.__apps.values():
+            application['IO_POOL'] = ThreadPoolExecutor(max_workers=int(application['IO_WORKERS']), thread_name_prefix='io')
+            application['UPLOADS'] = UploadManager(
+                application['SAVE_DIR'], 
+                int(application['UPLOAD_PART_SIZE']), 
+                float(application['UPLOAD_TTL']), 
+                float(application['UPLOAD_GC_INTERVAL']),
+                int(application['UPLOAD_BUFFER_SIZE']),
+                application['IO_POOL']
+                )
+            application['BLOBS'] = BlobStore(
+                application['SAVE_DIR'], 
+                float(application['BLOB_GC_INTERVAL']), 
+                application['IO_POOL']
+                ) if application['DEDUP'] else None
+    
+    def __jobs_create(self) -> None:
+        for application in self.__apps.values():
+            application['JOBS'] = JobManager(application['DB_HANDLER'], int(application['JOBS_CONCURRENCY']), int(application['JOBS_HISTORY']))
+            kinds_register(application['JOBS'], application['SAVE_DIR'], application['DB_HANDLER'], application['IO_POOL'])
+    
+    def __compression_setup(self) -> None:
+        for app_key, application in self.__apps.items():
+            name = application['COMPRESSION']
+            level = application['COMPRESSION_LEVEL']
+            
+            if not name:
+                application['COMPRESSION'] = None
+                continue
+            
+            try:
+                codec = Codec(name, int(level) if level is not None else None)
+            
+            except ValueError:
+                print(f'Неверное значение для "compression" в {app_key}. Допускается: {", ".join(CODECS)}.')
+                raise
+            
+            except ImportError:
+                print(f'Для сжатия "zstd" в {app_key} требуется пакет zstandard.')
+                raise
+            
+            application['COMPRESSION'] = CompressionPolicy(codec, application['COMPRESS_TYPES'])
+    
+    def __metrics_setup(self) -> None:
+        for application in self.__apps.values():
+            application['METRICS'] = Metrics() if application['METRICS'] else None
+            application['DB_HANDLER'].metrics_attach(application['METRICS'])
     
     def __routes_setup(self) -> None:
         [routes_setup(application) for application in self.__apps.values()]
@@ -126,33 +294,87 @@ class AppConfigurator:
             application_port = int(self.__parameter_get(application_settings, 'port', f'Отсутствует обязательный элемент: "port" в {app_key}.'))
             runner = AppRunner(application)
             await runner.setup()
-            site = TCPSite(runner, host=application_host, port=application_port)
+            site = TCPSite(runner, host=application_host, port=application_port, reuse_port=self.__reuse_port)
             self.__sites[app_key] = site
+            self.__runners[app_key] = runner
     
-    async def __site_start(self, site: TCPSite, app: Application) -> Coroutine[Any, Any, None]:
+    async def __site_start(self, site: TCPSite, runner: AppRunner, app: Application) -> Coroutine[Any, Any, None]:
         try:
             await site.start()
             while True:
                 await asyncio.sleep(3600)
         
         finally:
+            # Новые соединения больше не принимаются, начатые запросы дорабатывают
+            await runner.cleanup()
+            
+            if app['WATCHER'] is not None:
+                await app['WATCHER'].stop()
+            
+            await app['JOBS'].stop()
+            await app['UPLOADS'].stop()
+            
+            if app['BLOBS'] is not None:
+                await app['BLOBS'].stop()
+            
+            app['IO_POOL'].shutdown(wait=False)
+            
             await app['DB_HANDLER'].release()
     
+    @staticmethod
+    async def __startup_sync(jobs: JobManager) -> Coroutine[Any, Any, None]:
+        # Сверка, найденная идущей, могла остаться от остановленного процесса - тогда запускается своя
+        while True:
+            job, created = await jobs.submit('sync')
+            job = await jobs.wait(job['id'])
+            
+            if job is None or job['status'] != FAILED:
+                return
+            
+            if created:
+                raise RuntimeError(f'Сверка с хранилищем при старте не удалась: {job["error"]}')
+    
     def sites_start_tasks_create(self) -> List[asyncio.Task]:
         tasks = []
         for key_app in self.__config['applications']:
-            tasks.append(asyncio.create_task(self.__site_start(self.__sites[key_app], self.__apps[key_app])))
+            tasks.append(asyncio.create_task(self.__site_start(self.__sites[key_app], self.__runners[key_app], self.__apps[key_app])))
         
         return tasks
     
-    async def configurate(self) -> Coroutine[Any, Any, None]:
+    async def configurate(self, ready: Optional[Callable[[], None]] = None) -> Coroutine[Any, Any, None]:
+        # ready вызывается, когда схема БД готова: дальше идет только сверка с хранилищем
         self.__apps_create()
         self.__save_dirs_create()
         self.__db_handlers_create()
         self.__app_vars_registrate()
+        self.__uploads_create()
+        self.__jobs_create()
+        self.__watchers_create()
+        self.__compression_setup()
+        self.__metrics_setup()
         self.__routes_setup()
         self.__templates_setup()
         await self.__sites_create()
         await asyncio.gather(*[asyncio.create_task(application['DB_HANDLER'].create(self.__base)) for application in self.__apps.values()])
-        await asyncio.gather(*[asyncio.create_task(application['DB_HANDLER'].normalize(application['SAVE_DIR'], application['SAVE_DIR']))\
-            for application in self.__apps.values()])
\ No newline at end of file
+        
+        if ready is not None:
+            ready()
+        
+        if not self.__primary:
+            return
+        
+        # Наблюдение ставится до сверки, чтобы не потерять изменения, сделанные во время нее
+        await asyncio.gather(*[application['WATCHER'].start() for application in self.__apps.values() if application['WATCHER'] is not None])
+        [application['UPLOADS'].start() for application in self.__apps.values()]
+        await asyncio.gather(*[application['JOBS'].start() for application in self.__apps.values()])
+        [application['BLOBS'].start() for application in self.__apps.values() if application['BLOBS'] is not None]
+        
+        # Сверка при старте - задача sync, как и запущенная через /sync: соседний процесс не начнет вторую одновременно с ней.
+        # С fast_start порт открывается сразу, запросы обслуживаются по каталогу, уже записанному в БД, а ход сверки
+        # виден на /ready. Иначе configurate ждет окончания сверки.
+        for application in self.__apps.values():
+            if application['FAST_START']:
+                job, _ = await application['JOBS'].submit('sync')
+                application['JOBS'].startup_mark(job['id'])
+        
+        await asyncio.gather(*[self.__startup_sync(application['JOBS']) for application in self.__apps.values() if not application['FAST_START']])
\ No newline at end of file
@@ -1,14 +1,23 @@
 import sqlalchemy as sql
-import aiofiles.os as aos
 import asyncio
-from aiohttp.web import Application, Request
+import os
+import re
+from aiohttp.web import Request
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.orm.decl_api import DeclarativeMeta
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from typing import Coroutine, Any, List, Dict, Set, TypeVar, Type, Callable, Tuple, Union
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncConnection, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from urllib.parse import quote
+from typing import AbstractSet, AsyncIterator, Callable, Coroutine, Any, List, Dict, Set, TypeVar, Type, Tuple, Union, Optional
 
 
 Base = declarative_base()
@@ -25,49 +34,417 @@ class File(Base):
     create = sql.Column('created_at', sql.String, nullable=False)
     update = sql.Column('updated_at', sql.String)
     comment = sql.Column('comment', sql.String)
+    # Хэш содержимого (BLAKE2b) и время изменения файла, при котором он посчитан
+    hash = sql.Column('hash', sql.String)
+    mtime = sql.Column('mtime_ns', sql.BigInteger)
+    # Размер файла на диске и кодек, которым он сжат (см. app.uploads.codecs); size - размер исходного содержимого
+    stored_size = sql.Column('stored_size', sql.BigInteger)
+    encoding = sql.Column('encoding', sql.String)
     
     sql.PrimaryKeyConstraint(name, ext, path, name='pk_files')
+    # Порядок вывода списков и ключ постраничной навигации
+    sql.Index('ix_files_listing', path, name, ext)
+    sql.Index('ix_files_hash', hash)
     
     def __repr__(self):
         return f'File(name={self.name}, extension={self.ext}, size={self.sz}, path={self.path}, \
     created_at={self.create}, updated_at={self.update})'
 
 
+# Статусы незавершенной задачи (app.jobs.ACTIVE)
+JOB_ACTIVE = ('queued', 'running')
+
+
+class Job(Base):
+    # Фоновая задача (см. app.jobs). heartbeat - time.time() последней отметки процесса, который ее выполняет:
+    # по нему задача, зависшая в статусе queued или running после падения процесса, отличается от живой
+    __tablename__ = 'jobs'
+    
+    id = sql.Column('id', sql.String, primary_key=True)
+    kind = sql.Column('kind', sql.String, nullable=False)
+    status = sql.Column('status', sql.String, nullable=False)
+    create = sql.Column('created_at', sql.String, nullable=False)
+    start = sql.Column('started_at', sql.String)
+    finish = sql.Column('finished_at', sql.String)
+    heartbeat = sql.Column('heartbeat', sql.Float)
+    done = sql.Column('done', sql.BigInteger)
+    total = sql.Column('total', sql.BigInteger)
+    error = sql.Column('error', sql.String)
+    result = sql.Column('result', sql.String)
+    
+    sql.Index('ix_jobs_kind_status', kind, status)
+    sql.Index('ix_jobs_created_at', create)
+    # Активная задача каждого вида одна на все процессы: второй INSERT того же вида получает IntegrityError
+    sql.Index('ux_jobs_active_kind', kind, unique=True, sqlite_where=status.in_(JOB_ACTIVE), postgresql_where=status.in_(JOB_ACTIVE))
+
+
+class Dir(Base):
+    # Манифест директорий хранилища с последней сверки (см. walker.tree_walk): директории, у которых не изменились
+    # mtime и inode, следующая сверка не читает
+    __tablename__ = 'dirs'
+    
+    path = sql.Column('path', sql.String, primary_key=True)
+    mtime = sql.Column('mtime_ns', sql.BigInteger, nullable=False)
+    inode = sql.Column('inode', sql.BigInteger, nullable=False)
+    files = sql.Column('files', sql.BigInteger, nullable=False)
+    dirs = sql.Column('dirs', sql.BigInteger, nullable=False)
+
+
+QUERY_SAFE = re.compile(r'[A-Za-z0-9_.~-]*')
+
+
+@lru_cache(maxsize=4096)
+def _query_quote(value: str) -> str:
+    return quote(value, safe='')
+
+
+def prefix_next(prefix: str) -> Optional[str]:
+    # Наименьшая строка больше всех строк, начинающихся с prefix (None - такой нет)
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+
+def query_quote(value: Any) -> str:
+    # Большинство имен не требует кодирования, а пути и комментарии в списке часто повторяются
+    value = str(value)
+    
+    return value if QUERY_SAFE.fullmatch(value) else _query_quote(value)
+
+
 class Result:
-    __slots__ = 'value', 'del_url', 'upd_url', 'dwld_url'
+    # Строка хранится кортежем в порядке FIELDS, словарь value (без служебного mtime_ns) строится только при обращении
+    __slots__ = 'row', 'del_url', 'upd_url', 'dwld_url'
+    FIELDS = ('name', 'ext', 'size', 'path', 'created_at', 'updated_at', 'comment', 'hash', 'stored_size', 'encoding', 'mtime_ns')
+    VALUE_FIELDS = FIELDS[:-1]
+    FIELD_INDEX = {field: i for i, field in enumerate(FIELDS)}
+    KEY_FIELDS = frozenset(('name', 'ext', 'path'))
     
-    def __init__(self, value: str) -> None:
-        self.value = value
+    def __init__(self, row: Tuple[Any, ...]) -> None:
+        self.row = row
         self.del_url = None
         self.upd_url = None
         self.dwld_url = None
     
-    def make_url(
-        self, 
-        del_endpoint_name: str, 
-        upd_endpoint_name: str, 
-        dwld_endpoint_name: str,
-        app: Application, 
-        query_params: Dict[str, Any]
-        ) -> None:
-        
-        download_delete_p = {'name': query_params['name'], 'path': query_params['path'], 'ext': query_params['ext']}
+    def __getitem__(self, field: str) -> Any:
+        return self.row[self.FIELD_INDEX[field]]
+    
+    @property
+    def value(self) -> Dict[str, Any]:
+        return dict(zip(self.VALUE_FIELDS, self.row))
+    
+    @property
+    def key(self) -> Tuple[str, str, str]:
+        return self.row[3], self.row[0], self.row[1]
+    
+    def make_url(self, del_base: str, upd_base: str, dwld_base: str, link_keys: Tuple[str, ...]) -> None:
+        # Базовые пути маршрутов вычисляются один раз на приложение (см. BaseHandler._url_bases_get),
+        # здесь только кодируется строка запроса из значений строки
+        row = self.row
+        key_query = f'name={query_quote(row[0])}&path={query_quote(row[3])}&ext={query_quote(row[1])}'
+        extra_query = ''.join([f'&{key}={query_quote(row[self.FIELD_INDEX[key]])}' for key in link_keys if key not in self.KEY_FIELDS])
         
-        self.del_url = app.router[del_endpoint_name].url_for().with_query(download_delete_p)
-        self.upd_url = app.router[upd_endpoint_name].url_for().with_query(query_params)
-        self.dwld_url = app.router[dwld_endpoint_name].url_for().with_query(download_delete_p)
+        self.del_url = f'{del_base}?{key_query}'
+        self.upd_url = f'{upd_base}?{key_query}{extra_query}'
+        self.dwld_url = f'{dwld_base}?{key_query}'
     
+import app.metrics as mtr
 import app.routes.tools as tls
+from app.db import sqlite, walker
+from app.db.cache import QueryCache, Scope
+from app.db.writes import Work, WriteQueue
 from app.routes.tools import FileHandler
 
+PageKey = Tuple[str, str, str]
+# Размер на диске и mtime_ns файла, записанные в БД: по ним сверка узнает об изменении содержимого без чтения файла
+FileMeta = Tuple[int, Optional[int]]
+
+# Полнотекстовый поиск по имени и комментарию файла. В SQLite это FTS5-таблица с внешним содержимым (files),
+# которую поддерживают триггеры, т.е. любая запись в files: insert, update, _cleane, normalize.
+# В PostgreSQL - GIN-индекс по выражению POSTGRESQL_FTS_VECTOR, отдельно синхронизировать ничего не нужно.
+SQLITE_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(name, comment, content='files', content_rowid='rowid')",
+    '''CREATE TRIGGER IF NOT EXISTS files_fts_ai AFTER INSERT ON files BEGIN
+        INSERT INTO files_fts(rowid, name, comment) VALUES (new.rowid, new.name, new.comment);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS files_fts_ad AFTER DELETE ON files BEGIN
+        INSERT INTO files_fts(files_fts, rowid, name, comment) VALUES ('delete', old.rowid, old.name, old.comment);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS files_fts_au AFTER UPDATE ON files BEGIN
+        INSERT INTO files_fts(files_fts, rowid, name, comment) VALUES ('delete', old.rowid, old.name, old.comment);
+        INSERT INTO files_fts(rowid, name, comment) VALUES (new.rowid, new.name, new.comment);
+    END'''
+)
+POSTGRESQL_FTS_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || setweight(to_tsvector('simple', coalesce(comment, '')), 'B')"
+)
+FTS_TERM = re.compile(r'\w+')
+
+# Индексы, которые зависят от СУБД. В PostgreSQL поиск по префиксу (LIKE) использует индекс только с text_pattern_ops;
+# ix_files_sync нужен сверке, которая читает ключи в C-порядке. В SQLite префикс - промежуток значений path,
+# его читает ix_files_listing (см. DBHandler.prefix_filter), отдельный индекс не нужен.
+BACKEND_INDEXES = {
+    'postgresql': (
+        'CREATE INDEX IF NOT EXISTS ix_files_path_prefix ON files (path text_pattern_ops)',
+        'CREATE INDEX IF NOT EXISTS ix_files_sync ON files (path COLLATE "C", name COLLATE "C", extension COLLATE "C")',
+        f'CREATE INDEX IF NOT EXISTS ix_files_fts ON files USING GIN (({POSTGRESQL_FTS_VECTOR}))'
+    )
+}
+# Необязательные индексы, включаются через "extra_indexes" в "db_settings"
+OPTIONAL_INDEXES = {
+    'extension': 'CREATE INDEX IF NOT EXISTS ix_files_extension ON files (extension)',
+    'updated_at': 'CREATE INDEX IF NOT EXISTS ix_files_updated_at ON files (updated_at)'
+}
+
+
+FileRow = Tuple[str, str, int, str, str, Optional[str], str, Optional[str], Optional[int], Optional[str], Optional[int]]
+# Столбцы в порядке Result.FIELDS
+RESULT_COLUMNS = (
+    File.name, File.ext, File.sz, File.path, File.create, File.update, File.comment, File.hash, File.stored_size, File.encoding, File.mtime
+    )
+
+
 class DBHandler:
-    def __init__(self, db_url: str, echo: bool=False, future: bool=True) -> None:
-        self.__engine = create_async_engine(db_url, echo=echo, future=future)
+    # Страницы от этого размера читаются через курсор на стороне сервера
+    STREAM_ROWS = 1000
+    # Порядок значений в FileRow
+    ROW_COLUMNS = ('name', 'extension', 'size', 'path', 'created_at', 'updated_at', 'comment', 'hash', 'stored_size', 'encoding', 'mtime_ns')
+    
+    def __init__(
+        self, 
+        db_url: str, 
+        echo: bool=False, 
+        future: bool=True,
+        sync_batch_size: int = 1000,
+        insert_chunk_size: int = 5000,
+        stat_workers: int = 8,
+        extra_indexes: Tuple[str, ...] = (),
+        cache_size: int = 1024,
+        cache_ttl: float = 30.0,
+        count_cache_size: int = 256,
+        count_cache_ttl: Optional[float] = None,
+        change_detect: bool = False,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_timeout: float = 30.0,
+        pool_recycle: float = -1,
+        pool_pre_ping: bool = False,
+        sqlite_pragmas: Optional[Dict[str, Any]] = None,
+        sqlite_single_writer: bool = True,
+        group_commit_window: float = 0.0,
+        group_commit_max: int = 256,
+        dir_manifest: bool = False
+        ) -> None:
+        
+        url = make_url(db_url)
+        pool_options = {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_timeout': pool_timeout,
+            'pool_recycle': pool_recycle,
+            'pool_pre_ping': pool_pre_ping
+        }
+        
+        # aiosqlite по умолчанию открывает новое соединение (и поток) на каждый запрос - файловой БД SQLite
+        # нужен такой же пул, как у PostgreSQL; БД в памяти живет в единственном соединении
+        if url.get_backend_name() == 'sqlite':
+            pool_options = {'poolclass': AsyncAdaptedQueuePool, **pool_options} if url.database not in (None, '', ':memory:') else {}
+        
+        self.__engine = create_async_engine(db_url, echo=echo, future=future, **pool_options)
         self.__session_maker = sessionmaker(self.__engine, expire_on_commit=False, class_=AsyncSession)
+        self.__writer: Optional[WriteQueue] = None
+        self.__metrics: Optional[mtr.Metrics] = None
+        writer_engine = self.__engine
+        
+        if self.__engine.dialect.name == 'sqlite':
+            sqlite.engine_setup(self.__engine, {**sqlite.PRAGMAS, **(sqlite_pragmas or {})})
+            writer_engine = self.__engine.execution_options(**{sqlite.IMMEDIATE_OPTION: True})
+        
+        # Групповая фиксация (group_commit_window > 0) доступна для любой СУБД: записи из параллельных запросов,
+        # пришедшие за окно, фиксируются одной транзакцией, каждый запрос получает свой результат или ошибку
+        if group_commit_window > 0 or (self.__engine.dialect.name == 'sqlite' and sqlite_single_writer):
+            self.__writer = WriteQueue(
+                sessionmaker(writer_engine, expire_on_commit=False, class_=AsyncSession),
+                group_commit_max,
+                group_commit_window
+                )
+        
+        self.__cache = QueryCache(cache_size, cache_ttl)
+        # Общее кол-во строк для списков - отдельный кэш: его можно оставить и там, где кэш страниц выключен
+        # (несколько процессов), т.к. устаревшее на count_cache_ttl секунд кол-во не ломает пагинацию
+        self.__counts = QueryCache(count_cache_size, cache_ttl if count_cache_ttl is None else count_cache_ttl)
+        self.__sync_batch_size = sync_batch_size
+        self.__insert_chunk_size = insert_chunk_size
+        self.__stat_workers = stat_workers
+        self.__stat_pool: Optional[ThreadPoolExecutor] = None
+        self.__extra_indexes = extra_indexes
+        self.__change_detect = change_detect
+        # С change_detect нужен stat каждого файла, поэтому манифест директорий не используется
+        self.__dir_manifest = dir_manifest and not change_detect
+        self.__fts = self.__engine.dialect.name == 'postgresql'
     
     async def create(self, Base: DeclarativeMeta) -> None:
         async with self.__engine.begin() as connection:
             await connection.run_sync(Base.metadata.create_all)
+            await self._columns_add(connection, Base)
+            
+            # create_all не добавляет индексы к уже существующим таблицам
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    await connection.run_sync(index.create, checkfirst=True)
+            
+            ddl = [*BACKEND_INDEXES.get(self.__engine.dialect.name, ()), *(OPTIONAL_INDEXES[name] for name in self.__extra_indexes)]
+            for statement in ddl:
+                await connection.exec_driver_sql(statement)
+            
+            if self.__engine.dialect.name == 'sqlite':
+                await self._sqlite_fts_create(connection)
+        
+        await self._plan_check()
+    
+    async def _columns_add(self, connection: AsyncConnection, Base: DeclarativeMeta) -> Coroutine[Any, Any, None]:
+        # create_all не добавляет и новые столбцы: таблицы, созданные прежней версией, дополняются здесь
+        dialect = self.__engine.dialect
+        
+        for table in Base.metadata.sorted_tables:
+            existing = await connection.run_sync(lambda sync_connection: {
+                column['name'] for column in sql.inspect(sync_connection).get_columns(table.name)
+                })
+            
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=dialect)
+                    await connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+    
+    async def _sqlite_fts_create(self, connection: AsyncConnection) -> Coroutine[Any, Any, None]:
+        fts_exists = await connection.scalar(sql.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files_fts'"))
+        
+        try:
+            for statement in SQLITE_FTS_DDL:
+                await connection.exec_driver_sql(statement)
+        
+        except OperationalError as e:
+            print(f'Полнотекстовый поиск отключен: SQLite собран без FTS5 ({e.orig}).')
+            return
+        
+        # Индекс создан для уже заполненной таблицы
+        if not fts_exists:
+            await connection.exec_driver_sql("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")
+        
+        self.__fts = True
+    
+    def _fts_query(self, text: str) -> Optional[Tuple[Any, Any]]:
+        # Каждое слово запроса ищется как префикс, слова объединяются через И
+        terms = FTS_TERM.findall(text)
+        
+        if not terms or not self.__fts:
+            return None
+        
+        if self.__engine.dialect.name == 'postgresql':
+            vector = sql.literal_column(f'({POSTGRESQL_FTS_VECTOR})')
+            ts_query = sql.func.to_tsquery('simple', ' & '.join(f'{term}:*' for term in terms))
+            
+            return sql.select(File).where(vector.op('@@')(ts_query)), sql.func.ts_rank(vector, ts_query).desc()
+        
+        fts_table = sql.table('files_fts', sql.column('rowid'))
+        match = ' '.join(f'"{term}"*' for term in terms)
+        sql_query = sql.select(File)\
+            .join(fts_table, fts_table.c.rowid == sql.literal_column('files.rowid'))\
+            .where(sql.literal_column('files_fts').op('MATCH')(match))
+        
+        # Совпадение в имени весит больше, чем в комментарии
+        return sql_query, sql.func.bm25(sql.literal_column('files_fts'), 10.0, 1.0)
+    
+    async def fts_search(
+        self, 
+        text: str, 
+        offset: int = 0, 
+        limit: int = 100
+        ) -> Coroutine[Any, Any, Optional[Tuple[List[Result], int, bool]]]:
+        
+        fts_query = self._fts_query(text)
+        
+        if fts_query is None:
+            return None
+        
+        sql_query, rank = fts_query
+        ranked_query = sql_query.order_by(rank, File.path, File.name, File.ext).offset(offset).limit(limit + 1)
+        
+        async def fts_load() -> List[Tuple[Any, ...]]:
+            return await self.rows_fetch(ranked_query)
+        
+        # Совпадение зависит от комментария любой строки, поэтому результат сбрасывается при любой записи
+        rows = await self._cached(('fts', text, offset, limit), None, fts_load)
+        total = await self.count(sql_query)
+        
+        return [Result(row) for row in rows[:limit]], total, len(rows) > limit
+    
+    def _hot_queries(self) -> Dict[str, Any]:
+        # Запросы в том виде, в каком их выполняет page(): с условием курсора, сортировкой и лимитом
+        order = (File.path, File.name, File.ext)
+        sync_order = self._order_columns()
+        after = ('a', 'a', 'a')
+        
+        return {
+            'страница списка файлов': self._page_query(sql.select(File), after, 100),
+            'поиск по префиксу пути': self._page_query(sql.select(File).where(self.prefix_filter('a')), after, 100),
+            'выборка директории': self._page_query(sql.select(File).where(self.prefix_filter('a', subtree=True)), after, 1000),
+            'информация о файле': sql.select(File).where(File.name == 'a', File.path == 'a', File.ext == 'a'),
+            'пачка ключей сверки': sql.select(*order).where(sql.tuple_(*sync_order) > ('a', 'a', 'a')).order_by(*sync_order).limit(1000)
+        }
+    
+    async def _plan_check(self) -> Coroutine[Any, Any, None]:
+        # Самопроверка при старте: частые запросы не должны читать таблицу целиком или сортировать выборку
+        dialect = self.__engine.dialect
+        is_postgresql = dialect.name == 'postgresql'
+        explain = 'EXPLAIN ' if is_postgresql else 'EXPLAIN QUERY PLAN '
+        
+        async with self.__engine.connect() as connection:
+            # На пустой таблице PostgreSQL и так выберет Seq Scan, проверяем, что индекс вообще применим
+            if is_postgresql:
+                await connection.exec_driver_sql('SET enable_seqscan = off')
+            
+            for name, query in self._hot_queries().items():
+                compiled = str(query.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+                plan = [str(row[-1]) for row in (await connection.exec_driver_sql(explain + compiled)).all()]
+                
+                if is_postgresql:
+                    full_scan = any('Seq Scan on files' in line for line in plan)
+                
+                # Сортировка во временном B-дереве читает все подходящие строки на каждой странице, даже по индексу
+                else:
+                    full_scan = any(
+                        'TEMP B-TREE' in line or (line.startswith('SCAN files') and 'USING' not in line) for line in plan
+                        )
+                
+                if full_scan:
+                    print(f'Внимание: запрос "{name}" читает таблицу files целиком или сортирует выборку. План: {"; ".join(plan)}')
+            
+            if is_postgresql:
+                await connection.exec_driver_sql('RESET enable_seqscan')
+    
+    def prefix_filter(self, prefix: str, subtree: bool = False) -> Any:
+        # Путь, начинающийся с prefix; subtree - только сама директория prefix и вложенные в нее ("dir", но не "dir2").
+        # В SQLite это промежуток побайтового сравнения: его читает ix_files_listing, в порядке которого идут
+        # и страницы (LIKE читал бы индекс NOCASE, и каждая страница сортировала бы все совпадения заново).
+        if self.__engine.dialect.name == 'sqlite':
+            # "dir" и "dir/..." лежат в одном промежутке, между ними - только пути вроде "dir-1" и "dir.bak"
+            if subtree:
+                return sql.and_(
+                    File.path >= prefix, File.path < prefix_next(f'{prefix}/'), sql.or_(File.path == prefix, File.path >= f'{prefix}/')
+                    )
+            
+            high = prefix_next(prefix)
+            
+            return File.path >= prefix if high is None else sql.and_(File.path >= prefix, File.path < high)
+        
+        # Спецсимволы LIKE экранируются, иначе "_" и "%" в имени директории работали бы как шаблон
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        
+        if subtree:
+            return sql.or_(File.path == prefix, File.path.like(f'{pattern}/%', escape='\\'))
+        
+        return File.path.like(f'{pattern}%', escape='\\')
     
     async def drop(self, Base: DeclarativeMeta) -> None:
         async with self.__engine.begin() as connection:
@@ -83,34 +460,301 @@ class DBHandler:
         finally:
             await session.close()
     
+    @property
+    def cache_stats(self) -> Dict[str, int]:
+        return self.__cache.stats
+    
+    def _cache_invalidate(self, keys: Optional[List[PageKey]] = None) -> None:
+        self.__cache.invalidate(keys)
+        self.__counts.invalidate(keys)
+    
+    async def _cached(self, cache_key: Tuple[Any, ...], scope: Scope, loader: Any, cache: Optional[QueryCache] = None) -> Coroutine[Any, Any, Any]:
+        cache = cache if cache is not None else self.__cache
+        value = cache.get(cache_key)
+        
+        if value is None:
+            generation = cache.generation
+            value = await loader()
+            cache.put(cache_key, value, scope, generation)
+        
+        return value
+    
+    def metrics_attach(self, metrics: Optional[mtr.Metrics]) -> None:
+        self.__metrics = metrics
+    
+    async def _write(self, work: Work) -> Coroutine[Any, Any, Any]:
+        # Пишущая транзакция: через очередь писателя (единственный писатель SQLite, групповая фиксация), иначе сразу.
+        # Время записи в метриках включает ожидание в очереди.
+        with mtr.timer_get(self.__metrics, 'db_duration', 'write'):
+            if self.__writer is not None:
+                return await self.__writer.submit(work)
+            
+            async with self.get_session() as session:
+                result = await work(session)
+                await session.commit()
+            
+            return result
+    
+    @property
+    def write_stats(self) -> Dict[str, int]:
+        if self.__writer is None:
+            return {}
+        
+        return {'batches': self.__writer.batches, 'works': self.__writer.works}
+    
+    def _upsert_query(self) -> Any:
+        # Строку для только что записанного файла могла уже добавить сверка или наблюдение - ее заменяют данные загрузки.
+        # Чужой строки с этим ключом быть не может: загрузка не пишет поверх существующего файла.
+        table = File.__table__
+        insert = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}.get(self.__engine.dialect.name)
+        
+        if insert is None:
+            return sql.insert(table)
+        
+        sql_query = insert(table)
+        
+        return sql_query.on_conflict_do_update(
+            index_elements=[column for column in table.columns if column.primary_key],
+            set_={column.name: sql_query.excluded[column.name] for column in table.columns if not column.primary_key}
+            )
+    
     async def insert(self, file: Union[File, List[File]]) -> Coroutine[Any, Any, None]:
-        async with self.get_session() as session:
-            session.add(file) if isinstance(file, File) else session.add_all(file)
-            await session.commit()
+        # Вставка без ORM: session.merge читал бы строку перед записью
+        files = [file] if isinstance(file, File) else file
+        attrs = sql.inspect(File).column_attrs
+        values = [{attr.columns[0].name: getattr(item, attr.key) for attr in attrs} for item in files]
+        sql_query = self._upsert_query()
+        
+        await self._write(lambda session: session.execute(sql_query, values))
+        self._cache_invalidate([(item.path, item.name, item.ext) for item in files])
+    
+    async def rows_fetch(self, sql_query: Any) -> Coroutine[Any, Any, List[Tuple[Any, ...]]]:
+        # Чтение без ORM: выбираются только столбцы Result.FIELDS, строки остаются кортежами
+        with mtr.timer_get(self.__metrics, 'db_duration', 'fetch'):
+            async with self.__engine.connect() as connection:
+                result = await connection.execute(sql_query.with_only_columns(*RESULT_COLUMNS))
+                
+                return [tuple(row) for row in result]
+    
+    async def rows_stream(self, sql_query: Any, yield_per: int = 1000) -> AsyncIterator[Tuple[Any, ...]]:
+        # То же через курсор на стороне сервера: в памяти не больше yield_per строк
+        async with self.__engine.connect() as connection:
+            result = await connection.stream(sql_query.with_only_columns(*RESULT_COLUMNS))
+            
+            async for partition in result.partitions(yield_per):
+                for row in partition:
+                    yield tuple(row)
+    
+    async def execute(
+        self, 
+        sql_query: Any, 
+        is_dml: bool = False, 
+        prms: List[Dict[str, str]] = None, 
+        keys: Optional[List[PageKey]] = None
+        ) -> Coroutine[Any, Any, List[Result]]:
+        
+        # keys - ключи строк, которые меняет DML-запрос; если они не переданы, сбрасывается весь кэш
+        if not is_dml:
+            return [Result(row) for row in await self.rows_fetch(sql_query)]
+        
+        await self._write(lambda session: session.execute(sql_query, prms))
+        self._cache_invalidate(keys)
     
     @staticmethod
-    def __result_unpacker(result_item: File) -> Dict[str, Any]:
-        res = {
-        'name': result_item.name,
-        'ext': result_item.ext,
-        'size': result_item.sz,
-        'path': result_item.path,
-        'created_at': result_item.create,
-        'updated_at': result_item.update,
-        'comment': result_item.comment
-        }
+    def _page_query(sql_query: Any, after: Optional[PageKey], limit: int) -> Any:
+        # Keyset-пагинация по (path, name, ext): страница не зависит от смещения и читается по индексу ix_files_listing.
+        # Лишняя строка показывает, есть ли следующая страница.
+        order = (File.path, File.name, File.ext)
+        
+        if after is not None:
+            sql_query = sql_query.where(sql.tuple_(*order) > after)
+        
+        return sql_query.order_by(*order).limit(limit + 1)
     
-        return res
+    async def page(
+        self, 
+        sql_query: Any, 
+        after: Optional[PageKey] = None, 
+        limit: int = 100
+        ) -> Coroutine[Any, Any, Tuple[List[Result], Optional[PageKey]]]:
+        
+        sql_query = self._page_query(sql_query, after, limit)
+        
+        if limit >= self.STREAM_ROWS:
+            result = [Result(row) async for row in self.rows_stream(sql_query)]
+        
+        else:
+            result = await self.execute(sql_query)
+        
+        next_key = None
+        
+        if len(result) > limit:
+            result = result[:limit]
+            next_key = result[-1].key
+        
+        return result, next_key
     
-    async def execute(self, sql_query: Any, is_dml: bool = False, prms: List[Dict[str, str]] = None) -> Coroutine[Any, Any, List[Result]]:
-        async with self.get_session() as session:
-            if is_dml:   
-                await session.execute(sql_query, prms)
-                await session.commit()
+    async def count(self, sql_query: Any, scope: Scope = None) -> Coroutine[Any, Any, int]:
+        # Кол-во строк считается один раз и хранится до изменения строк, попадающих в scope
+        compiled = sql_query.compile()
+        cache_key = ('count', str(compiled), tuple(compiled.params.items()))
+        
+        async def count_load() -> int:
+            with mtr.timer_get(self.__metrics, 'db_duration', 'count'):
+                async with self.get_session() as session:
+                    return await session.scalar(sql.select(sql.func.count()).select_from(sql_query.subquery()))
+        
+        return await self._cached(cache_key, scope, count_load, self.__counts)
+    
+    @staticmethod
+    def __prefix_scope(prefix: Optional[str]) -> Scope:
+        if not prefix:
+            return lambda key: True
+        
+        return lambda key: key[0].startswith(prefix)
+    
+    def __page_scope(self, prefix: Optional[str], after: Optional[PageKey], bound: Optional[PageKey]) -> Scope:
+        # Страница зависит только от строк между курсором и первой строкой следующей страницы включительно.
+        # Порядок строк в Python совпадает с порядком в БД только при побайтовом сравнении (SQLite),
+        # для PostgreSQL со сравнением по локали страница сбрасывается при любом изменении по префиксу.
+        in_prefix = self.__prefix_scope(prefix)
+        
+        if self.__engine.dialect.name != 'sqlite':
+            return in_prefix
+        
+        return lambda key: in_prefix(key) and (after is None or key > after) and (bound is None or key <= bound)
+    
+    async def listing(
+        self, 
+        prefix: Optional[str] = None, 
+        after: Optional[PageKey] = None, 
+        limit: int = 100
+        ) -> Coroutine[Any, Any, Tuple[List[Result], Optional[PageKey], int]]:
+        
+        # Страница списка файлов (всех или с путем, начинающимся с prefix) и их общее кол-во.
+        # В кэше хранятся кортежи значений строк.
+        sql_query = sql.select(File)
+        
+        if prefix:
+            sql_query = sql_query.where(self.prefix_filter(prefix))
+        
+        cache_key = ('page', prefix or None, after, limit)
+        values = self.__cache.get(cache_key)
+        
+        if values is None:
+            generation = self.__cache.generation
+            result, next_key = await self.page(sql_query, after, limit + 1)
+            bound = None
             
-            else:
-                result = await session.execute(sql_query)
-                return [Result(self.__result_unpacker(item)) for item in result.scalars()]
+            # Лишняя строка нужна только для границы зависимости страницы
+            if len(result) > limit:
+                bound = result[limit].key
+                result = result[:limit]
+                next_key = result[-1].key
+            
+            values = ([item.row for item in result], next_key)
+            self.__cache.put(cache_key, values, self.__page_scope(prefix, after, bound), generation)
+        
+        rows, next_key = values
+        total = await self.count(sql_query, self.__prefix_scope(prefix))
+        
+        return [Result(row) for row in rows], next_key, total
+    
+    async def listing_iterate(
+        self, 
+        prefix: Optional[str] = None, 
+        after: Optional[PageKey] = None, 
+        batch_size: int = 1000,
+        subtree: bool = False
+        ) -> AsyncIterator[Result]:
+        
+        # Весь список пачками по keyset-курсору, мимо кэша: каждая пачка - короткое чтение,
+        # поэтому долгая выдача не держит соединение (и блокировку SQLite) открытым.
+        # subtree - prefix как директория (см. prefix_filter).
+        sql_query = sql.select(File)
+        
+        if prefix:
+            sql_query = sql_query.where(self.prefix_filter(prefix, subtree))
+        
+        async for item in self.rows_iterate(sql_query, batch_size, after):
+            yield item
+    
+    async def rows_iterate(
+        self, 
+        sql_query: Any, 
+        batch_size: int = 1000, 
+        after: Optional[PageKey] = None
+        ) -> AsyncIterator[Result]:
+        
+        # Все строки выборки sql_query (select(File) с условиями) пачками, как в listing_iterate
+        while True:
+            result, after = await self.page(sql_query, after, batch_size)
+            
+            for item in result:
+                yield item
+            
+            if after is None:
+                break
+    
+    @staticmethod
+    def hashless_query() -> Any:
+        # Строки без хэша содержимого, которые можно захэшировать по файлу на диске (см. app.jobs.hashes_fill)
+        return sql.select(File).where(File.hash.is_(None), File.encoding.is_(None))
+    
+    async def info(self, key: PageKey) -> Coroutine[Any, Any, List[Result]]:
+        path, name, ext = key
+        
+        async def info_load() -> List[Tuple[Any, ...]]:
+            return await self.rows_fetch(sql.select(File).where(File.name == name, File.path == path, File.ext == ext))
+        
+        rows = await self._cached(('info', key), key.__eq__, info_load)
+        
+        return [Result(row) for row in rows]
+    
+    async def info_many(self, keys: List[PageKey]) -> Coroutine[Any, Any, List[Result]]:
+        # Строки для пачки ключей одним запросом, мимо кэша
+        if not keys:
+            return []
+        
+        return await self.execute(sql.select(File).where(sql.tuple_(File.path, File.name, File.ext).in_(keys)))
+    
+    async def rows_delete(self, keys: List[PageKey]) -> Coroutine[Any, Any, None]:
+        # Одна пакетная команда (executemany) на весь список ключей
+        params = [{"path": path, "name": name, "ext": ext} for path, name, ext in keys]
+        
+        if params:
+            sql_query = sql.delete(File).where(
+                File.name == sql.bindparam('name'),
+                File.path == sql.bindparam('path'),
+                File.ext == sql.bindparam('ext')
+                )
+        
+            await self.execute(sql_query, True, params, keys)
+    
+    async def rows_update(self, changes: List[Tuple[PageKey, Dict[str, Any]]]) -> Coroutine[Any, Any, None]:
+        # Изменение пачки строк одной пакетной командой: у всех изменений должен быть одинаковый набор столбцов
+        # (атрибутов File), например {'path': ..., 'update': ...} при переносе или {'comment': ..., 'update': ...}
+        if not changes:
+            return
+        
+        table = File.__table__
+        columns = {name: File.__mapper__.columns[name].name for name in changes[0][1]}
+        sql_query = sql.update(table).where(
+            table.c.path == sql.bindparam('k_path'),
+            table.c.name == sql.bindparam('k_name'),
+            table.c.extension == sql.bindparam('k_ext')
+            ).values({column: sql.bindparam(f'v_{name}') for name, column in columns.items()})
+        params = [
+            {'k_path': path, 'k_name': name, 'k_ext': ext, **{f'v_{key}': value for key, value in values.items()}}
+            for (path, name, ext), values in changes
+            ]
+        
+        await self._write(lambda session: session.execute(sql_query, params))
+        
+        keys = [key for key, _ in changes]
+        self._cache_invalidate(keys + [
+            (values.get('path', key[0]), values.get('name', key[1]), key[2]) for key, values in changes
+            ])
             
     async def update(self, file: Type[File], request: Request, values: Dict[str, Any]) -> Coroutine[Any, Any, None]:
         sql_query = sql.update(file)\
@@ -121,105 +765,511 @@ class DBHandler:
             )\
             .values(values)
         
-        async with self.get_session() as session:
-            await session.execute(sql_query)
-            await session.commit()
+        await self._write(lambda session: session.execute(sql_query))
+        
+        key = (request.query.get('path'), request.query.get('name'), request.query.get('ext'))
+        new_key = (values.get('path', key[0]), values.get('name', key[1]), key[2])
+        self._cache_invalidate([key, new_key])
+    
+    async def job_insert(self, values: Dict[str, Any]) -> Coroutine[Any, Any, None]:
+        # values - столбцы таблицы jobs
+        await self._write(lambda session: session.execute(sql.insert(Job.__table__).values(values)))
+    
+    async def job_update(self, job_id: str, values: Dict[str, Any], statuses: Optional[Tuple[str, ...]] = None) -> Coroutine[Any, Any, int]:
+        # statuses - изменить, только если задача еще в одном из этих статусов. Возвращает кол-во измененных строк
+        table = Job.__table__
+        sql_query = sql.update(table).where(table.c.id == job_id).values(values)
+        
+        if statuses is not None:
+            sql_query = sql_query.where(table.c.status.in_(statuses))
+        
+        async def update_work(session: AsyncSession) -> int:
+            return (await session.execute(sql_query)).rowcount
+        
+        return await self._write(update_work)
+    
+    async def jobs_fetch(
+        self, 
+        job_id: Optional[str] = None, 
+        kind: Optional[str] = None, 
+        statuses: Optional[Tuple[str, ...]] = None, 
+        limit: int = 100
+        ) -> Coroutine[Any, Any, List[Dict[str, Any]]]:
+        
+        # Задачи, новые сначала, словарями по именам столбцов
+        table = Job.__table__
+        sql_query = sql.select(table).order_by(table.c.created_at.desc(), table.c.id).limit(limit)
+        
+        for column, value in ((table.c.id, job_id), (table.c.kind, kind)):
+            if value is not None:
+                sql_query = sql_query.where(column == value)
+        
+        if statuses is not None:
+            sql_query = sql_query.where(table.c.status.in_(statuses))
+        
+        async with self.__engine.connect() as connection:
+            return [dict(row._mapping) for row in await connection.execute(sql_query)]
+    
+    async def jobs_prune(self, keep: int) -> Coroutine[Any, Any, None]:
+        # В БД остаются последние keep завершенных задач
+        table = Job.__table__
+        sql_query = sql.delete(table).where(table.c.id.in_(
+            sql.select(table.c.id).where(table.c.finished_at.is_not(None)).order_by(table.c.created_at.desc()).offset(keep)
+            ))
+        
+        await self._write(lambda session: session.execute(sql_query))
+    
+    async def reindex(self) -> Coroutine[Any, Any, None]:
+        # Перестроение индексов и статистики планировщика: в SQLite - еще и полнотекстового индекса
+        if self.__engine.dialect.name == 'sqlite':
+            statements = ["INSERT INTO files_fts(files_fts) VALUES ('rebuild')"] if self.__fts else []
+            statements += ['REINDEX files', 'ANALYZE']
+        
+        else:
+            statements = ['REINDEX TABLE files', 'ANALYZE files']
+        
+        async def reindex_work(session: AsyncSession) -> None:
+            for statement in statements:
+                await session.execute(sql.text(statement))
+        
+        await self._write(reindex_work)
     
     async def release(self):
+        if self.__writer is not None:
+            await self.__writer.close()
+        
         await self.__engine.dispose()
+        
+        if self.__stat_pool is not None:
+            self.__stat_pool.shutdown(wait=False)
+            self.__stat_pool = None
 
 
-    # Можно и в статик, т.к. пр-во имен экземпляра не нужно тут, но пусть остается как есть
-    async def _path_aggregate(self, entry_path: tls.T) -> Coroutine[Any, Any, List[tls.T]]:
-        result = []
-        entry_path_items = [Path(entry_path).joinpath(item) for item in await aos.listdir(entry_path)]
-        [result.extend(await self._path_aggregate(item)) if await aos.path.isdir(item) else result.append(item) for item in entry_path_items]
+    def _order_columns(self) -> Tuple[Any, ...]:
+        # Сверка с хранилищем требует побайтового порядка строк, как у сортировки в Python
+        columns = (File.path, File.name, File.ext)
+        
+        if self.__engine.dialect.name == 'postgresql':
+            columns = tuple(sql.collate(column, 'C') for column in columns)
+        
+        return columns
     
-        return result
-
-    # Аналогичная ситуевина, как и с методов выше
-    def _path_relating(self, paths: List[tls.T], related_to_path: tls.T) -> Set[tls.T]:
-        return {path.relative_to(related_to_path) for path in paths}
+    @staticmethod
+    def _stored_size_column() -> Any:
+        # У строк, добавленных до появления stored_size, размер на диске равен size
+        return sql.func.coalesce(File.stored_size, File.sz)
     
-    async def _db_path_aggregate(self, save_dir_path: tls.T) -> Coroutine[Any, Any, List[tls.T]]:
-        sql_query = sql.select(File)
-        paths = [FileHandler.path_constructor(save_dir_path, item.value.get('path', ''), item.value.get('name', ''), item.value.get('ext', ''))\
-            for item in await self.execute(sql_query)]
-
-        return paths
+    async def _db_keys_iterate(self, ranges: Optional[List[Tuple[Optional[str], Optional[str]]]] = None) -> AsyncIterator[Tuple[PageKey, FileMeta]]:
+        # ranges - промежутки path (границы не включаются, None - без границы), по умолчанию все строки
+        order = self._order_columns()
+        base_query = sql.select(File.path, File.name, File.ext, self._stored_size_column(), File.mtime)\
+            .order_by(*order).limit(self.__sync_batch_size)
+        
+        for low, high in ranges if ranges is not None else [(None, None)]:
+            sql_query = base_query
+            
+            if low is not None:
+                sql_query = sql_query.where(order[0] > low)
+            
+            if high is not None:
+                sql_query = sql_query.where(order[0] < high)
+            
+            after = None
+            
+            while True:
+                chunk_query = sql_query if after is None else sql_query.where(sql.tuple_(*order) > after)
+                
+                async with self.get_session() as session:
+                    rows = (await session.execute(chunk_query)).all()
+                
+                for row in rows:
+                    yield tuple(row[:3]), tuple(row[3:])
+                
+                if len(rows) < self.__sync_batch_size:
+                    break
+                
+                after = tuple(rows[-1][:3])
     
-    async def _path_extract(
+    async def _path_counts(self) -> Coroutine[Any, Any, Dict[str, int]]:
+        # Кол-во строк по каждому path - одним проходом по индексу
+        async with self.get_session() as session:
+            return dict((await session.execute(sql.select(File.path, sql.func.count()).group_by(File.path))).all())
+    
+    async def _dirs_unchanged(
         self, 
-        entry_path: tls.T, 
-        related_to_path: tls.T, 
-        aggr_func: Callable[[tls.T], Coroutine[Any, Any, List[tls.T]]]
+        save_dir_path: Path, 
+        manifest: Dict[str, walker.DirMeta], 
+        counts: Dict[str, int]
+        ) -> Coroutine[Any, Any, Set[str]]:
+        
+        # Директории, которые можно не сверять: mtime и inode не изменились (значит, и состав файлов и поддиректорий),
+        # в манифесте есть записи всех поддиректорий, а строк в БД столько же, сколько было файлов.
+        # stat директорий идет в пуле сверки, как и stat файлов.
+        if self.__stat_pool is None:
+            self.__stat_pool = ThreadPoolExecutor(max_workers=self.__stat_workers, thread_name_prefix='stat')
         
-        ) -> Coroutine[Any, Any, Set[tls.T]]:
+        loop = asyncio.get_running_loop()
+        children = walker.manifest_children(manifest)
+        candidates = [
+            path for path, (_, _, files, dirs) in manifest.items() 
+            if dirs == len(children.get(path, ())) and counts.get(path, 0) == files
+            ]
+        part_size = -(-len(candidates) // self.__stat_workers) or 1
+        parts = await asyncio.gather(*[
+            loop.run_in_executor(self.__stat_pool, walker.dirs_unchanged, save_dir_path, manifest, candidates[i:i + part_size])
+            for i in range(0, len(candidates), part_size)
+            ])
         
-        paths = await aggr_func(entry_path)
-        r_paths = self._path_relating(paths, related_to_path)
+        return {path for part in parts for path in part}
     
-        return r_paths
+    @staticmethod
+    def _path_ranges(paths: List[str], skip: AbstractSet[str]) -> List[Tuple[Optional[str], Optional[str]]]:
+        # Промежутки между подряд идущими (в порядке сверки) пропускаемыми path. path, появившийся в БД после подсчета
+        # строк внутри такой серии, сверка не прочитает - его файлы она попробует добавить (см. _rows_insert_safe).
+        ranges, low = [], None
+        
+        for i, path in enumerate(paths):
+            if path not in skip:
+                continue
+            
+            if i == 0 or paths[i - 1] not in skip:
+                ranges.append((low, path))
+            
+            low = path
+        
+        ranges.append((low, None))
+        
+        return ranges
     
-    def _difference_get(self, paths_fh: Set[tls.T], paths_bd: Set[tls.T]) -> Tuple[Set[tls.T], Set[tls.T]]:
-        symmetric = paths_fh.symmetric_difference(paths_bd)
-        paths_fh_db = symmetric - paths_fh
-        paths_db_fh = symmetric - paths_bd
+    async def _fs_entries_iterate(
+        self, 
+        save_dir_path: tls.T, 
+        skip: AbstractSet[str] = frozenset(), 
+        manifest: Optional[Dict[str, walker.DirMeta]] = None, 
+        visited: Optional[Dict[str, walker.DirMeta]] = None
+        ) -> AsyncIterator[walker.Entry]:
         
-        return paths_fh_db, paths_db_fh
+        # Обход идет в потоке пачками, цикл событий ждет только готовые пачки
+        loop = asyncio.get_running_loop()
+        tree = walker.tree_walk(Path(save_dir_path), self.__sync_batch_size, skip, manifest, visited)
+        
+        while True:
+            batch = await loop.run_in_executor(None, next, tree, None)
+            
+            if batch is None:
+                break
+            
+            for item in batch:
+                yield item
     
     def _ext_make(self, path: tls.T, default: str = '') -> str:
-        return ''.join(path.suffixes).lstrip('./\\') if path.suffixes else f'{default}'
+        return walker.ext_make(path, default)
     
-    async def _files_obj_create(self, save_dir_path: tls.T, paths_db_fh: Set[tls.T]) -> Coroutine[Any, Any, List[File]]:
-        files_objs = []
+    @staticmethod
+    def _entries_stat(entries: List[walker.Entry]) -> List[Tuple[PageKey, Optional[os.stat_result]]]:
+        stats = []
         
-        for path in paths_db_fh:
-            file_data_dict = dict()
-            file_data_dict['name'] = path.stem
-            file_data_dict['ext'] = self._ext_make(path)
-            file_data_dict['path'] = str(path.parent)
-            file_data_dict['update'] = None
-            file_data_dict['comment'] = 'У файла нет комментария.'
-            
-            try:    
-                file_stat = await aos.stat(save_dir_path.joinpath(path))
+        for key, entry in entries:
+            try:
+                stats.append((key, entry.stat()))
             
             except FileNotFoundError:
+                stats.append((key, None))
+        
+        return stats
+    
+    async def _entries_stat_parallel(self, entries: List[walker.Entry]) -> Coroutine[Any, Any, List[Tuple[PageKey, Optional[os.stat_result]]]]:
+        # Пачка делится на части по числу потоков отдельного пула: stat блокирует поток, но не держит GIL
+        if self.__stat_pool is None:
+            self.__stat_pool = ThreadPoolExecutor(max_workers=self.__stat_workers, thread_name_prefix='stat')
+        
+        loop = asyncio.get_running_loop()
+        part_size = -(-len(entries) // self.__stat_workers) or 1
+        parts = await asyncio.gather(*[
+            loop.run_in_executor(self.__stat_pool, self._entries_stat, entries[i:i + part_size]) 
+            for i in range(0, len(entries), part_size)
+            ])
+        
+        return [item for part in parts for item in part]
+    
+    @staticmethod
+    def _rows_make(stats: List[Tuple[PageKey, Optional[os.stat_result]]]) -> List[FileRow]:
+        rows = []
+        
+        for (path, name, ext), file_stat in stats:
+            if file_stat is None:
                 created = ''
                 sz = 0
+                mtime = None
+            
             else:
                 created = datetime.utcfromtimestamp(file_stat.st_ctime).isoformat()
                 sz = file_stat.st_size
+                mtime = file_stat.st_mtime_ns
+            
+            rows.append((name, ext, sz, path, created, None, 'У файла нет комментария.', None, sz, None, mtime))
+        
+        return rows
+    
+    async def _rows_insert(self, rows: List[FileRow]) -> Coroutine[Any, Any, None]:
+        # Вставка без ORM: одна executemany на каждые insert_chunk_size строк
+        sql_query = sql.insert(File.__table__)
+        
+        for i in range(0, len(rows), self.__insert_chunk_size):
+            chunk = [dict(zip(self.ROW_COLUMNS, row)) for row in rows[i:i + self.__insert_chunk_size]]
+            await self._write(lambda session: session.execute(sql_query, chunk))
+        
+        if rows:
+            self._cache_invalidate([(path, name, ext) for name, ext, _, path, *_ in rows])
+            self.__rows_count('added', len(rows))
+    
+    async def _rows_insert_safe(self, rows: List[FileRow]) -> Coroutine[Any, Any, None]:
+        try:
+            await self._rows_insert(rows)
+        
+        # Строку успели добавить параллельно (загрузка через веб-интерфейс или сверка)
+        except IntegrityError:
+            for row in rows:
+                try:
+                    await self._rows_insert([row])
                 
-            file_data_dict['create'] = created
-            file_data_dict['sz'] = sz
+                except IntegrityError:
+                    pass
+    
+    async def _add(self, entries: List[walker.Entry]) -> Coroutine[Any, Any, None]:
+        # stat берется из DirEntry
+        stats = await self._entries_stat_parallel(entries)
+        await self._rows_insert_safe(self._rows_make(stats))
+    
+    @staticmethod
+    def _changes_find(stats: List[Tuple[PageKey, Optional[os.stat_result]]], metas: List[FileMeta]) -> List[Tuple[PageKey, os.stat_result]]:
+        return [
+            (key, file_stat) for (key, file_stat), (size, mtime) in zip(stats, metas) 
+            if file_stat is not None and (file_stat.st_size != size or file_stat.st_mtime_ns != mtime)
+            ]
+    
+    async def _rows_refresh(self, changed: List[Tuple[PageKey, os.stat_result]]) -> Coroutine[Any, Any, None]:
+        # Содержимое изменилось: новые размер на диске и mtime, хэш больше не верен.
+        # Размер содержимого сжатого файла без распаковки не узнать - он остается прежним.
+        if not changed:
+            return
+        
+        table = File.__table__
+        sql_query = sql.update(table).where(
+            table.c.path == sql.bindparam('k_path'),
+            table.c.name == sql.bindparam('k_name'),
+            table.c.extension == sql.bindparam('k_ext')
+            ).values(
+                size=sql.case((table.c.encoding.is_(None), sql.bindparam('k_size')), else_=table.c.size),
+                stored_size=sql.bindparam('k_size'), 
+                mtime_ns=sql.bindparam('k_mtime'), 
+                hash=None
+                )
+        params = [
+            {'k_path': path, 'k_name': name, 'k_ext': ext, 'k_size': file_stat.st_size, 'k_mtime': file_stat.st_mtime_ns}
+            for (path, name, ext), file_stat in changed
+            ]
+        
+        await self._write(lambda session: session.execute(sql_query, params))
+        
+        self._cache_invalidate([key for key, _ in changed])
+        self.__rows_count('changed', len(changed))
+    
+    async def _changes_apply(self, items: List[Tuple[walker.Entry, FileMeta]]) -> Coroutine[Any, Any, None]:
+        stats = await self._entries_stat_parallel([entry for entry, _ in items])
+        await self._rows_refresh(self._changes_find(stats, [meta for _, meta in items]))
+    
+    async def _cleane(self, keys: List[PageKey]) -> Coroutine[Any, Any, None]:
+        if keys:
+            await self.rows_delete(keys)
+            self.__rows_count('removed', len(keys))
+    
+    async def _manifest_load(self) -> Coroutine[Any, Any, Dict[str, walker.DirMeta]]:
+        table = Dir.__table__
+        
+        async with self.__engine.connect() as connection:
+            result = await connection.stream(sql.select(table))
             
-            files_objs.append(File(**file_data_dict))
+            return {row[0]: tuple(row[1:]) async for row in result}
+    
+    async def _manifest_save(self, old: Dict[str, walker.DirMeta], new: Dict[str, walker.DirMeta]) -> Coroutine[Any, Any, None]:
+        # Пишется только разница: удаляются записи исчезнувших и измененных директорий, добавляются новые и измененные
+        table = Dir.__table__
+        removed = [{'k_path': path} for path, meta in old.items() if new.get(path) != meta]
+        added = [
+            {'path': path, 'mtime_ns': meta[0], 'inode': meta[1], 'files': meta[2], 'dirs': meta[3]} 
+            for path, meta in new.items() if old.get(path) != meta
+            ]
+        delete_query = sql.delete(table).where(table.c.path == sql.bindparam('k_path'))
+        
+        for i in range(0, len(removed), self.__insert_chunk_size):
+            chunk = removed[i:i + self.__insert_chunk_size]
+            await self._write(lambda session: session.execute(delete_query, chunk))
+        
+        for i in range(0, len(added), self.__insert_chunk_size):
+            chunk = added[i:i + self.__insert_chunk_size]
+            await self._write(lambda session: session.execute(sql.insert(table), chunk))
+    
+    async def _paths_canonize(self) -> Coroutine[Any, Any, None]:
+        # Строки, загруженные c путем вида "/dir" или "./dir", приводятся к виду, который дает обход хранилища,
+        # иначе сверка посчитала бы их отсутствующими в хранилище. Выборка идет по диапазонам индекса в побайтовом
+        # порядке (см. _order_columns): при сравнении по локали PostgreSQL "/dir" может не попасть между "/" и "0".
+        path = self._order_columns()[0]
+        sql_query = sql.select(File.path, File.name, File.ext).where(sql.or_(
+            sql.and_(path >= '/', path < '0'),
+            sql.and_(path >= './', path < '.0'),
+            File.path == ''
+            )).limit(self.__sync_batch_size)
+        
+        async def canonize_work(session: AsyncSession) -> List[Tuple[str, str, str]]:
+            rows = (await session.execute(sql_query)).all()
             
-        return files_objs  
+            for path, name, ext in rows:
+                new_path = FileHandler.path_normalize(path)
+                key_filter = (File.name == name, File.ext == ext)
+                exists = await session.scalar(sql.select(File.name).where(*key_filter, File.path == new_path))
+                
+                if exists is None:
+                    await session.execute(sql.update(File).where(*key_filter, File.path == path).values(path=new_path))
+                
+                else:
+                    await session.execute(sql.delete(File).where(*key_filter, File.path == path))
+            
+            return rows
+        
+        while True:
+            rows = await self._write(canonize_work)
+            
+            if rows:
+                self._cache_invalidate()
+            
+            if len(rows) < self.__sync_batch_size:
+                break
     
-    async def _add(self, save_dir_path: tls.T, paths_db_fh: Set[tls.T]) -> Coroutine[Any, Any, None]:
-        files = await self._files_obj_create(save_dir_path, paths_db_fh)
-        await self.insert(files)
+    async def files_apply(
+        self, 
+        present: List[Tuple[PageKey, Optional[os.stat_result]]], 
+        absent: List[PageKey], 
+        absent_dirs: List[str]
+        ) -> Coroutine[Any, Any, None]:
+        
+        # Точечное применение изменений хранилища (см. app.watcher): директории и файлы, которых больше нет,
+        # удаляются из БД, появившиеся файлы добавляются, если их еще нет в БД.
+        # Поддиректории - промежуток путей в побайтовом порядке, как и у сверки (см. _order_columns).
+        path = self._order_columns()[0]
+        
+        for rel_dir in absent_dirs:
+            sql_query = sql.delete(File).where(sql.or_(
+                File.path == rel_dir,
+                sql.and_(path >= f'{rel_dir}/', path < f'{rel_dir}0')
+                ))
+            await self.execute(sql_query, True)
+        
+        await self._cleane(absent)
+        
+        for i in range(0, len(present), self.__sync_batch_size):
+            chunk = dict(present[i:i + self.__sync_batch_size])
+            sql_query = sql.select(File.path, File.name, File.ext, self._stored_size_column(), File.mtime)\
+                .where(sql.tuple_(File.path, File.name, File.ext).in_(list(chunk)))
+            
+            async with self.get_session() as session:
+                existing = {tuple(row[:3]): tuple(row[3:]) for row in (await session.execute(sql_query)).all()}
+            
+            if self.__change_detect:
+                known = [(key, file_stat) for key, file_stat in chunk.items() if key in existing]
+                await self._rows_refresh(self._changes_find(known, [existing[key] for key, _ in known]))
+            
+            rows = self._rows_make([(key, file_stat) for key, file_stat in chunk.items() if key not in existing])
+            await self._rows_insert_safe(rows)
     
-    async def _cleane(self, paths_fh_db: Set[tls.T]) -> Coroutine[Any, Any, None]:
-        params = [{"path": str(path.parent), "name": path.stem, "ext": self._ext_make(path)} for path in paths_fh_db]
+    def __rows_count(self, change: str, count: int) -> None:
+        if self.__metrics is not None:
+            self.__metrics.reconcile_rows.inc(count, change)
+    
+    async def normalize(
+        self, 
+        save_dir_path: tls.T, 
+        related_to: tls.T, 
+        progress: Optional[Callable[[int], None]] = None
+        ) -> Coroutine[Any, Any, None]:
         
-        if params:
-            sql_query = sql.delete(File).where(
-                File.name == sql.bindparam('name'),
-                File.path == sql.bindparam('path'),
-                File.ext == sql.bindparam('ext')
-                )
+        with mtr.timer_get(self.__metrics, 'reconcile_duration'):
+            await self._reconcile(save_dir_path, related_to, progress)
+    
+    async def _reconcile(
+        self, 
+        save_dir_path: tls.T, 
+        related_to: tls.T, 
+        progress: Optional[Callable[[int], None]] = None
+        ) -> Coroutine[Any, Any, None]:
+        
+        # Сверка слиянием двух отсортированных потоков ключей (path, name, ext): хранилища и БД.
+        # В памяти держится не больше пачки ключей с каждой стороны и пачки изменений.
+        # progress получает кол-во сверенных ключей после каждых sync_batch_size ключей.
+        # С dir_manifest директории, не изменившиеся с прошлой сверки (см. _dirs_unchanged), не читаются ни с диска,
+        # ни из БД: слияние идет только по остальным.
+        await self._paths_canonize()
+        
+        manifest = await self._manifest_load() if self.__dir_manifest else None
+        visited: Optional[Dict[str, walker.DirMeta]] = {} if manifest is not None else None
+        skip, ranges, processed = set(), None, 0
+        
+        if manifest:
+            counts = await self._path_counts()
+            skip = await self._dirs_unchanged(Path(save_dir_path), manifest, counts)
+            ranges = self._path_ranges(sorted(counts), skip)
+            processed = sum(counts.get(path, 0) for path in skip)
+        
+        fs_entries = self._fs_entries_iterate(save_dir_path, skip, manifest, visited)
+        db_keys = self._db_keys_iterate(ranges)
+        fs_item = await anext(fs_entries, None)
+        db_key, db_meta = await anext(db_keys, None) or (None, None)
+        to_add, to_clean, to_check = [], [], []
+        
+        while fs_item is not None or db_key is not None:
+            processed += 1
+            
+            if progress is not None and processed % self.__sync_batch_size == 0:
+                progress(processed)
+            
+            if db_key is None or (fs_item is not None and fs_item[0] < db_key):
+                to_add.append(fs_item)
+                fs_item = await anext(fs_entries, None)
+            
+            elif fs_item is None or db_key < fs_item[0]:
+                to_clean.append(db_key)
+                db_key, db_meta = await anext(db_keys, None) or (None, None)
+            
+            else:
+                # Файл есть и там, и там: с change_detect сверяются размер и mtime
+                if self.__change_detect:
+                    to_check.append((fs_item, db_meta))
+                
+                fs_item = await anext(fs_entries, None)
+                db_key, db_meta = await anext(db_keys, None) or (None, None)
+            
+            if len(to_add) >= self.__insert_chunk_size:
+                await self._add(to_add)
+                to_add = []
+            
+            if len(to_clean) >= self.__sync_batch_size:
+                await self._cleane(to_clean)
+                to_clean = []
+            
+            if len(to_check) >= self.__sync_batch_size:
+                await self._changes_apply(to_check)
+                to_check = []
+        
+        if to_add:
+            await self._add(to_add)
+        
+        if to_check:
+            await self._changes_apply(to_check)
+        
+        await self._cleane(to_clean)
         
-            await self.execute(sql_query, True, params)
-             
-    async def normalize(self, save_dir_path: tls.T, related_to: tls.T) -> Coroutine[Any, Any, None]:
-        files_holder_paths, db_files_paths = await asyncio.gather(
-            self._path_extract(save_dir_path, related_to, self._path_aggregate),
-            self._path_extract(save_dir_path, related_to, self._db_path_aggregate)
-        )
-        paths_fh_db, paths_db_fh = self._difference_get(files_holder_paths, db_files_paths)
+        if manifest is not None:
+            await self._manifest_save(manifest, visited)
         
-        await asyncio.gather(self._add(save_dir_path, paths_db_fh), self._cleane(paths_fh_db))
\ No newline at end of file
+        if progress is not None:
+            progress(processed)
@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+
+Key = Tuple[str, str, str]
+# Проверка "зависит ли запись кэша от строки с ключом (path, name, ext)", None - зависит от всей таблицы
+Scope = Optional[Callable[[Key], bool]]
+
+
+class QueryCache:
+    # LRU с ограничением времени жизни записей. Запись помнит, от каких строк files зависит ее результат,
+    # поэтому изменение строки сбрасывает только затронутые записи. Изменения, сделанные в обход DBHandler
+    # (например, другим процессом), становятся видны не позже чем через ttl секунд.
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0, bulk_threshold: int = 64) -> None:
+        self.__entries: OrderedDict[Hashable, Tuple[float, Any, Scope]] = OrderedDict()
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__bulk_threshold = bulk_threshold
+        self.__generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self) -> int:
+        # Меняется при каждом сбросе: результат чтения, начатого до записи, в кэш не попадет
+        return self.__generation
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self.__entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+    def get(self, cache_key: Hashable) -> Any:
+        entry = self.__entries.get(cache_key)
+
+        if entry is not None and entry[0] < time.monotonic():
+            del self.__entries[cache_key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.__entries.move_to_end(cache_key)
+        self.hits += 1
+
+        return entry[1]
+
+    def put(self, cache_key: Hashable, value: Any, scope: Scope, generation: int) -> None:
+        if self.__max_size <= 0 or generation != self.__generation:
+            return
+
+        self.__entries[cache_key] = (time.monotonic() + self.__ttl, value, scope)
+        self.__entries.move_to_end(cache_key)
+
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, keys: Optional[Iterable[Key]] = None) -> None:
+        # Ключи неизвестны либо их слишком много (пачки сверки) - проще сбросить кэш целиком
+        keys = None if keys is None else list(keys)
+        self.__generation += 1
+
+        if keys is None or len(keys) > self.__bulk_threshold:
+            self.invalidations += len(self.__entries)
+            self.__entries.clear()
+            return
+
+        stale = [
+            cache_key for cache_key, (_, _, scope) in self.__entries.items()
+            if scope is None or any(scope(key) for key in keys)
+            ]
+
+        for cache_key in stale:
+            del self.__entries[cache_key]
+
+        self.invalidations += len(stale)
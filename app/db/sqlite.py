@@ -0,0 +1,37 @@
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+# Настройки соединения SQLite по умолчанию: WAL - читатели не ждут писателя, synchronous=NORMAL - в режиме WAL
+# fsync только при контрольной точке, busy_timeout - сколько ждать блокировку записи другого соединения или процесса (мс)
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'temp_store': 'MEMORY'
+}
+# Опция выполнения: транзакция начинается с BEGIN IMMEDIATE, т.е. сразу берет блокировку записи
+IMMEDIATE_OPTION = 'sqlite_immediate'
+
+
+def engine_setup(engine: AsyncEngine, pragmas: Dict[str, Any]) -> None:
+    # Модуль sqlite3 сам открывает транзакции только перед DML и не поддерживает SAVEPOINT внутри них,
+    # поэтому управление транзакциями переходит к SQLAlchemy: BEGIN выполняется явно в событии begin
+    @event.listens_for(engine.sync_engine, 'connect')
+    def connect(dbapi_connection: Any, connection_record: Any) -> None:
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+        cursor.close()
+
+    @event.listens_for(engine.sync_engine, 'begin')
+    def begin(connection: Any) -> None:
+        immediate = connection.get_execution_options().get(IMMEDIATE_OPTION, False)
+        connection.exec_driver_sql('BEGIN IMMEDIATE' if immediate else 'BEGIN')
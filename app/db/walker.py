@@ -0,0 +1,140 @@
+import heapq
+import os
+import time
+from collections import defaultdict
+from itertools import count
+from pathlib import Path
+from typing import AbstractSet, Dict, Iterator, List, Optional, Tuple
+
+from app.uploads import UPLOADS_DIR
+from app.uploads.blobs import BLOBS_DIR
+
+
+Key = Tuple[str, str, str]
+Entry = Tuple[Key, os.DirEntry]
+# Запись манифеста директорий: mtime_ns, inode, кол-во файлов и поддиректорий на момент обхода
+DirMeta = Tuple[int, int, int, int]
+# Директория, измененная позже чем за столько наносекунд до обхода, в манифест не попадает: изменение в тот же
+# квант времени файловой системы не сдвинуло бы ее mtime
+RACY_NS = 2_000_000_000
+
+# Служебные директории в корне хранилища (незавершенные загрузки, содержимое по хэшу), их содержимое - не файлы каталога
+SERVICE_DIRS = frozenset((UPLOADS_DIR, BLOBS_DIR))
+
+
+def ext_make(path: Path, default: str = '') -> str:
+    return ''.join(path.suffixes).lstrip('./\\') if path.suffixes else f'{default}'
+
+
+def key_make(rel_dir: str, file_name: str) -> Key:
+    path = Path(file_name)
+
+    return rel_dir, path.stem, ext_make(path)
+
+
+def manifest_children(manifest: Dict[str, DirMeta]) -> Dict[str, List[str]]:
+    # Имена поддиректорий каждой директории манифеста
+    children = defaultdict(list)
+
+    for rel_dir in manifest:
+        if rel_dir != '.':
+            parent, _, name = rel_dir.rpartition('/')
+            children[parent or '.'].append(name)
+
+    return children
+
+
+def dirs_unchanged(root: Path, manifest: Dict[str, DirMeta], rel_dirs: List[str]) -> List[str]:
+    # Директории из rel_dirs, у которых mtime и inode те же, что в манифесте
+    unchanged = []
+
+    for rel_dir in rel_dirs:
+        try:
+            dir_stat = os.stat(root.joinpath(rel_dir))
+
+        except OSError:
+            continue
+
+        if manifest[rel_dir][:2] == (dir_stat.st_mtime_ns, dir_stat.st_ino):
+            unchanged.append(rel_dir)
+
+    return unchanged
+
+
+def tree_walk(
+    root: Path,
+    batch_size: int = 1000,
+    skip: AbstractSet[str] = frozenset(),
+    manifest: Optional[Dict[str, DirMeta]] = None,
+    visited: Optional[Dict[str, DirMeta]] = None
+    ) -> Iterator[List[Entry]]:
+
+    # Обход хранилища в порядке (path, name, ext), том же, что и у индекса ix_files_listing в БД.
+    # Директории достаются из кучи по строке относительного пути: потомки всегда "больше" родителя,
+    # поэтому файлы выдаются в глобально отсортированном порядке, а в памяти лежит только очередь
+    # еще не прочитанных директорий и содержимое одной текущей.
+    # Директории из skip (не изменившиеся с прошлого обхода) не читаются: их файлы не выдаются, а поддиректории
+    # берутся из manifest. В visited попадают записи пройденных директорий - манифест для следующего обхода.
+    seq = count()
+    heap = [('.', next(seq), None)]
+    batch = []
+    children = manifest_children(manifest) if skip else {}
+    racy_after = time.time_ns() - RACY_NS
+
+    while heap:
+        rel_dir, _, entries = heapq.heappop(heap)
+
+        if entries is None and rel_dir in skip:
+            for name in children.get(rel_dir, ()):
+                heapq.heappush(heap, (name if rel_dir == '.' else f'{rel_dir}/{name}', next(seq), None))
+
+            if visited is not None:
+                visited[rel_dir] = manifest[rel_dir]
+
+        elif entries is None:
+            abs_dir = root.joinpath(rel_dir)
+            files = []
+            sub_dirs = 0
+
+            try:
+                dir_stat = os.stat(abs_dir)
+
+                with os.scandir(abs_dir) as dir_iter:
+                    for entry in dir_iter:
+                        try:
+                            is_dir = entry.is_dir()
+
+                        except OSError:
+                            continue
+
+                        if is_dir and rel_dir == '.' and entry.name in SERVICE_DIRS:
+                            continue
+
+                        if is_dir:
+                            sub_dir = entry.name if rel_dir == '.' else f'{rel_dir}/{entry.name}'
+                            heapq.heappush(heap, (sub_dir, next(seq), None))
+                            sub_dirs += 1
+
+                        else:
+                            files.append((key_make(rel_dir, entry.name), entry))
+
+            # Директорию могли удалить или закрыть доступ во время обхода
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+
+            if visited is not None and dir_stat.st_mtime_ns < racy_after:
+                visited[rel_dir] = (dir_stat.st_mtime_ns, dir_stat.st_ino, len(files), sub_dirs)
+
+            files.sort(key=lambda item: item[0])
+            heapq.heappush(heap, (rel_dir, next(seq), files))
+
+        else:
+            for item in entries:
+                batch.append(item)
+
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+    if batch:
+        yield batch
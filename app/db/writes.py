@@ -0,0 +1,110 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+Work = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class WriteQueue:
+    # Единственный писатель: пишущие транзакции выполняет по очереди одна задача, поэтому соединения процесса
+    # не борются за блокировку записи SQLite. Все, что успело накопиться в очереди, пока шла предыдущая
+    # транзакция (не больше max_batch), выполняется в одной транзакции: каждая работа - в своей точке
+    # сохранения, так что ошибка одной откатывает только ее, а фиксация и fsync - одни на всю пачку.
+    # window - групповая фиксация: сколько секунд после первой работы ждать следующие, пока их меньше max_batch.
+    def __init__(self, session_maker: Callable[[], AsyncSession], max_batch: int = 256, window: float = 0.0) -> None:
+        self.__session_maker = session_maker
+        self.__max_batch = max_batch
+        self.__window = window
+        self.__queue: Optional[asyncio.Queue] = None
+        self.__task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.works = 0
+
+    async def submit(self, work: Work) -> Any:
+        if self.__task is None:
+            self.__queue = asyncio.Queue()
+            self.__task = asyncio.create_task(self.__run())
+
+        future = asyncio.get_running_loop().create_future()
+        self.__queue.put_nowait((work, future))
+
+        return await future
+
+    async def _batch_take(self, first: Tuple[Work, asyncio.Future]) -> List[Tuple[Work, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.__window
+        batch = [first]
+
+        while len(batch) < self.__max_batch:
+            if not self.__queue.empty():
+                batch.append(self.__queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self.__queue.get(), timeout))
+
+            except asyncio.TimeoutError:
+                break
+
+        # Запрос, который перестали ждать, не выполняется
+        return [(work, future) for work, future in batch if not future.cancelled()]
+
+    async def _batch_run(self, batch: List[Tuple[Work, asyncio.Future]]) -> None:
+        results: List[Tuple[asyncio.Future, Any, Optional[BaseException]]] = []
+
+        try:
+            async with self.__session_maker() as session:
+                async with session.begin():
+                    for work, future in batch:
+                        if len(batch) == 1:
+                            results.append((future, await work(session), None))
+                            continue
+
+                        try:
+                            async with session.begin_nested():
+                                result = await work(session)
+
+                        except Exception as e:
+                            results.append((future, None, e))
+
+                        else:
+                            results.append((future, result, None))
+
+        # Не удалась вся транзакция (ошибка единственной работы или фиксации)
+        except Exception as e:
+            results = [(future, None, e) for _, future in batch]
+
+        self.batches += 1
+        self.works += len(batch)
+
+        for future, result, error in results:
+            if future.done():
+                continue
+
+            if error is not None:
+                future.set_exception(error)
+
+            else:
+                future.set_result(result)
+
+    async def __run(self) -> None:
+        while True:
+            batch = await self._batch_take(await self.__queue.get())
+
+            if batch:
+                await self._batch_run(batch)
+
+    async def close(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+
+            while not self.__queue.empty():
+                self.__queue.get_nowait()[1].cancel()
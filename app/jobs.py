@@ -0,0 +1,359 @@
+import asyncio
+import json
+import os
+import secrets
+import time
+from concurrent.futures import Executor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+import app.routes.tools as tls
+from app.db import DBHandler
+from app.uploads.blobs import file_hash
+
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+ACTIVE = (QUEUED, RUNNING)
+# Задача без отметки процесса дольше HEARTBEAT_INTERVAL * HEARTBEAT_MISSES секунд считается прерванной
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_MISSES = 10
+
+
+class JobProgress:
+    # Счетчики выполнения, которые обновляет сама операция; total - None, если объем заранее неизвестен
+    __slots__ = 'done', 'total'
+
+    def __init__(self) -> None:
+        self.done = 0
+        self.total: Optional[int] = None
+
+    def update(self, done: int, total: Optional[int] = None) -> None:
+        self.done = done
+
+        if total is not None:
+            self.total = total
+
+
+JobWork = Callable[[JobProgress], Awaitable[Optional[Dict[str, Any]]]]
+
+
+class Job:
+    __slots__ = 'id', 'kind', 'status', 'created_at', 'started_at', 'finished_at', 'error', 'result', 'progress', 'task'
+
+    def __init__(self, kind: str) -> None:
+        self.id = secrets.token_hex(16)
+        self.kind = kind
+        self.status = QUEUED
+        self.created_at = datetime.now().isoformat()
+        self.started_at: Optional[str] = None
+        self.finished_at: Optional[str] = None
+        self.error: Optional[str] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.progress = JobProgress()
+        self.task: Optional[asyncio.Task] = None
+
+    def row(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'heartbeat': time.time(),
+            'done': self.progress.done,
+            'total': self.progress.total,
+            'error': self.error,
+            'result': json.dumps(self.result, ensure_ascii=False) if self.result is not None else None
+        }
+
+
+def job_value(row: Dict[str, Any]) -> Dict[str, Any]:
+    # Строка таблицы jobs (или Job.row()) в виде ответа API
+    started, finished = row['started_at'], row['finished_at']
+    duration = None
+
+    if started is not None:
+        end = datetime.fromisoformat(finished) if finished is not None else datetime.now()
+        duration = round((end - datetime.fromisoformat(started)).total_seconds(), 3)
+
+    return {
+        'id': row['id'],
+        'kind': row['kind'],
+        'status': row['status'],
+        'created_at': row['created_at'],
+        'started_at': started,
+        'finished_at': finished,
+        'duration_s': duration,
+        'progress': {'done': row['done'] or 0, 'total': row['total']},
+        'error': row['error'],
+        'result': json.loads(row['result']) if row['result'] else None
+    }
+
+
+class JobManager:
+    # Фоновые задачи приложения: запрос получает id задачи сразу, а сама операция идет в отдельной asyncio-задаче.
+    # Одновременно выполняется не больше concurrency задач, остальные ждут в статусе queued. Задача одного вида
+    # не запускается повторно, пока предыдущая не завершена, - возвращается уже идущая, в том числе из соседнего
+    # процесса: активная задача вида в таблице jobs одна (уникальный индекс ux_jobs_active_kind), поэтому из двух
+    # процессов, одновременно создающих задачу, создаст ее только один. Статус, прогресс и итог пишутся в таблицу jobs,
+    # в БД хранятся последние history задач.
+    def __init__(self, db_handler: DBHandler, concurrency: int = 1, history: int = 100) -> None:
+        self.__db = db_handler
+        self.__semaphore = asyncio.Semaphore(concurrency)
+        self.__history = history
+        self.__kinds: Dict[str, JobWork] = {}
+        self.__jobs: Dict[str, Job] = {}
+        self.__lock = asyncio.Lock()
+        self.__startup_job: Optional[str] = None
+
+    def register(self, kind: str, work: JobWork) -> None:
+        self.__kinds[kind] = work
+
+    @property
+    def kinds(self) -> Tuple[str, ...]:
+        return tuple(self.__kinds)
+
+    @property
+    def startup_job(self) -> Optional[str]:
+        # id сверки при старте этого процесса (fast_start). Хранится здесь, а не в приложении:
+        # после запуска приложение менять нельзя
+        return self.__startup_job
+
+    def startup_mark(self, job_id: str) -> None:
+        self.__startup_job = job_id
+
+    @staticmethod
+    def __alive(row: Dict[str, Any]) -> bool:
+        return row['heartbeat'] is not None and time.time() - row['heartbeat'] < HEARTBEAT_INTERVAL * HEARTBEAT_MISSES
+
+    async def __dead_mark(self, row: Dict[str, Any], error: str) -> Coroutine[Any, Any, None]:
+        await self.__db.job_update(row['id'], {'status': FAILED, 'error': error, 'finished_at': datetime.now().isoformat()}, ACTIVE)
+
+    async def __active_find(self, kind: str) -> Coroutine[Any, Any, Optional[Dict[str, Any]]]:
+        # Идущая задача вида; задачи, процесс которых остановлен, помечаются неудачными
+        for job in self.__jobs.values():
+            if job.kind == kind:
+                return job_value(job.row())
+
+        for row in await self.__db.jobs_fetch(kind=kind, statuses=ACTIVE):
+            if self.__alive(row):
+                return job_value(row)
+
+            await self.__dead_mark(row, 'Процесс задачи остановлен.')
+
+        return None
+
+    async def submit(self, kind: str) -> Coroutine[Any, Any, Tuple[Dict[str, Any], bool]]:
+        # Задача и признак того, что она создана этим вызовом, а не найдена среди идущих
+        if kind not in self.__kinds:
+            raise KeyError(kind)
+
+        async with self.__lock:
+            while True:
+                found = await self.__active_find(kind)
+
+                if found is not None:
+                    return found, False
+
+                job = Job(kind)
+
+                try:
+                    await self.__db.job_insert(job.row())
+                    break
+
+                # Соседний процесс успел создать задачу того же вида после проверки - возвращается она
+                except IntegrityError:
+                    continue
+
+            self.__jobs[job.id] = job
+            job.task = asyncio.create_task(self.__run(job, self.__kinds[kind]))
+
+        return job_value(job.row()), True
+
+    async def __heartbeat(self, job: Job) -> Coroutine[Any, Any, None]:
+        # Прогресс и отметка о том, что процесс жив. Задачу, отмененную через БД (из другого процесса), здесь и прерывают.
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            row = job.row()
+            values = {key: row[key] for key in ('heartbeat', 'done', 'total')}
+
+            try:
+                if not await self.__db.job_update(job.id, values, ACTIVE):
+                    job.task.cancel()
+                    return
+
+            except Exception as e:
+                print(f'Ошибка сохранения состояния задачи {job.kind} ({job.id}): {e!r}')
+
+    async def __run(self, job: Job, work: JobWork) -> Coroutine[Any, Any, None]:
+        heartbeat = asyncio.create_task(self.__heartbeat(job))
+
+        try:
+            async with self.__semaphore:
+                job.status = RUNNING
+                job.started_at = datetime.now().isoformat()
+                await self.__db.job_update(job.id, {'status': RUNNING, 'started_at': job.started_at}, ACTIVE)
+                job.result = await work(job.progress)
+
+            job.status = DONE
+
+        except asyncio.CancelledError:
+            job.status = CANCELLED
+
+        except Exception as e:
+            job.status = FAILED
+            job.error = repr(e)
+            print(f'Ошибка задачи {job.kind} ({job.id}): {e!r}')
+
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            job.finished_at = datetime.now().isoformat()
+
+            try:
+                await self.__db.job_update(job.id, job.row())
+                await self.__db.jobs_prune(self.__history)
+
+            except Exception as e:
+                print(f'Ошибка сохранения состояния задачи {job.kind} ({job.id}): {e!r}')
+
+            self.__jobs.pop(job.id, None)
+
+    async def get(self, job_id: str) -> Coroutine[Any, Any, Optional[Dict[str, Any]]]:
+        if job_id in self.__jobs:
+            return job_value(self.__jobs[job_id].row())
+
+        rows = await self.__db.jobs_fetch(job_id=job_id, limit=1)
+
+        return job_value(rows[0]) if rows else None
+
+    async def wait(self, job_id: str) -> Coroutine[Any, Any, Optional[Dict[str, Any]]]:
+        # Задача после завершения. Задача этого процесса ожидается напрямую, соседнего - по отметкам в БД.
+        job = self.__jobs.get(job_id)
+
+        # asyncio.wait, а не gather: отмена ожидающего не должна отменять задачу
+        if job is not None:
+            await asyncio.wait([job.task])
+
+        while True:
+            rows = await self.__db.jobs_fetch(job_id=job_id, limit=1)
+
+            if not rows or rows[0]['status'] not in ACTIVE:
+                return job_value(rows[0]) if rows else None
+
+            if not self.__alive(rows[0]):
+                await self.__dead_mark(rows[0], 'Процесс задачи остановлен.')
+                continue
+
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def last(self, kind: str) -> Coroutine[Any, Any, Optional[Dict[str, Any]]]:
+        rows = await self.__db.jobs_fetch(kind=kind, limit=1)
+
+        if not rows:
+            return None
+
+        return job_value(self.__jobs[rows[0]['id']].row()) if rows[0]['id'] in self.__jobs else job_value(rows[0])
+
+    async def listing(self, limit: int = 100) -> Coroutine[Any, Any, List[Dict[str, Any]]]:
+        # Идущие задачи этого процесса - с текущим прогрессом, а не с последней отметкой в БД
+        return [
+            job_value(self.__jobs[row['id']].row()) if row['id'] in self.__jobs else job_value(row)
+            for row in await self.__db.jobs_fetch(limit=limit)
+            ]
+
+    async def cancel(self, job_id: str) -> Coroutine[Any, Any, Optional[Dict[str, Any]]]:
+        # Задача из другого процесса отменяется через БД: ее процесс увидит это при следующей отметке
+        job = self.__jobs.get(job_id)
+
+        if job is not None:
+            job.task.cancel()
+            await asyncio.gather(job.task, return_exceptions=True)
+
+        else:
+            await self.__db.job_update(job_id, {'status': CANCELLED, 'finished_at': datetime.now().isoformat()}, ACTIVE)
+
+        return await self.get(job_id)
+
+    async def start(self) -> Coroutine[Any, Any, None]:
+        # Задачи, оставшиеся активными в БД после остановки приложения, уже никто не выполнит.
+        # Задачи соседних процессов, успевших запуститься раньше, живы - их отметки свежие.
+        for row in await self.__db.jobs_fetch(statuses=ACTIVE, limit=self.__history):
+            if not self.__alive(row):
+                await self.__dead_mark(row, 'Прервана остановкой приложения.')
+
+    async def stop(self) -> Coroutine[Any, Any, None]:
+        tasks = [job.task for job in self.__jobs.values()]
+        [task.cancel() for task in tasks]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _hash_make(path: Path) -> Optional[Tuple[str, int]]:
+    # Хэш и mtime_ns, при котором он посчитан; файл, изменившийся во время чтения, пропускается
+    try:
+        before = os.stat(path).st_mtime_ns
+        digest = file_hash(path)
+
+        return (digest, before) if os.stat(path).st_mtime_ns == before else None
+
+    except OSError:
+        return None
+
+
+async def hashes_fill(
+    db_handler: DBHandler,
+    save_dir: Path,
+    io_pool: Optional[Executor],
+    progress: JobProgress,
+    chunk_size: int = 500
+    ) -> Coroutine[Any, Any, Dict[str, int]]:
+
+    # Хэши файлов, у которых их нет (добавлены сверкой или изменены в обход приложения). У сжатых в хранилище
+    # файлов хэш исходного содержимого посчитан при загрузке, по файлу на диске его не получить - они пропускаются.
+    loop = asyncio.get_running_loop()
+    total = await db_handler.count(db_handler.hashless_query())
+    progress.update(0, total)
+    hashed, chunk = 0, []
+
+    async def chunk_apply(items: List[Any]) -> int:
+        digests = await asyncio.gather(*[
+            loop.run_in_executor(io_pool, _hash_make, tls.FileHandler.path_constructor(save_dir, *item.key)) for item in items
+            ])
+        changes = [(item.key, {'hash': digest[0], 'mtime': digest[1]}) for item, digest in zip(items, digests) if digest is not None]
+        await db_handler.rows_update(changes)
+
+        return len(changes)
+
+    async for item in db_handler.rows_iterate(db_handler.hashless_query(), chunk_size):
+        chunk.append(item)
+
+        if len(chunk) >= chunk_size:
+            hashed += await chunk_apply(chunk)
+            progress.update(progress.done + len(chunk))
+            chunk = []
+
+    if chunk:
+        hashed += await chunk_apply(chunk)
+        progress.update(progress.done + len(chunk))
+
+    return {'hashed': hashed, 'skipped': progress.done - hashed}
+
+
+def kinds_register(manager: JobManager, save_dir: Path, db_handler: DBHandler, io_pool: Optional[Executor]) -> None:
+    # sync - сверка БД с хранилищем, rehash - хэши файлов без хэша, reindex - перестроение индексов БД
+    async def sync(progress: JobProgress) -> None:
+        await db_handler.normalize(save_dir, save_dir, progress.update)
+
+    async def rehash(progress: JobProgress) -> Dict[str, int]:
+        return await hashes_fill(db_handler, save_dir, io_pool, progress)
+
+    async def reindex(progress: JobProgress) -> None:
+        await db_handler.reindex()
+
+    manager.register('sync', sync)
+    manager.register('rehash', rehash)
+    manager.register('reindex', reindex)
@@ -0,0 +1,144 @@
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
+
+
+# Границы корзин гистограмм длительности по умолчанию, секунды
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Без метрик замер - один общий пустой контекст
+NULL_TIMER = nullcontext()
+
+Labels = Tuple[str, ...]
+
+
+def label_escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def value_format(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, help_text: str, label_names: Labels = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: Dict[Labels, Any] = {}
+
+    def _labels_format(self, labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = [*zip(self.label_names, labels), *extra]
+
+        if not pairs:
+            return ''
+
+        return '{' + ','.join(f'{key}="{label_escape(value)}"' for key, value in pairs) + '}'
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name}{self._labels_format(labels)} {value_format(value)}' for labels, value in sorted(self._values.items())]
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.TYPE}', *self._samples()]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, value: float = 1, *labels: str) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def inc(self, value: float = 1, *labels: str) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def dec(self, value: float = 1, *labels: str) -> None:
+        self._values[labels] = self._values.get(labels, 0) - value
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help_text: str, label_names: Labels = (), buckets: Tuple[float, ...] = BUCKETS) -> None:
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        # Значение: [кол-во в каждой корзине (последняя - +Inf), сумма]
+        state = self._values.get(labels)
+
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def _samples(self) -> List[str]:
+        samples = []
+
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                samples.append(f'{self.name}_bucket{self._labels_format(labels, (("le", value_format(bound)),))} {cumulative}')
+
+            samples.append(f'{self.name}_sum{self._labels_format(labels)} {value_format(total)}')
+            samples.append(f'{self.name}_count{self._labels_format(labels)} {cumulative}')
+
+        return samples
+
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram: Histogram, labels: Labels) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> 'Timer':
+        self.started = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Metrics:
+    # Метрики одного процесса приложения в текстовом формате Prometheus. Значения меняются только из цикла событий,
+    # поэтому блокировки не нужны. При нескольких процессах (workers) у каждого свои значения.
+    def __init__(self) -> None:
+        self.requests = Counter('http_requests_total', 'HTTP requests.', ('method', 'route', 'status'))
+        self.request_duration = Histogram('http_request_duration_seconds', 'HTTP request handling time.', ('method', 'route'))
+        self.in_flight = Gauge('http_requests_in_flight', 'HTTP requests being handled.')
+        self.stage_duration = Histogram('handler_stage_duration_seconds', 'Time spent in request handling stages.', ('stage',))
+        self.db_duration = Histogram('db_query_duration_seconds', 'Database query time.', ('operation',))
+        self.upload_bytes = Counter('upload_bytes_total', 'Bytes of file content received.')
+        self.download_bytes = Counter('download_bytes_total', 'Bytes of file content sent.')
+        self.reconcile_duration = Histogram('reconcile_duration_seconds', 'Storage and database reconcile time.')
+        self.reconcile_rows = Counter('reconcile_rows_total', 'Rows changed by reconcile and storage watching.', ('change',))
+        self.__metrics: List[Metric] = [value for value in vars(self).values() if isinstance(value, Metric)]
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.__metrics for line in metric.render()) + '\n'
+
+
+def timer_get(metrics: Optional[Metrics], name: str, *labels: str) -> ContextManager[Any]:
+    # name - имя гистограммы в Metrics: with timer_get(metrics, 'db_duration', 'fetch'): ...
+    if metrics is None:
+        return NULL_TIMER
+
+    return Timer(getattr(metrics, name), labels)
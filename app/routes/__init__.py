@@ -2,7 +2,7 @@ import aiohttp.web as web
 from aiohttp.web import Application
 
 import app as m_app
-from app.routes import handlers
+from app.routes import api, archive, bulk, handlers, jobs, monitoring
 
 
 def routes_setup(app: Application) -> None:
@@ -14,6 +14,11 @@ def routes_setup(app: Application) -> None:
     insert_handler = handlers.InsertHandler(app)
     update_handler = handlers.UpdateHandler(app)
     sync_handler = handlers.SyncHandler(app)
+    api_handler = api.ApiHandler(app)
+    upload_handler = api.UploadApiHandler(app)
+    bulk_handler = bulk.BulkApiHandler(app)
+    archive_handler = archive.ArchiveApiHandler(app)
+    job_handler = jobs.JobApiHandler(app)
     
     app.add_routes([
         web.get('/search', search_handler.get, name='g_search'),
@@ -27,7 +32,31 @@ def routes_setup(app: Application) -> None:
         web.post('/insert', insert_handler.post, name='p_insert'),
         web.get('/update', update_handler.get, name='g_update'),
         web.post('/update', update_handler.post, name='p_update'),
-        web.get('/sync', sync_handler.get, name='sync')
+        web.get('/sync', sync_handler.get, name='sync'),
+        web.get('/api/v1/files', api_handler.files_list, name='api_files'),
+        web.post('/api/v1/files', api_handler.file_upload, name='api_upload'),
+        web.get('/api/v1/files/{id}', api_handler.file_get, name='api_file'),
+        web.delete('/api/v1/files/{id}', api_handler.file_delete, name='api_delete'),
+        web.get('/api/v1/files/{id}/content', api_handler.file_content, name='api_content'),
+        web.get('/api/v1/search', api_handler.search, name='api_search'),
+        web.post('/api/v1/sync', job_handler.sync, name='api_sync'),
+        web.get('/api/v1/jobs', job_handler.listing, name='api_jobs'),
+        web.post('/api/v1/jobs', job_handler.create, name='api_job_create'),
+        web.get('/api/v1/jobs/{id}', job_handler.get, name='api_job'),
+        web.delete('/api/v1/jobs/{id}', job_handler.cancel, name='api_job_cancel'),
+        web.post('/api/v1/bulk', bulk_handler.bulk, name='api_bulk'),
+        web.get('/api/v1/archive', archive_handler.archive, name='api_archive'),
+        web.post('/api/v1/uploads', upload_handler.create, name='api_upload_create'),
+        web.get('/api/v1/uploads/{id}', upload_handler.status, name='api_upload_status'),
+        web.delete('/api/v1/uploads/{id}', upload_handler.abort, name='api_upload_abort'),
+        web.put('/api/v1/uploads/{id}/parts/{number}', upload_handler.part_put, name='api_upload_part'),
+        web.post('/api/v1/uploads/{id}/commit', upload_handler.commit, name='api_upload_commit')
     ])
     
-    app.router.add_static('/static', m_app.STATIC_DIR, name='static')
\ No newline at end of file
+    app.router.add_static('/static', m_app.STATIC_DIR, name='static')
+    app.router.add_get('/ready', monitoring.ReadinessHandler(app).get, name='ready')
+    
+    # Без метрик (app_vars.metrics) нет ни промежуточного слоя, ни /metrics: запросы не замеряются вовсе
+    if app['METRICS'] is not None:
+        app.middlewares.append(monitoring.metrics_middleware)
+        app.router.add_get('/metrics', monitoring.MetricsHandler(app).get, name='metrics')
\ No newline at end of file
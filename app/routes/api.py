@@ -0,0 +1,257 @@
+import asyncio
+import json
+from aiohttp import hdrs
+from datetime import datetime
+from aiohttp.web import Application, HTTPBadRequest, Request, Response, StreamResponse, json_response
+from typing import Any, AsyncIterator, Coroutine, Dict, Optional
+
+import app.db as db
+from app.routes import exceptipon as exc
+from app.routes import forms as fs
+from app.routes import tools as tls
+from app.routes.handlers import BaseHandler
+from app.uploads import UploadError, UploadManager, blobs
+
+
+NDJSON_TYPE = 'application/x-ndjson'
+
+
+class ApiHandler(BaseHandler):
+    # JSON API поверх тех же DBHandler и FileHandler, что и HTML-страницы.
+    # Файл адресуется идентификатором - закодированным ключом (path, name, ext), как курсор страницы.
+    NDJSON_BATCH = 1000
+
+    def __init__(self, app: Application) -> None:
+        super().__init__(app)
+
+    @staticmethod
+    def _error(status: int, message: str) -> Response:
+        return json_response({'error': message}, status=status)
+
+    @staticmethod
+    def _item_make(item: db.Result) -> Dict[str, Any]:
+        return {'id': tls.cursor_encode(item.key), **item.value}
+
+    def _key_get(self, request: Request) -> Optional[db.PageKey]:
+        return tls.cursor_decode(request.match_info['id'])
+
+    @staticmethod
+    def _ndjson_wanted(request: Request) -> bool:
+        return request.query.get('format') == 'ndjson' or NDJSON_TYPE in request.headers.get(hdrs.ACCEPT, '')
+
+    async def _ndjson_send(self, request: Request, items: AsyncIterator[db.Result]) -> Coroutine[Any, Any, StreamResponse]:
+        # Ответ начинается сразу, строки отправляются пачками по мере чтения из БД
+        response = StreamResponse(headers={hdrs.CONTENT_TYPE: NDJSON_TYPE})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        lines = []
+        async for item in items:
+            lines.append(json.dumps(self._item_make(item), ensure_ascii=False))
+
+            if len(lines) >= self.NDJSON_BATCH:
+                await response.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                lines = []
+
+        if lines:
+            await response.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+        await response.write_eof()
+
+        return response
+
+    async def _listing_send(self, request: Request, prefix: Optional[str]) -> Coroutine[Any, Any, StreamResponse]:
+        db_handler: db.DBHandler = self._app['DB_HANDLER']
+        limit, after = self._page_params_get(request)
+
+        if self._ndjson_wanted(request):
+            return await self._ndjson_send(request, db_handler.listing_iterate(prefix, after, self.NDJSON_BATCH))
+
+        result, next_key, total = await db_handler.listing(prefix, after, limit)
+
+        return json_response({
+            'items': [self._item_make(item) for item in result],
+            'total': total,
+            'next': tls.cursor_encode(next_key) if next_key is not None else None
+        })
+
+    async def files_list(self, request: Request) -> Coroutine[Any, Any, StreamResponse]:
+        prefix = request.query.get('prefix')
+
+        return await self._listing_send(request, prefix.lstrip('./') if prefix else None)
+
+    async def file_get(self, request: Request) -> Coroutine[Any, Any, Response]:
+        key = self._key_get(request)
+        result = await self._app['DB_HANDLER'].info(key) if key is not None else None
+
+        if not result:
+            return self._error(404, 'Такого файла не существует.')
+
+        return json_response(self._item_make(result[0]))
+
+    async def file_content(self, request: Request) -> Coroutine[Any, Any, StreamResponse]:
+        key = self._key_get(request)
+
+        if key is None:
+            return self._error(404, 'Такого файла не существует.')
+
+        handle_path = tls.FileHandler.path_constructor(self._app['SAVE_DIR'], *key)
+
+        try:
+            response = await self._file_download(request, key)
+
+        except FileNotFoundError:
+            return self._error(404, 'Такого файла не существует.')
+
+        response.headers['content-disposition'] = f'attachment; filename="{handle_path.name}"'
+
+        return response
+
+    async def file_upload(self, request: Request) -> Coroutine[Any, Any, Response]:
+        if not request.content_type.startswith('multipart/'):
+            return self._error(400, 'Файл загружается формой multipart/form-data.')
+
+        try:
+            form = await self._file_upload(request)
+
+        except exc.RequiredFormFieldError as e:
+            return self._error(400, str(e))
+
+        except HTTPBadRequest as e:
+            return self._error(400, e.text)
+
+        except FileExistsError:
+            return self._error(409, 'По данному пути уже существует файл с таким именем.')
+
+        result = await self._app['DB_HANDLER'].info((form.path, form.name, form.ext))
+
+        return json_response(self._item_make(result[0]), status=201)
+
+    async def file_delete(self, request: Request) -> Coroutine[Any, Any, Response]:
+        key = self._key_get(request)
+
+        if key is None or not await self._app['DB_HANDLER'].info(key):
+            return self._error(404, 'Такого файла не существует.')
+
+        await self._file_delete(key)
+
+        return Response(status=204)
+
+    async def search(self, request: Request) -> Coroutine[Any, Any, StreamResponse]:
+        # q - полнотекстовый поиск (курсор - смещение), path - поиск по префиксу пути
+        if request.query.get('path'):
+            return await self._listing_send(request, request.query['path'].lstrip('./'))
+
+        if not request.query.get('q'):
+            return self._error(400, 'Требуется параметр q или path.')
+
+        limit, _ = self._page_params_get(request)
+        offset = self._offset_get(request)
+        found = await self._app['DB_HANDLER'].fts_search(request.query['q'], offset, limit)
+
+        if found is None:
+            return self._error(400, 'Полнотекстовый поиск недоступен либо в запросе нет слов.')
+
+        result, total, has_next = found
+
+        return json_response({
+            'items': [self._item_make(item) for item in result],
+            'total': total,
+            'next': tls.cursor_encode((str(offset + limit),)) if has_next else None
+        })
+
+class UploadApiHandler(ApiHandler):
+    # Загрузка по частям: POST /uploads -> PUT /uploads/{id}/parts/{n} (в любом порядке и параллельно) -> POST /uploads/{id}/commit.
+    # Строка в БД появляется только при завершении.
+    def __init__(self, app: Application) -> None:
+        super().__init__(app)
+
+    async def create(self, request: Request) -> Coroutine[Any, Any, Response]:
+        uploads: UploadManager = self._app['UPLOADS']
+
+        try:
+            body = await request.json()
+            form = fs.UpdateForm(body['path'], body['name'], body.get('comment') or 'У файла нет комментария.', body['ext'])
+
+            if not all((form.path, form.name, form.ext)):
+                raise exc.RequiredFormFieldError
+
+            self._form_key_normalize(form)
+
+            target = tls.FileHandler.path_constructor(self._app['SAVE_DIR'], form.path, form.name, form.ext)
+
+            if await asyncio.get_running_loop().run_in_executor(self._app['IO_POOL'], target.exists):
+                return self._error(409, 'По данному пути уже существует файл с таким именем.')
+
+            session = await uploads.create({**form.get_data(), 'size': body.get('size')})
+
+        except (ValueError, KeyError, TypeError, AttributeError, exc.RequiredFormFieldError):
+            return self._error(400, 'Требуется JSON с полями path, name, ext и size.')
+
+        except UploadError as e:
+            return self._error(e.status, str(e))
+
+        return json_response(session, status=201)
+
+    async def status(self, request: Request) -> Coroutine[Any, Any, Response]:
+        try:
+            return json_response(await self._app['UPLOADS'].status(request.match_info['id']))
+
+        except UploadError as e:
+            return self._error(e.status, str(e))
+
+    async def part_put(self, request: Request) -> Coroutine[Any, Any, Response]:
+        try:
+            number = int(request.match_info['number'])
+            written = await self._app['UPLOADS'].part_write(request.match_info['id'], number, request.content.iter_chunked(262144))
+
+        except ValueError:
+            return self._error(400, 'Неверный номер части.')
+
+        except UploadError as e:
+            return self._error(e.status, str(e))
+
+        if self._app['METRICS'] is not None:
+            self._app['METRICS'].upload_bytes.inc(written)
+
+        return Response(status=204)
+
+    async def commit(self, request: Request) -> Coroutine[Any, Any, Response]:
+        uploads: UploadManager = self._app['UPLOADS']
+        db_handler: db.DBHandler = self._app['DB_HANDLER']
+
+        try:
+            meta = await uploads.meta(request.match_info['id'])
+            target = tls.FileHandler.path_constructor(self._app['SAVE_DIR'], meta['path'], meta['name'], meta['ext'])
+            await uploads.commit(request.match_info['id'], target)
+
+        except UploadError as e:
+            return self._error(e.status, str(e))
+
+        except FileExistsError:
+            return self._error(409, 'По данному пути уже существует файл с таким именем.')
+
+        # Части приходят в произвольном порядке, поэтому хэш считается только для дедупликации - повторным чтением файла
+        digest = None
+        if self._app['BLOBS'] is not None:
+            digest = await asyncio.get_running_loop().run_in_executor(self._app['IO_POOL'], blobs.file_hash, target)
+
+        file_stat = await self._file_intern(target, digest)
+
+        await db_handler.insert(db.File(
+            name=meta['name'], ext=meta['ext'], sz=meta['size'], path=meta['path'],
+            create=datetime.now().isoformat(), comment=meta['comment'], hash=digest, 
+            mtime=file_stat.st_mtime_ns, stored_size=file_stat.st_size
+            ))
+        result = await db_handler.info((meta['path'], meta['name'], meta['ext']))
+
+        return json_response(self._item_make(result[0]), status=201)
+
+    async def abort(self, request: Request) -> Coroutine[Any, Any, Response]:
+        try:
+            await self._app['UPLOADS'].abort(request.match_info['id'])
+
+        except UploadError as e:
+            return self._error(e.status, str(e))
+
+        return Response(status=204)
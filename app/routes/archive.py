@@ -0,0 +1,195 @@
+import asyncio
+import os
+import tarfile
+import time
+import zipfile
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, AsyncIterator, Coroutine, IO, Optional
+
+from aiohttp import hdrs
+from aiohttp.web import Application, Request, StreamResponse
+
+import app.db as db
+from app.routes import tools as tls
+from app.routes.api import ApiHandler
+from app.uploads import codecs
+
+
+FORMATS = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+# Уже сжатые форматы кладутся в ZIP без сжатия (ZIP_STORED): повторное сжатие только тратит процессор
+STORED_EXTS = frozenset((
+    '7z', 'aac', 'avi', 'br', 'bz2', 'docx', 'flac', 'gif', 'gz', 'heic', 'jar', 'jpeg', 'jpg', 'lz4', 'm4a', 'mkv',
+    'mov', 'mp3', 'mp4', 'ogg', 'opus', 'pdf', 'png', 'pptx', 'rar', 'tgz', 'webm', 'webp', 'xlsx', 'xz', 'zip', 'zst'
+    ))
+READ_SIZE = 262144
+# Раньше 1980 года время в ZIP не записать
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+class ArchiveBuffer:
+    # Поток без seek для zipfile: записанное копится здесь и забирается в ответ после каждого шага,
+    # поэтому в памяти не больше одного прочитанного куска файла (и его сжатой копии)
+    def __init__(self) -> None:
+        self.__data = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self.__data += data
+
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = bytes(self.__data)
+        self.__data.clear()
+
+        return data
+
+
+class FileReader:
+    # Содержимое файла хранилища кусками; сжатый в хранилище файл (encoding) распаковывается
+    def __init__(self, path: Path, encoding: Optional[str], pool: Optional[Executor]) -> None:
+        self.__path = path
+        self.__decoder = codecs.codec_get(encoding).decoder_make() if encoding else None
+        self.__pool = pool
+        self.__fobj: Optional[IO[bytes]] = None
+
+    async def open(self) -> Coroutine[Any, Any, os.stat_result]:
+        loop = asyncio.get_running_loop()
+        self.__fobj = await loop.run_in_executor(self.__pool, open, self.__path, 'rb')
+
+        return os.fstat(self.__fobj.fileno())
+
+    def __read(self) -> Optional[bytes]:
+        data = self.__fobj.read(READ_SIZE)
+        if not data:
+            return None
+
+        return self.__decoder.decompress(data) if self.__decoder is not None else data
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            chunk = await loop.run_in_executor(self.__pool, self.__read)
+            if chunk is None:
+                break
+
+            if chunk:
+                yield chunk
+
+    async def close(self) -> Coroutine[Any, Any, None]:
+        if self.__fobj is not None:
+            await asyncio.get_running_loop().run_in_executor(self.__pool, self.__fobj.close)
+
+
+class ArchiveApiHandler(ApiHandler):
+    # GET /api/v1/archive?prefix=dir&format=zip|tar - файлы с путем, начинающимся с prefix (как в поиске), одним архивом.
+    # Архив собирается по ходу чтения списка из БД и файлов с диска: первые байты уходят клиенту сразу.
+    # Сжатие ZIP и чтение файлов идут в пуле ввода-вывода, по очереди - объект архива используется одним потоком за раз.
+    def __init__(self, app: Application) -> None:
+        super().__init__(app)
+
+    @staticmethod
+    def _arcname(item: db.Result) -> str:
+        path, name, ext = item.key
+        file_name = f'{name}.{ext}' if ext else name
+
+        return file_name if path in ('', '.') else f'{path}/{file_name}'
+
+    async def _zip_write(self, response: StreamResponse, items: AsyncIterator[db.Result]) -> Coroutine[Any, Any, None]:
+        loop = asyncio.get_running_loop()
+        pool = self._app['IO_POOL']
+        buffer = ArchiveBuffer()
+        archive = zipfile.ZipFile(buffer, 'w', allowZip64=True)
+
+        async for item in items:
+            reader = FileReader(tls.FileHandler.path_constructor(self._app['SAVE_DIR'], *item.key), item['encoding'], pool)
+
+            try:
+                file_stat = await reader.open()
+
+            except OSError:
+                continue
+
+            try:
+                info = zipfile.ZipInfo(self._arcname(item), max(time.localtime(file_stat.st_mtime)[:6], ZIP_EPOCH))
+                info.compress_type = zipfile.ZIP_STORED if item['ext'].lower() in STORED_EXTS else zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                size = item['size'] if item['encoding'] else file_stat.st_size
+                entry = archive.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT)
+
+                async for chunk in reader.chunks():
+                    await loop.run_in_executor(pool, entry.write, chunk)
+                    await response.write(buffer.take())
+
+                await loop.run_in_executor(pool, entry.close)
+                await response.write(buffer.take())
+
+            finally:
+                await reader.close()
+
+        # Центральный каталог ZIP - запись на каждый файл архива, он пишется в конце
+        await loop.run_in_executor(pool, archive.close)
+        await response.write(buffer.take())
+
+    async def _tar_write(self, response: StreamResponse, items: AsyncIterator[db.Result]) -> Coroutine[Any, Any, None]:
+        # Заголовок tar требует размер заранее: у сжатого в хранилище файла это размер содержимого из БД.
+        # Если распакованное содержимое с ним не совпало (файл изменили в обход приложения), оно обрезается
+        # или дополняется нулями, чтобы архив остался целым.
+        async for item in items:
+            reader = FileReader(tls.FileHandler.path_constructor(self._app['SAVE_DIR'], *item.key), item['encoding'], self._app['IO_POOL'])
+
+            try:
+                file_stat = await reader.open()
+
+            except OSError:
+                continue
+
+            try:
+                info = tarfile.TarInfo(self._arcname(item))
+                info.size = item['size'] if item['encoding'] else file_stat.st_size
+                info.mtime = int(file_stat.st_mtime)
+                info.mode = 0o644
+                await response.write(info.tobuf(tarfile.PAX_FORMAT))
+                left = info.size
+
+                async for chunk in reader.chunks():
+                    chunk = chunk[:left]
+                    left -= len(chunk)
+                    await response.write(chunk)
+
+                    if not left:
+                        break
+
+                padding = left + (-info.size) % tarfile.BLOCKSIZE
+                await response.write(b'\0' * padding)
+
+            finally:
+                await reader.close()
+
+        await response.write(b'\0' * tarfile.BLOCKSIZE * 2)
+
+    async def archive(self, request: Request) -> Coroutine[Any, Any, StreamResponse]:
+        archive_format = request.query.get('format', 'zip')
+        prefix = request.query.get('prefix', '').lstrip('./')
+
+        if archive_format not in FORMATS:
+            return self._error(400, f'Неверный формат архива. Допускается: {", ".join(FORMATS)}.')
+
+        db_handler: db.DBHandler = self._app['DB_HANDLER']
+        file_name = f'{prefix.replace("/", "_") or "files"}.{archive_format}'
+        response = StreamResponse(headers={
+            hdrs.CONTENT_TYPE: FORMATS[archive_format],
+            hdrs.CONTENT_DISPOSITION: f'attachment; filename="{file_name}"'
+            })
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        items = db_handler.listing_iterate(prefix or None, None, self.NDJSON_BATCH)
+        await (self._zip_write if archive_format == 'zip' else self._tar_write)(response, items)
+        await response.write_eof()
+
+        return response
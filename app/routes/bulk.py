@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Coroutine, Dict, List, Optional, Tuple
+
+from aiohttp import hdrs
+from aiohttp.web import Application, Request, StreamResponse
+from sqlalchemy.exc import IntegrityError
+
+import app.db as db
+from app.routes import tools as tls
+from app.routes.api import NDJSON_TYPE, ApiHandler
+from app.uploads import blobs
+
+
+OPERATIONS = ('delete', 'move', 'comment')
+
+
+def file_remove(path: Path, blob_store: Optional[blobs.BlobStore], blob: Optional[str]) -> None:
+    # Файла уже нет - строка все равно удаляется, как и при одиночном удалении
+    try:
+        os.remove(path)
+
+    except FileNotFoundError:
+        pass
+
+    if blob_store is not None and blob is not None:
+        blob_store.release(blob)
+
+
+def file_move(source: Path, target: Path) -> None:
+    # Через жесткую ссылку: если два файла пачки переносятся под одно имя, второй получит FileExistsError,
+    # а не заменит первый, как при rename после проверки
+    target.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        os.link(source, target)
+
+    except FileExistsError:
+        raise
+
+    # Файловая система без жестких ссылок
+    except OSError:
+        if target.exists():
+            raise FileExistsError(target)
+
+        os.rename(source, target)
+        return
+
+    os.remove(source)
+
+
+def dirs_clean(dirs: List[Path], root: Path) -> None:
+    # Опустевшие директории удаляются один раз на пачку, снизу вверх и не выше корня хранилища
+    for path in sorted(dirs, key=lambda item: len(item.parts), reverse=True):
+        while path != root and root in path.parents:
+            try:
+                path.rmdir()
+
+            except OSError:
+                break
+
+            path = path.parent
+
+
+class BulkApiHandler(ApiHandler):
+    # POST /api/v1/bulk: {"op": "delete" | "move" | "comment", "ids": [...] | "prefix": "dir", "target": "new_dir", "comment": "..."}.
+    # Файлы обрабатываются пачками: операции с файлами - параллельно в пуле ввода-вывода, изменения БД - одной пакетной
+    # командой на пачку. Ответ - NDJSON: строка на каждый файл, после каждой пачки - прогресс, в конце - итог.
+    def __init__(self, app: Application) -> None:
+        super().__init__(app)
+
+    @staticmethod
+    def _line(value: Dict[str, Any]) -> bytes:
+        return (json.dumps(value, ensure_ascii=False) + '\n').encode('utf-8')
+
+    @staticmethod
+    def _item_result(item_id: str, error: Optional[str] = None) -> Dict[str, Any]:
+        return {'id': item_id, 'status': 'ok'} if error is None else {'id': item_id, 'status': 'error', 'error': error}
+
+    def _params_check(self, params: Any) -> Optional[str]:
+        if not isinstance(params, dict) or params.get('op') not in OPERATIONS:
+            return f'Требуется "op": {", ".join(OPERATIONS)}.'
+
+        if isinstance(params.get('ids'), list) == ('prefix' in params):
+            return 'Требуется либо список "ids", либо "prefix".'
+
+        # "/" и "./" после нормализации - корень хранилища, то есть все файлы
+        if 'prefix' in params and (not isinstance(params['prefix'], str) or tls.FileHandler.path_normalize(params['prefix']) == '.'):
+            return '"prefix" должен быть путем директории внутри хранилища.'
+
+        if params['op'] == 'move':
+            target = params.get('target')
+
+            if not isinstance(target, str) or not target.strip('./'):
+                return 'Для переноса требуется "target" - путь директории.'
+
+            # Перенесенные строки снова попали бы под выборку по префиксу
+            if 'prefix' in params:
+                prefix, target = tls.FileHandler.path_normalize(params['prefix']), tls.FileHandler.path_normalize(target)
+
+                if target == prefix or target.startswith(f'{prefix}/'):
+                    return '"target" не может находиться внутри "prefix".'
+
+        if params['op'] == 'comment' and not isinstance(params.get('comment'), str):
+            return 'Для изменения комментария требуется "comment".'
+
+        return None
+
+    async def _chunks_select(self, params: Dict[str, Any], chunk_size: int) -> AsyncIterator[Tuple[List[db.Result], List[Any]]]:
+        # Пачки строк выборки и id, которых нет в БД (или неверные). prefix - директория: "dir" выбирает
+        # "dir" и "dir/sub", но не "dir2"
+        db_handler: db.DBHandler = self._app['DB_HANDLER']
+
+        if 'prefix' in params:
+            chunk = []
+            async for item in db_handler.listing_iterate(params['prefix'], None, chunk_size, subtree=True):
+                chunk.append(item)
+
+                if len(chunk) >= chunk_size:
+                    yield chunk, []
+                    chunk = []
+
+            if chunk:
+                yield chunk, []
+
+            return
+
+        for i in range(0, len(params['ids']), chunk_size):
+            ids = params['ids'][i:i + chunk_size]
+            keys = [tls.cursor_decode(item) if isinstance(item, str) else None for item in ids]
+            found = await db_handler.info_many(list({key for key in keys if key is not None}))
+            found_keys = {item.key for item in found}
+
+            yield found, [item for item, key in zip(ids, keys) if key not in found_keys]
+
+    def _target_path(self, params: Dict[str, Any], key: db.PageKey) -> str:
+        # Выборка по префиксу: директория prefix заменяется на target, вложенность сохраняется; список id - все в target
+        path, _, _ = key
+        target = tls.FileHandler.path_normalize(params['target'])
+
+        if 'prefix' in params:
+            return f'{target}{path[len(params["prefix"]):]}'
+
+        return target
+
+    async def _moves_undo(self, moves: List[Tuple[Path, Path]]) -> Coroutine[Any, Any, None]:
+        # Файлы, строки которых не удалось изменить, возвращаются на место; то, что вернуть не удалось, исправит сверка
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self._app['IO_POOL'], file_move, target, source) for source, target in moves
+            ], return_exceptions=True)
+
+        for (source, target), result in zip(moves, results):
+            if isinstance(result, Exception):
+                print(f'Не удалось вернуть файл {target} на место {source}: {result!r}')
+
+        await loop.run_in_executor(self._app['IO_POOL'], dirs_clean, list({target.parent for _, target in moves}), self._app['SAVE_DIR'])
+
+    async def _chunk_apply(self, params: Dict[str, Any], rows: List[db.Result]) -> Coroutine[Any, Any, Dict[db.PageKey, Optional[str]]]:
+        loop = asyncio.get_running_loop()
+        db_handler: db.DBHandler = self._app['DB_HANDLER']
+        blob_store: Optional[blobs.BlobStore] = self._app['BLOBS']
+        io_pool = self._app['IO_POOL']
+        save_dir: Path = self._app['SAVE_DIR']
+        now = datetime.now().isoformat()
+        keys = [row.key for row in rows]
+        paths = {key: tls.FileHandler.path_constructor(save_dir, *key) for key in keys}
+        errors: Dict[db.PageKey, Optional[str]] = {key: None for key in keys}
+
+        if params['op'] == 'comment':
+            await db_handler.rows_update([(key, {'comment': params['comment'], 'update': now}) for key in keys])
+            return errors
+
+        if params['op'] == 'delete':
+            blob_names = [blobs.blob_name(row['hash'], row['encoding']) if row['hash'] else None for row in rows]
+            # Строки удаляются до файлов: удаленный файл без строки исправит сверка, а строка без файла была бы видна
+            await db_handler.rows_delete(keys)
+            await asyncio.gather(*[
+                loop.run_in_executor(io_pool, file_remove, paths[key], blob_store, blob) for key, blob in zip(keys, blob_names)
+                ])
+            await loop.run_in_executor(io_pool, dirs_clean, list({path.parent for path in paths.values()}), save_dir)
+            return errors
+
+        targets = {key: (self._target_path(params, key), key[1], key[2]) for key in keys}
+        moved = await asyncio.gather(*[
+            loop.run_in_executor(io_pool, file_move, paths[key], tls.FileHandler.path_constructor(save_dir, *targets[key]))
+            for key in keys
+            ], return_exceptions=True)
+
+        for key, result in zip(keys, moved):
+            if isinstance(result, FileExistsError):
+                errors[key] = 'Файл с указанными параметрами уже существует.'
+
+            elif isinstance(result, OSError):
+                errors[key] = f'Во время переноса файла произошла ошибка: {result.strerror or result!r}.'
+
+        changes = [(key, {'path': targets[key][0], 'update': now}) for key in keys if errors[key] is None]
+        moves = {key: (paths[key], tls.FileHandler.path_constructor(save_dir, *targets[key])) for key, _ in changes}
+
+        try:
+            await db_handler.rows_update(changes)
+
+        # Строка с новым ключом уже есть в БД: пачка повторяется по одной строке, файл неудачной возвращается на место
+        except IntegrityError:
+            for i, (key, values) in enumerate(changes):
+                try:
+                    await db_handler.rows_update([(key, values)])
+
+                except IntegrityError:
+                    errors[key] = 'Файл с указанными параметрами уже существует.'
+                    await self._moves_undo([moves[key]])
+
+                except Exception as e:
+                    rest = [key for key, _ in changes[i:]]
+                    errors.update({key: f'Ошибка обработки: {e!r}' for key in rest})
+                    await self._moves_undo([moves[key] for key in rest])
+                    break
+
+        # Любая другая ошибка БД: иначе перенесенные файлы разошлись бы со строками
+        except Exception as e:
+            errors.update({key: f'Ошибка обработки: {e!r}' for key, _ in changes})
+            await self._moves_undo(list(moves.values()))
+
+        await loop.run_in_executor(io_pool, dirs_clean, list({paths[key].parent for key in keys if errors[key] is None}), save_dir)
+
+        return errors
+
+    async def bulk(self, request: Request) -> Coroutine[Any, Any, StreamResponse]:
+        try:
+            params = await request.json()
+
+        except ValueError:
+            return self._error(400, 'Тело запроса должно быть JSON.')
+
+        error_message = self._params_check(params)
+
+        if error_message is not None:
+            return self._error(400, error_message)
+
+        if 'prefix' in params:
+            params['prefix'] = tls.FileHandler.path_normalize(params['prefix'])
+
+        response = StreamResponse(headers={hdrs.CONTENT_TYPE: NDJSON_TYPE})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        done, failed = 0, 0
+
+        async for rows, missing in self._chunks_select(params, int(self._app['BULK_CHUNK_SIZE'])):
+            results = [self._item_result(item_id, 'Такого файла не существует.') for item_id in missing]
+
+            # Пачка доводится до конца и при отключении клиента: отмена обработчика между операциями с файлами
+            # и записью в БД оставила бы их несогласованными
+            try:
+                errors = await asyncio.shield(self._chunk_apply(params, rows))
+
+            # Пачка не применена целиком (например, ошибка БД) - остальные пачки продолжают обрабатываться
+            except Exception as e:
+                errors = {row.key: f'Ошибка обработки: {e!r}' for row in rows}
+
+            results += [self._item_result(tls.cursor_encode(key), error) for key, error in errors.items()]
+            failed += sum(result['status'] == 'error' for result in results)
+            done += len(results)
+
+            await response.write(b''.join(self._line(result) for result in results) + self._line({'progress': {'done': done, 'failed': failed}}))
+
+        await response.write(self._line({'summary': {'op': params['op'], 'done': done, 'failed': failed}}))
+        await response.write_eof()
+
+        return response
@@ -1,21 +1,36 @@
 import asyncio
+import os
 import sqlalchemy as sql
 from typing import Any, Coroutine, List, Optional, Tuple, TypeVar, Dict
 from aiohttp import BodyPartReader
-from aiohttp.web import Application, Request, Response, HTTPFound
+from aiohttp import hdrs
+from aiohttp.web import Application, Request, Response, HTTPBadRequest, HTTPFound, StreamResponse
 from aiohttp_jinja2 import render_template
 from datetime import datetime
 
 import app.db as db
+import app.metrics as mtr
 from app.routes import exceptipon as exc
 from app.routes import tools as tls
 from app.routes import forms as fs
+from app.uploads import blobs, codecs
 
 F = TypeVar('F', bound=fs.SearchForm)
 
 class BaseHandler:
     def __init__(self, app: Application) -> None:
         self._app = app
+        self.__url_bases: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+    
+    def _url_bases_get(self, *endpoint_names: str) -> Tuple[str, ...]:
+        # Маршруты не меняются после запуска приложения, поэтому их пути вычисляются один раз
+        bases = self.__url_bases.get(endpoint_names)
+        
+        if bases is None:
+            bases = tuple(str(self._app.router[name].url_for()) for name in endpoint_names)
+            self.__url_bases[endpoint_names] = bases
+        
+        return bases
     
     def _redirect_maker(self, endpoint_name: str, query_params: Optional[Dict[str, str]] = None) -> HTTPFound:
         url = self._app.router[endpoint_name].url_for()
@@ -31,6 +46,89 @@ class BaseHandler:
         
         return await factory.create()
     
+    async def _file_upload(self, request: Request) -> Coroutine[Any, Any, fs.InsertForm]:
+        # Общая часть загрузки для HTML-страницы и API: файл пишется в хранилище, затем строка в БД
+        try:
+            form, field = await self._form_data_maker(request, fs.InsertForm)
+        
+        # В форме нет части полей (path, name, ext, comment)
+        except TypeError:
+            raise exc.RequiredFormFieldError
+        
+        # Без части file_choose (или с вложенной multipart вместо файла) загружать нечего - это ошибка клиента
+        if not isinstance(field, BodyPartReader):
+            raise HTTPBadRequest(text='В форме нет файла (поле file_choose).')
+        
+        self._form_key_normalize(form)
+        handle_path = tls.FileHandler.path_constructor(self._app['SAVE_DIR'], **form.get_spec_data(('name', 'path', 'ext')))
+        file_handler = tls.FileHandler(
+            handle_path, buffer_size=self._app['UPLOAD_BUFFER_SIZE'], io_pool=self._app['IO_POOL'], metrics=self._app['METRICS'])
+        compression: Optional[codecs.CompressionPolicy] = self._app['COMPRESSION']
+        codec = compression.codec_select(form.ext) if compression is not None else None
+        encoding = codec.name if codec is not None else None
+        hasher = blobs.hasher_make()
+        form.sz, _ = await file_handler.file_uploader(
+            field, request.content_length, hasher, codec.encoder_make() if codec is not None else None)
+        form.create = datetime.now().isoformat()
+        digest = hasher.hexdigest()
+        file_stat = await self._file_intern(handle_path, digest, encoding)
+        
+        db_handler: db.DBHandler = self._app['DB_HANDLER']
+        await db_handler.insert(db.File(
+            **form.get_data(), hash=digest, mtime=file_stat.st_mtime_ns, stored_size=file_stat.st_size, encoding=encoding))
+        
+        return form
+    
+    async def _file_intern(self, handle_path: tls.T, digest: Optional[str], encoding: Optional[str] = None) -> Coroutine[Any, Any, os.stat_result]:
+        # В режиме дедупликации файл с уже известным содержимым заменяется ссылкой на блоб.
+        # Возвращает stat файла - по mtime_ns сверка узнает, что содержимое с тех пор не менялось.
+        blob_store: Optional[blobs.BlobStore] = self._app['BLOBS']
+        
+        if blob_store is not None and digest is not None:
+            await blob_store.intern_async(handle_path, blobs.blob_name(digest, encoding))
+        
+        return await asyncio.get_running_loop().run_in_executor(self._app['IO_POOL'], os.stat, handle_path)
+    
+    async def _file_delete(self, key: db.PageKey) -> Coroutine[Any, Any, None]:
+        path, name, ext = key
+        handle_path = tls.FileHandler.path_constructor(self._app['SAVE_DIR'], path, name, ext)
+        file_handler = tls.FileHandler(handle_path)
+        db_handler: db.DBHandler = self._app['DB_HANDLER']
+        blob_store: Optional[blobs.BlobStore] = self._app['BLOBS']
+        sql_query = sql.delete(db.File).where(db.File.name == name, db.File.path == path, db.File.ext == ext)
+        result = await db_handler.info(key) if blob_store is not None else None
+        
+        await asyncio.gather(file_handler.file_deleter(), db_handler.execute(sql_query, True, keys=[key]))
+        
+        # Последняя ссылка на содержимое - блоб удаляется сразу, не дожидаясь gc
+        if result and result[0]['hash']:
+            await blob_store.release_async(blobs.blob_name(result[0]['hash'], result[0]['encoding']))
+    
+    async def _file_download(self, request: Request, key: db.PageKey) -> Coroutine[Any, Any, StreamResponse]:
+        # Хэш содержимого - сильный ETag, пока файл не менялся после его подсчета.
+        # Сжатый файл отдается как есть, если клиент принимает его Content-Encoding, иначе распаковывается на лету.
+        handle_path = tls.FileHandler.path_constructor(self._app['SAVE_DIR'], *key)
+        result = await self._app['DB_HANDLER'].info(key)
+        row = result[0] if result else None
+        etag, etag_stat, encoding, decoder, size = None, None, None, None, None
+        
+        if row is not None and row['mtime_ns'] is not None:
+            etag, etag_stat = row['hash'], (row['stored_size'] if row['stored_size'] is not None else row['size'], row['mtime_ns'])
+        
+        if row is not None and row['encoding']:
+            encoding = row['encoding']
+            
+            if codecs.encoding_accepted(request.headers.get(hdrs.ACCEPT_ENCODING, ''), encoding):
+                # У разных кодировок одного содержимого должны быть разные ETag
+                etag = f'{etag}-{encoding}' if etag is not None else None
+            
+            else:
+                decoder = codecs.codec_get(encoding).decoder_make()
+                size = row['size'] if etag_stat is not None else None
+        
+        return await tls.FileHandler(handle_path, metrics=self._app['METRICS']).file_downloader(
+            etag=etag, etag_stat=etag_stat, encoding=encoding, decoder=decoder, size=size)
+    
     def _page_context_maker(
         self, 
         request: Request, 
@@ -61,25 +159,117 @@ class BaseHandler:
         ) -> List[db.Result]:
         
         if result:
-            for item in result:
-                item.make_url(
-                    delete_endpoint_name, 
-                    update_endpoint_name, 
-                    download_endpoint_name, 
-                    self._app, 
-                    {key: item.value[key] for key in link_keys}
-                    )
+            with mtr.timer_get(self._app['METRICS'], 'stage_duration', 'links'):
+                bases = self._url_bases_get(delete_endpoint_name, update_endpoint_name, download_endpoint_name)
+                
+                for item in result:
+                    item.make_url(*bases, link_keys)
         
         return result
+    
+    def _page_render(self, request: Request, context: tls.PageContext) -> Response:
+        with mtr.timer_get(self._app['METRICS'], 'stage_duration', 'render'):
+            return render_template('index.jinja2', request=request, context=context.get_context())
+    
+    def _form_key_normalize(self, form: fs.InfoForm) -> fs.InfoForm:
+        # Ключ файла приводится к тому виду, в котором его пишет в БД сверка с хранилищем
+        form.path = tls.FileHandler.path_normalize(form.path)
+        form.name = form.name.lstrip('/')
+        form.ext = form.ext.lstrip('./\\')
+        
+        return form
+    
+    def _page_params_get(self, request: Request) -> Tuple[int, Optional[db.PageKey]]:
+        try:
+            limit = int(request.query.get('limit', self._app['PAGE_SIZE']))
+        
+        except ValueError:
+            limit = self._app['PAGE_SIZE']
+        
+        limit = min(max(limit, 1), self._app['PAGE_SIZE_MAX'])
+        after = tls.cursor_decode(request.query.get('after'))
+        
+        return limit, after
+    
+    def _offset_get(self, request: Request) -> int:
+        # Курсор страниц, упорядоченных по релевантности - смещение
+        cursor = tls.cursor_decode(request.query.get('after'), 1)
+        
+        return int(cursor[0]) if cursor is not None and cursor[0].isdigit() else 0
+    
+    async def _page_fill(
+        self, 
+        request: Request, 
+        context: tls.PageContext, 
+        prefix: Optional[str], 
+        endpoint_name: str, 
+        query_params: Optional[Dict[str, str]] = None
+        ) -> None:
+        
+        db_handler: db.DBHandler = self._app['DB_HANDLER']
+        limit, after = self._page_params_get(request)
+        result, next_key, context.total = await db_handler.listing(prefix, after, limit)
+        context.result = self._file_menu_link_maker(result, 'delete', 'g_update', 'download', ('name', 'ext', 'path', 'comment'))
+        self._page_links_make(context, endpoint_name, query_params, limit, after is not None, next_key)
+    
+    def _page_links_make(
+        self, 
+        context: tls.PageContext, 
+        endpoint_name: str, 
+        query_params: Optional[Dict[str, str]], 
+        limit: int, 
+        is_first: bool, 
+        next_key: Optional[Tuple[str, ...]]
+        ) -> None:
+        
+        page_params = {**(query_params or {}), 'limit': limit}
+        url = self._app.router[endpoint_name].url_for()
+        
+        if is_first:
+            context.first_url = url.with_query(page_params)
+        
+        if next_key is not None:
+            context.next_url = url.with_query({**page_params, 'after': tls.cursor_encode(next_key)})
 
 
 class SearchHanler(BaseHandler):
     def __init__(self, app: Application) -> None:
         super().__init__(app)
     
+    async def _search_fill(self, request: Request, context: tls.PageContext, form: fs.SearchForm) -> None:
+        context.form_data = form
+        await self._page_fill(request, context, form.path.lstrip('./'), 'g_search', form.get_data())
+        
+        if context.result:
+            context.archive_url = self._app.router['api_archive'].url_for().with_query({'prefix': form.path})
+    
+    async def _fts_fill(self, request: Request, context: tls.PageContext, text: str) -> None:
+        # Результаты упорядочены по релевантности, поэтому курсор здесь - смещение
+        db_handler: db.DBHandler = self._app['DB_HANDLER']
+        limit, _ = self._page_params_get(request)
+        offset = self._offset_get(request)
+        found = await db_handler.fts_search(text, offset, limit)
+        
+        if found is None:
+            error_message = 'Полнотекстовый поиск недоступен либо в запросе нет слов.'
+            raise self._redirect_maker('g_search', {'error': error_message})
+        
+        result, context.total, has_next = found
+        context.result = self._file_menu_link_maker(result, 'delete', 'g_update', 'download', ('name', 'ext', 'path', 'comment'))
+        self._page_links_make(context, 'g_search', {'q': text}, limit, offset > 0, (str(offset + limit),) if has_next else None)
+    
     async def get(self, request: Request) -> Coroutine[Any, Any, Response]:
         context = self._page_context_maker(request, 'search', 'Search', 'p_search')
-        response = render_template('index.jinja2', request=request, context=context.get_context())
+        
+        # Полнотекстовый поиск по имени и комментарию - параметр q
+        if request.query.get('q'):
+            await self._fts_fill(request, context, request.query['q'])
+        
+        # Следующие страницы результатов поиска запрашиваются через GET c параметром path
+        elif request.query.get('path'):
+            await self._search_fill(request, context, fs.SearchForm(request.query['path']))
+        
+        response = self._page_render(request, context)
         
         return response
     
@@ -94,12 +284,9 @@ class SearchHanler(BaseHandler):
             raise self._redirect_maker('g_search', {'error': error_message})
         
         else:
-            db_handler: db.DBHandler = self._app['DB_HANDLER']
-            sql_query = sql.select(db.File).where(db.File.path.like(f'{form.path}%'))
-            result = await db_handler.execute(sql_query)
-            context.result = self._file_menu_link_maker(result, 'delete', 'g_update', 'download', ('name', 'ext', 'path', 'comment'))
+            await self._search_fill(request, context, form)
         
-        response = render_template('index.jinja2', request=request, context=context.get_context())
+        response = self._page_render(request, context)
         
         return response
 
@@ -109,12 +296,9 @@ class IndexHandler(BaseHandler):
     
     async def get(self, request: Request) -> Coroutine[Any, Any, Response]:
         context = self._page_context_maker(request, 'index', 'Search')
-        db_handler: db.DBHandler = self._app['DB_HANDLER']
-        sql_query = sql.select(db.File)
-        result = await db_handler.execute(sql_query)
-        context.result = self._file_menu_link_maker(result, 'delete', 'g_update', 'download', ('name', 'ext', 'path', 'comment'))
+        await self._page_fill(request, context, None, 'index')
         
-        response = render_template('index.jinja2', request=request, context=context.get_context())
+        response = self._page_render(request, context)
         
         return response
 
@@ -125,7 +309,7 @@ class InfoHandler(BaseHandler):
     
     async def get(self, request: Request) -> Coroutine[Any, Any, Response]:
         context = self._page_context_maker(request, 'info', 'info', 'p_info')
-        response = render_template('index.jinja2', request=request, context=context.get_context())
+        response = self._page_render(request, context)
         
         return response
     
@@ -134,6 +318,7 @@ class InfoHandler(BaseHandler):
         
         try:
             form, _ = await self._form_data_maker(request, fs.InfoForm)
+            self._form_key_normalize(form)
         
         except exc.RequiredFormFieldError as e:
             error_message = str(e)
@@ -141,11 +326,10 @@ class InfoHandler(BaseHandler):
         
         else:
             db_handler: db.DBHandler = self._app['DB_HANDLER']
-            sql_query = sql.select(db.File).where(db.File.name == form.name, db.File.path == form.path, db.File.ext == form.ext)
-            result = await db_handler.execute(sql_query)
+            result = await db_handler.info((form.path, form.name, form.ext))
             context.result = self._file_menu_link_maker(result, 'delete', 'g_update', 'download', ('name', 'ext', 'path', 'comment'))
         
-        response = render_template('index.jinja2', request=request, context=context.get_context())
+        response = self._page_render(request, context)
         
         return response
 
@@ -155,19 +339,18 @@ class DownloadHandler(BaseHandler):
         super().__init__(app)
         
     async def get(self, request: Request) -> Coroutine[Any, Any, Response]:
-        handle_path = tls.FileHandler.path_constructor(
-            self._app['SAVE_DIR'], **tls.collector_query_params(request, ['path', 'name', 'ext'], None))
+        key = tuple(tls.collector_query_params(request, ['path', 'name', 'ext'], None).values())
+        handle_path = tls.FileHandler.path_constructor(self._app['SAVE_DIR'], *key)
         
         try:
-            file_handler = tls.FileHandler(handle_path)
-            body = await file_handler.file_downloader()
+            response = await self._file_download(request, key)
         
         # В идеале, если БД и хранилище синхронизированы такого не может случиться, но тут может =)
         except FileNotFoundError:
             error_message = 'Такого файла не существует.'
             raise self._redirect_maker('index', {'error': error_message})
         
-        response = Response(body=body, status=200, reason='OK', headers={'content-disposition': f'inline; filename="{handle_path.name}"'})
+        response.headers['content-disposition'] = f'inline; filename="{handle_path.name}"'
         
         return response
 
@@ -177,15 +360,7 @@ class DeleteHandler(BaseHandler):
         super().__init__(app)
     
     async def get(self, request: Request) -> Coroutine[Any, Any, Response]:
-        query_params = tls.collector_query_params(request, ['path', 'name', 'ext'], None)
-        handle_path = tls.FileHandler.path_constructor(request.app['SAVE_DIR'], **tls.collector_query_params(request, ['path', 'name', 'ext'], None))
-        file_handler = tls.FileHandler(handle_path)
-        db_handler: db.DBHandler = self._app['DB_HANDLER']
-        sql_query = sql.delete(db.File).where(
-            db.File.name == request.query.get('name'), db.File.path == request.query.get('path'), db.File.ext == request.query.get('ext')
-            )
-    
-        await asyncio.gather(file_handler.file_deleter(), db_handler.execute(sql_query, True))
+        await self._file_delete((request.query.get('path'), request.query.get('name'), request.query.get('ext')))
     
         raise self._redirect_maker('index')
 
@@ -195,7 +370,7 @@ class InsertHandler(BaseHandler):
     
     async def get(self, request: Request) -> Coroutine[Any, Any, Response]:
         context = self._page_context_maker(request, 'insert', 'Insert', 'p_insert')
-        response = render_template('index.jinja2', request=request, context=context.get_context())
+        response = self._page_render(request, context)
         
         return response
 
@@ -203,11 +378,7 @@ class InsertHandler(BaseHandler):
         context = self._page_context_maker(request, 'insert', 'Insert', 'p_insert')
         
         try:
-            form, field = await self._form_data_maker(request, fs.InsertForm)
-            handle_path = tls.FileHandler.path_constructor(self._app['SAVE_DIR'], **form.get_spec_data(('name', 'path', 'ext')))
-            file_handler = tls.FileHandler(handle_path)
-            form.sz = await file_handler.file_uploader(field)
-            form.create = datetime.now().isoformat()
+            await self._file_upload(request)
             
         except exc.RequiredFormFieldError as e:
             error_message = str(e)
@@ -218,8 +389,6 @@ class InsertHandler(BaseHandler):
             raise self._redirect_maker('g_insert', {'error': error_message})
         
         else:
-            db_handler: db.DBHandler = self._app['DB_HANDLER']
-            await db_handler.insert(db.File(**form.get_data()))
             raise self._redirect_maker('index')
 
 class UpdateHandler(BaseHandler):
@@ -230,14 +399,17 @@ class UpdateHandler(BaseHandler):
         context = self._page_context_maker(request, 'update', 'Update', 'p_update', request.query)
         context.form_data = fs.UpdateForm(**tls.collector_query_params(request, ['path', 'name', 'ext', 'comment'], None))
         
-        response = render_template('index.jinja2', request=request, context=context.get_context())
+        response = self._page_render(request, context)
     
         return response
 
     def _file_meta_difference_check(self, request: Request, form: fs.UpdateForm) -> bool:
         for key, value in form.get_data().items():
                 if key == 'name' or key == 'path':
-                    if value != request.query.get(key):
+                    current = request.query.get(key, '')
+                    current = tls.FileHandler.path_normalize(current) if key == 'path' else current.lstrip('/')
+                    
+                    if value != current:
                         return False
                         
         return True
@@ -251,7 +423,8 @@ class UpdateHandler(BaseHandler):
         except exc.RequiredFormFieldError as e:
             error_message = str(e)
             raise self._redirect_maker('g_update', {'error': error_message, **request.query})
-
+        
+        self._form_key_normalize(form)
         db_handler: db.DBHandler = self._app['DB_HANDLER']
         
         if not self._file_meta_difference_check(request, form):
@@ -284,5 +457,6 @@ class SyncHandler(BaseHandler):
         super().__init__(app)
     
     async def get(self, request: Request) -> Coroutine[Any, Any, Any]:
-        await self._app['DB_HANDLER'].normalize(self._app['SAVE_DIR'], self._app['SAVE_DIR'])
+        # Сверка идет фоновой задачей (см. app.jobs), страница не ждет ее окончания
+        await self._app['JOBS'].submit('sync')
         raise self._redirect_maker('index')
\ No newline at end of file
@@ -0,0 +1,61 @@
+from typing import Any, Coroutine, Dict
+
+from aiohttp import hdrs
+from aiohttp.web import Application, Request, Response, json_response
+
+from app.jobs import JobManager
+from app.routes.api import ApiHandler
+
+
+class JobApiHandler(ApiHandler):
+    # Долгие операции (сверка, хэши, индексы) идут фоновыми задачами: запрос сразу получает 202 и задачу,
+    # за которой следят через GET /api/v1/jobs/{id}. Повторный запуск идущей задачи возвращает ее же.
+    def __init__(self, app: Application) -> None:
+        super().__init__(app)
+
+    def _job_response(self, job: Dict[str, Any]) -> Response:
+        location = self._app.router['api_job'].url_for(id=job['id'])
+
+        return json_response(job, status=202, headers={hdrs.LOCATION: str(location)})
+
+    async def sync(self, request: Request) -> Coroutine[Any, Any, Response]:
+        job, _ = await self._app['JOBS'].submit('sync')
+
+        return self._job_response(job)
+
+    async def create(self, request: Request) -> Coroutine[Any, Any, Response]:
+        jobs: JobManager = self._app['JOBS']
+
+        try:
+            kind = (await request.json())['kind']
+
+        except (ValueError, KeyError, TypeError):
+            return self._error(400, f'Требуется JSON с "kind": {", ".join(jobs.kinds)}.')
+
+        if kind not in jobs.kinds:
+            return self._error(400, f'Неизвестный вид задачи. Допускается: {", ".join(jobs.kinds)}.')
+
+        job, _ = await jobs.submit(kind)
+
+        return self._job_response(job)
+
+    async def listing(self, request: Request) -> Coroutine[Any, Any, Response]:
+        limit, _ = self._page_params_get(request)
+
+        return json_response({'items': await self._app['JOBS'].listing(limit)})
+
+    async def get(self, request: Request) -> Coroutine[Any, Any, Response]:
+        job = await self._app['JOBS'].get(request.match_info['id'])
+
+        if job is None:
+            return self._error(404, 'Задача не найдена.')
+
+        return json_response(job)
+
+    async def cancel(self, request: Request) -> Coroutine[Any, Any, Response]:
+        job = await self._app['JOBS'].cancel(request.match_info['id'])
+
+        if job is None:
+            return self._error(404, 'Задача не найдена.')
+
+        return json_response(job)
@@ -0,0 +1,64 @@
+import time
+from typing import Any, Awaitable, Callable, Coroutine
+
+from aiohttp.web import Application, HTTPException, Request, Response, StreamResponse, json_response, middleware
+
+import app.metrics as mtr
+from app.jobs import ACTIVE, JobManager
+from app.routes.handlers import BaseHandler
+
+
+Handler = Callable[[Request], Awaitable[StreamResponse]]
+
+
+@middleware
+async def metrics_middleware(request: Request, handler: Handler) -> Coroutine[Any, Any, StreamResponse]:
+    # Маршрут в метках - шаблон пути ("/api/v1/files/{id}"), а не сам путь: кол-во рядов не растет от запросов.
+    # Время - до возврата ответа из обработчика: тело файла отдается уже после (см. download_bytes_total).
+    metrics: mtr.Metrics = request.app['METRICS']
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    status = 500
+    started = time.perf_counter()
+    metrics.in_flight.inc()
+
+    try:
+        response = await handler(request)
+        status = response.status
+
+        return response
+
+    except HTTPException as e:
+        status = e.status
+        raise
+
+    finally:
+        metrics.in_flight.dec()
+        metrics.request_duration.observe(time.perf_counter() - started, request.method, route)
+        metrics.requests.inc(1, request.method, route, str(status))
+
+
+class MetricsHandler(BaseHandler):
+    def __init__(self, app: Application) -> None:
+        super().__init__(app)
+
+    async def get(self, request: Request) -> Coroutine[Any, Any, Response]:
+        metrics: mtr.Metrics = self._app['METRICS']
+
+        return Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': mtr.CONTENT_TYPE})
+
+
+class ReadinessHandler(BaseHandler):
+    # GET /ready: раз ответ есть, приложение обслуживает запросы. reconcile - сверка при старте (fast_start),
+    # а если ее не было в этом процессе - последняя сверка. С reconciled=1 ответ 503, пока эта сверка идет.
+    def __init__(self, app: Application) -> None:
+        super().__init__(app)
+
+    async def get(self, request: Request) -> Coroutine[Any, Any, Response]:
+        jobs: JobManager = self._app['JOBS']
+        startup_job = jobs.startup_job
+        job = await jobs.get(startup_job) if startup_job is not None else await jobs.last('sync')
+        reconciled = job is None or job['status'] not in ACTIVE
+        status = 503 if request.query.get('reconciled') and not reconciled else 200
+
+        return json_response({'status': 'ready' if reconciled else 'reconciling', 'reconcile': job}, status=status)
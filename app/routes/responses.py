@@ -0,0 +1,255 @@
+import asyncio
+import mimetypes
+import os
+import re
+from aiohttp import hdrs
+from aiohttp.abc import AbstractStreamWriter
+from aiohttp.helpers import ETAG_ANY, ETag
+from aiohttp.web import BaseRequest, FileResponse, StreamResponse
+from pathlib import Path
+from typing import Any, Coroutine, IO, Optional, Tuple
+
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def etag_weak_match(etag_value: str, etags: Tuple[ETag, ...]) -> bool:
+    # Слабое сравнение для If-None-Match (RFC 9110, 13.1.2): W/"x" совпадает с "x"
+    if len(etags) == 1 and etags[0].value == ETAG_ANY:
+        return True
+
+    return any(etag.value == etag_value for etag in etags)
+
+
+class FileStreamResponse(FileResponse):
+    # FileResponse aiohttp, у которого свои только выбор ETag (хэш содержимого из БД), If-Range по ETag,
+    # слабое сравнение для If-None-Match и счетчик отданных байт. Соседний файл ".gz" не подставляется:
+    # в хранилище это другой файл пользователя. Отправка и ответы 304 и 412 - из FileResponse.
+    def __init__(
+        self,
+        path: Path,
+        chunk_size: int = 262144,
+        etag: Optional[str] = None,
+        etag_stat: Optional[Tuple[int, int]] = None,
+        status: int = 200,
+        reason: Optional[str] = None,
+        sent_counter: Optional[Any] = None
+        ) -> None:
+
+        # etag_stat - (размер, mtime_ns) файла, для которого верен etag: если файл с тех пор изменился,
+        # ETag строится по его текущим метаданным. sent_counter - счетчик отданных байт (см. app.metrics).
+        super().__init__(path, chunk_size, status=status, reason=reason)
+        self._etag_value = etag
+        self._etag_stat = etag_stat
+        self._sent_counter = sent_counter
+
+    @staticmethod
+    def _range_parse(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+        # None - диапазон не запрошен (или запрошено несколько диапазонов, их игнорируем и отдаем файл целиком)
+        # (0, 0) - диапазон невыполним
+        if header is None:
+            return None
+
+        match = RANGE_PATTERN.match(header.strip())
+        if match is None:
+            return None
+
+        start, end = match.groups()
+        if not start and not end:
+            return None
+
+        if not start:
+            count = min(int(end), size)
+            return (size - count, count) if count else (0, 0)
+
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+        if start >= size or start > end:
+            return (0, 0)
+
+        return start, end - start + 1
+
+    def _if_range_check(self, request: BaseRequest, etag_value: str, st: os.stat_result) -> bool:
+        if_range = request.headers.get(hdrs.IF_RANGE)
+        if if_range is None:
+            return True
+
+        if if_range.startswith(('"', 'W/')):
+            return if_range == f'"{etag_value}"'
+
+        since = request.if_range
+
+        return since is not None and int(st.st_mtime) <= since.timestamp()
+
+    async def _sendfile_fallback(self, writer: AbstractStreamWriter, fobj: IO[Any], offset: int, count: int) -> AbstractStreamWriter:
+        # В aiohttp 3.8 первое чтение берет chunk_size байт независимо от count, и короткий диапазон
+        # без sendfile (TLS) отдавался бы с лишними байтами
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, fobj.seek, offset)
+
+        while count > 0:
+            chunk = await loop.run_in_executor(None, fobj.read, min(self._chunk_size, count))
+            if not chunk:
+                break
+
+            count -= len(chunk)
+            await writer.write(chunk)
+
+        await writer.drain()
+
+        return writer
+
+    async def _sendfile(self, request: BaseRequest, fobj: IO[Any], offset: int, count: int) -> AbstractStreamWriter:
+        writer = await super()._sendfile(request, fobj, offset, count)
+
+        if self._sent_counter is not None:
+            self._sent_counter.inc(count)
+
+        return writer
+
+    async def prepare(self, request: BaseRequest) -> Coroutine[Any, Any, Optional[AbstractStreamWriter]]:
+        loop = asyncio.get_running_loop()
+        fobj = await loop.run_in_executor(None, self._path.open, 'rb')
+
+        try:
+            st = os.fstat(fobj.fileno())
+            etag_fresh = self._etag_stat is None or self._etag_stat == (st.st_size, st.st_mtime_ns)
+            etag_value = self._etag_value if self._etag_value and etag_fresh else f'{st.st_mtime_ns:x}-{st.st_size:x}'
+            self.headers[hdrs.ACCEPT_RANGES] = 'bytes'
+
+            # https://www.rfc-editor.org/rfc/rfc9110#section-13.2.2
+            if_match = request.if_match
+            if if_match is not None and not self._strong_etag_match(etag_value, if_match):
+                return await self._precondition_failed(request)
+
+            unmod_since = request.if_unmodified_since
+            if if_match is None and unmod_since is not None and int(st.st_mtime) > unmod_since.timestamp():
+                return await self._precondition_failed(request)
+
+            if_none_match = request.if_none_match
+            if if_none_match is not None and etag_weak_match(etag_value, if_none_match):
+                return await self._not_modified(request, etag_value, st.st_mtime)
+
+            mod_since = request.if_modified_since
+            if if_none_match is None and mod_since is not None and int(st.st_mtime) <= mod_since.timestamp():
+                return await self._not_modified(request, etag_value, st.st_mtime)
+
+            if hdrs.CONTENT_TYPE not in self.headers:
+                content_type, _ = mimetypes.guess_type(str(self._path))
+                self.content_type = content_type or 'application/octet-stream'
+
+            self.etag = etag_value
+            self.last_modified = st.st_mtime
+            size = st.st_size
+            offset, count = 0, size
+
+            if self._if_range_check(request, etag_value, st):
+                file_range = self._range_parse(request.headers.get(hdrs.RANGE), size)
+
+                if file_range == (0, 0):
+                    self.headers[hdrs.CONTENT_RANGE] = f'bytes */{size}'
+                    self.set_status(416)
+                    self.content_length = 0
+                    return await StreamResponse.prepare(self, request)
+
+                if file_range is not None:
+                    offset, count = file_range
+                    self.set_status(206)
+                    self.headers[hdrs.CONTENT_RANGE] = f'bytes {offset}-{offset + count - 1}/{size}'
+
+            self.content_length = count
+
+            # Заголовки без тела - подготовкой StreamResponse, в обход FileResponse.prepare
+            if not count or request.method == hdrs.METH_HEAD:
+                return await StreamResponse.prepare(self, request)
+
+            return await self._sendfile(request, fobj, offset, count)
+
+        finally:
+            await loop.run_in_executor(None, fobj.close)
+
+
+class DecodedFileResponse(StreamResponse):
+    # Сжатый в хранилище файл для клиента, не принимающего его Content-Encoding: распаковывается по частям в пуле потоков.
+    # Частичные загрузки не поддерживаются - диапазоны относятся к распакованному содержимому, а смещения в нем неизвестны.
+    def __init__(
+        self,
+        path: Path,
+        decoder: Any,
+        size: Optional[int] = None,
+        chunk_size: int = 65536,
+        etag: Optional[str] = None,
+        etag_stat: Optional[Tuple[int, int]] = None,
+        status: int = 200,
+        reason: Optional[str] = None,
+        sent_counter: Optional[Any] = None
+        ) -> None:
+
+        # size - размер распакованного содержимого; верен, пока файл совпадает с etag_stat
+        super().__init__(status=status, reason=reason)
+        self._sent_counter = sent_counter
+        self._path = path
+        self._decoder = decoder
+        self._size = size
+        self._chunk_size = chunk_size
+        self._etag_value = etag
+        self._etag_stat = etag_stat
+
+    def _chunk_decode(self, fobj: IO[Any]) -> Optional[bytes]:
+        data = fobj.read(self._chunk_size)
+        if not data:
+            return None
+
+        return self._decoder.decompress(data)
+
+    async def prepare(self, request: BaseRequest) -> Coroutine[Any, Any, Optional[AbstractStreamWriter]]:
+        loop = asyncio.get_running_loop()
+        fobj = await loop.run_in_executor(None, self._path.open, 'rb')
+
+        try:
+            st = os.fstat(fobj.fileno())
+            fresh = self._etag_stat is None or self._etag_stat == (st.st_size, st.st_mtime_ns)
+            self.last_modified = st.st_mtime
+            self.headers[hdrs.ACCEPT_RANGES] = 'none'
+
+            if self._etag_value and fresh:
+                self.etag = self._etag_value
+                if_none_match = request.if_none_match
+
+                if if_none_match is not None and etag_weak_match(self._etag_value, if_none_match):
+                    self.set_status(304)
+                    self._length_check = False
+                    return await super().prepare(request)
+
+            if hdrs.CONTENT_TYPE not in self.headers:
+                content_type, _ = mimetypes.guess_type(str(self._path))
+                self.content_type = content_type or 'application/octet-stream'
+
+            if fresh and self._size is not None:
+                self.content_length = self._size
+
+            else:
+                self.enable_chunked_encoding()
+
+            writer = await super().prepare(request)
+
+            if request.method == hdrs.METH_HEAD:
+                return writer
+
+            while True:
+                chunk = await loop.run_in_executor(None, self._chunk_decode, fobj)
+                if chunk is None:
+                    break
+
+                if chunk:
+                    await self.write(chunk)
+
+                    if self._sent_counter is not None:
+                        self._sent_counter.inc(len(chunk))
+
+            await self.write_eof()
+
+            return writer
+
+        finally:
+            await loop.run_in_executor(None, fobj.close)
@@ -1,22 +1,48 @@
-import aiofiles as aiof
 import aiofiles.os as aos
+import asyncio
+import json
+import os
 
-from aiohttp import BodyPartReader, MultipartReader
-from aiohttp.web import Request
+from aiohttp import BodyPartReader, MultipartReader, hdrs
+from aiohttp.web import Request, StreamResponse
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from concurrent.futures import Executor
 from pathlib import Path
 from time import time
-from typing import Any, Coroutine, Dict, Union, List, TypeVar, Optional
+from typing import Any, AsyncIterator, Coroutine, Dict, Union, List, TypeVar, Optional, Tuple
 from multidict import MultiDict
 from yarl import URL
 
 from app.db import Result
+from app.metrics import Metrics
 from app.routes import exceptipon as exc
+from app.routes.responses import DecodedFileResponse, FileStreamResponse
+from app.uploads import writer as wrt
 
 T = TypeVar('T', bound=Path)
 
 def collector_query_params(request: Request, params_names: List[str], default: Any) -> Dict[str, Any]:
      return {name: request.query.get(name, default) for name in params_names}
 
+def cursor_encode(key: Tuple[str, ...]) -> str:
+    return urlsafe_b64encode(json.dumps(key, ensure_ascii=False).encode('utf-8')).decode('ascii').rstrip('=')
+
+def cursor_decode(cursor: Optional[str], size: int = 3) -> Optional[Tuple[str, ...]]:
+    # Битый курсор не ошибка - просто отдаем первую страницу
+    if not cursor:
+        return None
+    
+    try:
+        key = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    
+    except ValueError:
+        return None
+    
+    if not isinstance(key, list) or len(key) != size or not all(isinstance(item, str) for item in key):
+        return None
+    
+    return tuple(key)
+
 class RequiredFormFieldError(Exception):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
@@ -45,9 +71,20 @@ class FileMetaDifference(Exception):
             
 
 class FileHandler:
-    def __init__(self, path: T, chunk_size: int = 65535) -> None:
+    def __init__(
+        self, 
+        path: T, 
+        chunk_size: int = 262144, 
+        buffer_size: int = 1048576, 
+        io_pool: Optional[Executor] = None,
+        metrics: Optional[Metrics] = None
+        ) -> None:
+        
         self._path = path
         self._chunk_size = chunk_size  
+        self._buffer_size = buffer_size
+        self._io_pool = io_pool
+        self._metrics = metrics
     
     async def _is_exist(self, path: Optional[T]=None, mkdir: bool = True) -> Coroutine[Any, Any, bool]:
         if path is None:
@@ -78,30 +115,89 @@ class FileHandler:
         await aos.replace(self._path, new_path)
         await self._cleaner(self._path.parent)
     
-    async def file_uploader(self, source: BodyPartReader) -> Coroutine[Any, Any, int]:
+    async def _chunks_read(self, source: BodyPartReader) -> AsyncIterator[bytes]:
+        while True:
+            file_chunk = await source.read_chunk(self._chunk_size)
+            if not file_chunk:
+                break
+            
+            yield file_chunk
+    
+    async def file_uploader(
+        self, 
+        source: BodyPartReader, 
+        size_hint: Optional[int] = None, 
+        hasher: Optional[Any] = None,
+        encoder: Optional[Any] = None
+        ) -> Coroutine[Any, Any, Tuple[int, int]]:
+        
+        # size_hint - Content-Length запроса, т.е. размер файла с запасом: место выделяется заранее,
+        # а лишнее отрезается по фактическому размеру. hasher получает содержимое по мере записи,
+        # encoder сжимает его (размер сжатого файла заранее не известен, место не выделяется).
+        # Возвращает размер содержимого и размер файла на диске.
         await self._is_exist()
         
-        size = 0
-        async with aiof.open(self._path, 'wb') as fd:
-            while True:
-                file_chunk  = await source.read_chunk(self._chunk_size)
-                if not file_chunk:
-                    break
+        loop = asyncio.get_running_loop()
+        fd = await loop.run_in_executor(self._io_pool, os.open, self._path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        preallocated = bool(size_hint) and encoder is None
+        completed = False
+        
+        try:
+            if preallocated:
+                await loop.run_in_executor(self._io_pool, wrt.preallocate, fd, size_hint)
+            
+            size, stored_size = await wrt.chunks_write(
+                fd, self._chunks_read(source), 0, self._buffer_size, self._io_pool, hasher=hasher, encoder=encoder)
             
-                size += len(file_chunk)
-                await fd.write(file_chunk)
+            if preallocated:
+                await loop.run_in_executor(self._io_pool, os.ftruncate, fd, stored_size)
+            
+            completed = True
+        
+        # Оборванная загрузка (ошибка, разрыв соединения, отмена) удаляет файл: иначе в хранилище остался бы
+        # заполненный нулями файл заявленного размера, и следующая сверка добавила бы его в каталог
+        finally:
+            await loop.run_in_executor(self._io_pool, os.close, fd)
+            
+            if not completed:
+                await loop.run_in_executor(self._io_pool, lambda: self._path.unlink(missing_ok=True))
+        
+        if self._metrics is not None:
+            self._metrics.upload_bytes.inc(size)
     
-        return size
+        return size, stored_size
     
-    async def file_downloader(self) -> Coroutine[Any, Any, Optional[bytes]]:
+    async def file_downloader(
+        self, 
+        send_chunk_size: int = 262144, 
+        etag: Optional[str] = None, 
+        etag_stat: Optional[Tuple[int, int]] = None,
+        encoding: Optional[str] = None,
+        decoder: Optional[Any] = None,
+        size: Optional[int] = None
+        ) -> Coroutine[Any, Any, Optional[StreamResponse]]:
+        
+        # Сжатый файл (encoding) отдается как есть с Content-Encoding, либо, если передан decoder, распакованным
         try:
             await self._is_exist(mkdir=False)
         
         except FileExistsError:
-            async with aiof.open(self._path, 'rb') as fd:
-                result = await fd.read()
-        
-            return result
+            sent_counter = self._metrics.download_bytes if self._metrics is not None else None
+            
+            if decoder is not None:
+                response = DecodedFileResponse(self._path, decoder, size, etag=etag, etag_stat=etag_stat, sent_counter=sent_counter)
+            
+            # Файл не читается в память: отдача идет через sendfile при подготовке ответа
+            else:
+                response = FileStreamResponse(self._path, send_chunk_size, etag, etag_stat, sent_counter=sent_counter)
+                
+                if encoding is not None:
+                    response.headers[hdrs.CONTENT_ENCODING] = encoding
+            
+            if encoding is not None:
+                response.headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+            
+            return response
     
     async def file_deleter(self) -> Coroutine[Any, Any, None]:
         try:
@@ -115,6 +211,11 @@ class FileHandler:
         except FileNotFoundError:
             pass
         
+    @staticmethod
+    def path_normalize(path: str) -> str:
+        # Относительный путь директории в том виде, в котором он хранится в БД: "/dir/" -> "dir", "/" -> "."
+        return str(Path(path.lstrip('./')))
+    
     @staticmethod
     def path_constructor(save_dir_path: T, path:str = '', name: str = '', ext: str = '') -> T:
         if all((path, name, ext)):
@@ -159,7 +260,7 @@ class FormHandler:
         return self._form_data, field
 
 class PageContext:
-    __slots__ = 'target', 'form_action', 'form_data', 'result', 'page_name', 'request'
+    __slots__ = 'target', 'form_action', 'form_data', 'result', 'page_name', 'request', 'total', 'next_url', 'first_url', 'archive_url'
     
     def __init__(
         self,
@@ -178,6 +279,10 @@ class PageContext:
         self.form_action = form_action  
         self.form_data = form_data
         self.result = result
+        self.total = None
+        self.next_url = None
+        self.first_url = None
+        self.archive_url = None
     
     def get_context(self) -> Dict[str, Any]:
         c = {
@@ -186,7 +291,12 @@ class PageContext:
             'f_action': self.form_action,
             'f_data': self.form_data,
             'page_name': self.page_name,
-            'result': self.result
+            'result': self.result,
+            'total': self.total,
+            'next_url': self.next_url,
+            'first_url': self.first_url,
+            'archive_url': self.archive_url,
+            'query': self.request.query.get('q', '')
         }
         
         return c
\ No newline at end of file
@@ -0,0 +1,183 @@
+import asyncio
+import multiprocessing as mp
+import signal
+import time
+from multiprocessing.process import BaseProcess
+from multiprocessing.synchronize import Event
+from pathlib import Path
+from typing import Any, Coroutine, Dict, List, Tuple
+
+from app.configurator import AppConfigGetter, AppConfigurator, app_workers_get
+from app.db import Base
+
+
+# Сколько ждать готовности нового процесса и завершения старого (с запасом к shutdown_timeout aiohttp), секунд
+READY_TIMEOUT = 120.0
+STOP_TIMEOUT = 75.0
+POLL_INTERVAL = 0.5
+# Пауза перед повторным запуском упавшего процесса удваивается с каждым падением подряд, от RESPAWN_DELAY до
+# RESPAWN_DELAY_MAX секунд; процесс, проработавший RESPAWN_RESET секунд, падением подряд не считается
+RESPAWN_DELAY = 1.0
+RESPAWN_DELAY_MAX = 60.0
+RESPAWN_RESET = 60.0
+
+WorkerKey = Tuple[str, int]
+
+
+async def worker_serve(config_path: Path, app_key: str, primary: bool, ready: Event) -> Coroutine[Any, Any, None]:
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+
+    configurator = AppConfigurator(config_path, Base, (app_key,), primary, True)
+    await configurator.configurate(ready.set)
+    tasks = configurator.sites_start_tasks_create()
+
+    await stopping.wait()
+    [task.cancel() for task in tasks]
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def worker_run(config_path: Path, app_key: str, primary: bool, ready: Event) -> None:
+    # Ctrl+C получает вся группа процессов: рабочие процессы останавливает супервизор через SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    asyncio.run(worker_serve(config_path, app_key, primary, ready))
+
+
+class Supervisor:
+    # По процессу на каждого из "workers" приложения, все слушают один порт (SO_REUSEPORT), соединения между ними
+    # распределяет ядро. Процесс с номером 0 - основной: он первым создает схему БД, затем сверяет ее с хранилищем,
+    # наблюдает за ним и чистит незавершенные загрузки; остальные только обслуживают запросы.
+    # Процессы запускаются через spawn: при перезапуске (SIGHUP) подхватываются новые код и конфигурация.
+    # Завершившийся процесс запускается заново, SIGINT/SIGTERM - плавная остановка всех процессов.
+    def __init__(self, config_path: Path) -> None:
+        self.__config_path = config_path
+        self.__context = mp.get_context('spawn')
+        self.__workers: Dict[WorkerKey, BaseProcess] = {}
+        # Событие готовности должно жить, пока процесс его не получит
+        self.__ready: Dict[WorkerKey, Event] = {}
+        self.__started: Dict[WorkerKey, float] = {}
+        self.__failures: Dict[WorkerKey, int] = {}
+        self.__respawn_at: Dict[WorkerKey, float] = {}
+        self.__stopping = False
+        self.__restarting = False
+
+    @staticmethod
+    def required(config_path: Path) -> bool:
+        applications = AppConfigGetter(config_path).config['applications']
+
+        return any(app_workers_get(app_val) > 1 for app_val in applications.values())
+
+    def __spawn(self, key: WorkerKey) -> Tuple[BaseProcess, Event]:
+        app_key, index = key
+        ready = self.__context.Event()
+        process = self.__context.Process(
+            target=worker_run,
+            args=(self.__config_path, app_key, index == 0, ready),
+            name=f'{app_key}-{index}'
+            )
+        process.start()
+        self.__ready[key] = ready
+        self.__started[key] = time.monotonic()
+
+        return process, ready
+
+    @staticmethod
+    def __ready_wait(spawned: List[Tuple[BaseProcess, Event]]) -> bool:
+        deadline = time.monotonic() + READY_TIMEOUT
+
+        for process, ready in spawned:
+            while not ready.wait(POLL_INTERVAL):
+                if not process.is_alive() or time.monotonic() > deadline:
+                    print(f'Процесс {process.name} не запустился.')
+                    return False
+
+        return True
+
+    @staticmethod
+    def __stop(processes: List[BaseProcess]) -> None:
+        [process.terminate() for process in processes if process.is_alive()]
+
+        for process in processes:
+            process.join(STOP_TIMEOUT)
+
+            if process.is_alive():
+                print(f'Процесс {process.name} не завершился за {STOP_TIMEOUT} с и будет остановлен принудительно.')
+                process.kill()
+                process.join()
+
+    def __start(self) -> None:
+        config = AppConfigGetter(self.__config_path).config
+        keys = [(app_key, index) for app_key, app_val in config['applications'].items() for index in range(app_workers_get(app_val))]
+        primary = [key for key in keys if key[1] == 0]
+
+        # Основные процессы создают схему БД, остальные запускаются после них, чтобы не менять схему одновременно.
+        # Не запустившийся процесс останавливает запуск: run() завершит уже запущенные.
+        for group in (primary, [key for key in keys if key[1] != 0]):
+            spawned = {key: self.__spawn(key) for key in group}
+            self.__workers.update({key: process for key, (process, _) in spawned.items()})
+
+            if not self.__ready_wait(list(spawned.values())):
+                raise RuntimeError('Запуск остановлен: не все процессы приложения запустились.')
+
+    def __restart(self) -> None:
+        # Поочередная замена: новый процесс слушает порт вместе со старым, старый дорабатывает начатые запросы
+        for key in list(self.__workers):
+            if self.__stopping:
+                break
+
+            process, ready = self.__spawn(key)
+
+            if not self.__ready_wait([(process, ready)]):
+                self.__stop([process])
+                print(f'Перезапуск остановлен: процесс {key[0]}-{key[1]} оставлен прежним.')
+                break
+
+            old, self.__workers[key] = self.__workers[key], process
+            self.__respawn_at.pop(key, None)
+            self.__stop([old])
+
+    def __respawn(self) -> None:
+        # Процесс, падающий сразу после запуска (например, из-за ошибки конфигурации), перезапускается с растущей паузой
+        now = time.monotonic()
+
+        for key, process in list(self.__workers.items()):
+            if process.is_alive() or self.__stopping:
+                continue
+
+            if key not in self.__respawn_at:
+                failures = 1 if now - self.__started[key] >= RESPAWN_RESET else self.__failures.get(key, 0) + 1
+                delay = min(RESPAWN_DELAY * 2 ** (failures - 1), RESPAWN_DELAY_MAX)
+                self.__failures[key] = failures
+                self.__respawn_at[key] = now + delay
+                print(f'Процесс {process.name} завершился (код {process.exitcode}), запуск заново через {delay:g} с.')
+
+            if now >= self.__respawn_at[key]:
+                del self.__respawn_at[key]
+                self.__workers[key], _ = self.__spawn(key)
+
+    def __stop_request(self, signum: int, frame: Any) -> None:
+        self.__stopping = True
+
+    def __restart_request(self, signum: int, frame: Any) -> None:
+        self.__restarting = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self.__stop_request)
+        signal.signal(signal.SIGTERM, self.__stop_request)
+        signal.signal(signal.SIGHUP, self.__restart_request)
+
+        try:
+            self.__start()
+
+            while not self.__stopping:
+                if self.__restarting:
+                    self.__restarting = False
+                    self.__restart()
+
+                self.__respawn()
+                time.sleep(POLL_INTERVAL)
+
+        finally:
+            self.__stop(list(self.__workers.values()))
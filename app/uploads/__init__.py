@@ -0,0 +1,216 @@
+import asyncio
+import json
+import os
+import re
+import secrets
+import shutil
+import time
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, List, Optional, Tuple, TypeVar
+
+from app.uploads import writer
+
+
+# Служебная директория в корне хранилища: ее не обходит сверка и не наблюдает app.watcher
+UPLOADS_DIR = '.uploads'
+SESSION_ID = re.compile(r'[0-9a-f]{32}')
+META_FILE = 'meta.json'
+DATA_FILE = 'data'
+
+R = TypeVar('R')
+
+
+class UploadError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class UploadManager:
+    # Загрузка по частям: сессия - директория в UPLOADS_DIR с описанием (meta.json) и файлом данных,
+    # место под который выделяется заранее. Каждая часть пишется со своего смещения (pwrite), поэтому
+    # части можно слать параллельно и повторять, а при завершении файл не копируется - только переносится.
+    def __init__(
+        self,
+        save_dir_path: Path,
+        part_size: int = 8388608,
+        ttl: float = 86400.0,
+        gc_interval: float = 3600.0,
+        buffer_size: int = 1048576,
+        io_pool: Optional[Executor] = None
+        ) -> None:
+
+        self.__root = Path(save_dir_path).joinpath(UPLOADS_DIR)
+        self.__part_size = part_size
+        self.__buffer_size = buffer_size
+        self.__io_pool = io_pool
+        self.__ttl = ttl
+        self.__gc_interval = gc_interval
+        self.__task: Optional[asyncio.Task] = None
+
+    async def __run(self, func: Callable[..., R], *args: Any) -> Coroutine[Any, Any, R]:
+        # Любая работа с файловой системой - в пуле ввода-вывода, не в цикле событий
+        return await asyncio.get_running_loop().run_in_executor(self.__io_pool, func, *args)
+
+    def __session_load(self, session_id: str) -> Tuple[Path, Dict[str, Any]]:
+        # Директория сессии и ее описание
+        if not SESSION_ID.fullmatch(session_id):
+            raise UploadError(404, 'Сессия загрузки не найдена.')
+
+        session_dir = self.__root.joinpath(session_id)
+
+        try:
+            return session_dir, json.loads(session_dir.joinpath(META_FILE).read_text('utf-8'))
+
+        except FileNotFoundError:
+            raise UploadError(404, 'Сессия загрузки не найдена.')
+
+    @staticmethod
+    def __parts_count(meta: Dict[str, Any]) -> int:
+        return -(-meta['size'] // meta['part_size'])
+
+    @staticmethod
+    def __received(session_dir: Path) -> List[int]:
+        return sorted(int(item.stem) for item in session_dir.glob('*.part'))
+
+    def __session_state(self, session_id: str) -> Tuple[Path, Dict[str, Any], List[int]]:
+        session_dir, meta = self.__session_load(session_id)
+
+        return session_dir, meta, self.__received(session_dir)
+
+    @staticmethod
+    def __part_mark(session_dir: Path, number: int) -> None:
+        # Отметка о полученной части; mtime описания - время последней записи в сессию (см. gc)
+        session_dir.joinpath(f'{number}.part').touch()
+        os.utime(session_dir.joinpath(META_FILE))
+
+    def __create(self, meta: Dict[str, Any]) -> str:
+        session_id = secrets.token_hex(16)
+        session_dir = self.__root.joinpath(session_id)
+        session_dir.mkdir(parents=True)
+
+        with open(session_dir.joinpath(DATA_FILE), 'wb') as fd:
+            try:
+                if meta['size']:
+                    os.posix_fallocate(fd.fileno(), 0, meta['size'])
+
+            # Файловая система без fallocate - остается разреженный файл нужного размера
+            except (AttributeError, OSError):
+                fd.truncate(meta['size'])
+
+        session_dir.joinpath(META_FILE).write_text(json.dumps(meta, ensure_ascii=False), 'utf-8')
+
+        return session_id
+
+    async def create(self, meta: Dict[str, Any]) -> Coroutine[Any, Any, Dict[str, Any]]:
+        if not isinstance(meta.get('size'), int) or meta['size'] < 0:
+            raise UploadError(400, 'Размер файла должен быть неотрицательным целым числом.')
+
+        meta = {**meta, 'part_size': self.__part_size}
+        session_id = await self.__run(self.__create, meta)
+
+        return {'id': session_id, 'part_size': self.__part_size, 'parts': self.__parts_count(meta)}
+
+    async def meta(self, session_id: str) -> Coroutine[Any, Any, Dict[str, Any]]:
+        _, meta = await self.__run(self.__session_load, session_id)
+
+        return meta
+
+    async def status(self, session_id: str) -> Coroutine[Any, Any, Dict[str, Any]]:
+        _, meta, received = await self.__run(self.__session_state, session_id)
+
+        return {'id': session_id, 'part_size': meta['part_size'], 'parts': self.__parts_count(meta), 'received': received}
+
+    async def part_write(self, session_id: str, number: int, source: AsyncIterator[bytes]) -> Coroutine[Any, Any, int]:
+        session_dir, meta = await self.__run(self.__session_load, session_id)
+
+        if not 0 <= number < self.__parts_count(meta):
+            raise UploadError(400, 'Неверный номер части.')
+
+        loop = asyncio.get_running_loop()
+        offset = number * meta['part_size']
+        expected = min(meta['part_size'], meta['size'] - offset)
+        fd = await loop.run_in_executor(self.__io_pool, os.open, session_dir.joinpath(DATA_FILE), os.O_WRONLY)
+
+        try:
+            written, _ = await writer.chunks_write(fd, source, offset, self.__buffer_size, self.__io_pool, expected)
+
+        except OverflowError:
+            raise UploadError(400, 'Часть больше ожидаемого размера.')
+
+        finally:
+            await loop.run_in_executor(self.__io_pool, os.close, fd)
+
+        # Обрыв соединения: часть не отмечается полученной, ее нужно прислать заново
+        if written != expected:
+            raise UploadError(400, f'Получено {written} байт из {expected}.')
+
+        await self.__run(self.__part_mark, session_dir, number)
+
+        return written
+
+    def __commit(self, session_dir: Path, target: Path) -> None:
+        data_path = session_dir.joinpath(DATA_FILE)
+
+        with open(data_path, 'rb') as fd:
+            os.fsync(fd.fileno())
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # link не перезаписывает существующий файл, в отличие от rename
+        os.link(data_path, target)
+        shutil.rmtree(session_dir, ignore_errors=True)
+
+    async def commit(self, session_id: str, target: Path) -> Coroutine[Any, Any, None]:
+        session_dir, meta, received = await self.__run(self.__session_state, session_id)
+        missing = sorted(set(range(self.__parts_count(meta))) - set(received))
+
+        if missing:
+            raise UploadError(409, f'Не получены части: {", ".join(map(str, missing))}.')
+
+        await self.__run(self.__commit, session_dir, target)
+
+    async def abort(self, session_id: str) -> Coroutine[Any, Any, None]:
+        session_dir, _ = await self.__run(self.__session_load, session_id)
+        await self.__run(shutil.rmtree, session_dir, True)
+
+    def gc(self) -> int:
+        # Сессии, в которые ничего не писали дольше ttl, удаляются вместе с данными
+        if not self.__root.exists():
+            return 0
+
+        deadline = time.time() - self.__ttl
+        removed = 0
+
+        for session_dir in self.__root.iterdir():
+            try:
+                stale = session_dir.joinpath(META_FILE).stat().st_mtime < deadline
+
+            # Сессия без описания - след прерванного создания
+            except FileNotFoundError:
+                stale = session_dir.stat().st_mtime < deadline
+
+            if stale:
+                shutil.rmtree(session_dir, ignore_errors=True)
+                removed += 1
+
+        return removed
+
+    async def __gc_loop(self) -> Coroutine[Any, Any, None]:
+        while True:
+            try:
+                await self.__run(self.gc)
+
+            except OSError as e:
+                print(f'Ошибка очистки незавершенных загрузок в {self.__root}: {e!r}')
+
+            await asyncio.sleep(self.__gc_interval)
+
+    def start(self) -> None:
+        self.__task = asyncio.create_task(self.__gc_loop())
+
+    async def stop(self) -> Coroutine[Any, Any, None]:
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
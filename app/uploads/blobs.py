@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import os
+import secrets
+import stat
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, Coroutine, Optional
+
+
+# Служебная директория в корне хранилища с содержимым файлов, адресуемым по хэшу
+BLOBS_DIR = '.blobs'
+HASH_BUFFER_SIZE = 1048576
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+def hasher_make() -> Any:
+    return hashlib.blake2b(digest_size=32)
+
+
+def file_hash(path: Path, buffer_size: int = HASH_BUFFER_SIZE) -> str:
+    hasher = hasher_make()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+
+    with open(path, 'rb', buffering=0) as fd:
+        while True:
+            read = fd.readinto(buffer)
+            if not read:
+                break
+
+            hasher.update(view[:read])
+
+    return hasher.hexdigest()
+
+
+def blob_name(digest: str, encoding: Optional[str] = None) -> str:
+    # Сжатое и несжатое одинаковое содержимое - разные файлы на диске, поэтому и разные блобы
+    return digest if encoding is None else f'{digest}.{encoding}'
+
+
+class BlobStore:
+    # Содержимое с одинаковым хэшем хранится один раз: BLOBS_DIR/<первые 2 символа>/<хэш>, а файлы каталога -
+    # жесткие ссылки на него. Счетчик ссылок ведет сама файловая система (st_nlink), в БД его нет, поэтому его уменьшает
+    # любое удаление файла: через приложение, при сверке или вручную. Блоб без ссылок удаляет gc.
+    # Ссылки делят один inode: изменение на месте одного файла изменило бы все копии и блоб, и их хэши в БД стали бы
+    # неверными. Поэтому блоб (а с ним и все ссылки) доступен только для чтения, изменять такие файлы можно только
+    # заменой (новый файл и rename). Копирования при записи нет, поэтому режим dedup по умолчанию выключен.
+    def __init__(self, save_dir_path: Path, gc_interval: float = 3600.0, io_pool: Optional[Executor] = None) -> None:
+        self.__root = Path(save_dir_path).joinpath(BLOBS_DIR)
+        self.__gc_interval = gc_interval
+        self.__io_pool = io_pool
+        self.__task: Optional[asyncio.Task] = None
+
+    def blob_path(self, name: str) -> Path:
+        return self.__root.joinpath(name[:2], name)
+
+    def intern(self, file_path: Path, name: str) -> bool:
+        # name - имя блоба (см. blob_name). True - такое содержимое уже было, и файл заменен ссылкой на блоб
+        blob = self.blob_path(name)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+
+        for _ in range(2):
+            try:
+                os.link(file_path, blob)
+                os.chmod(blob, stat.S_IMODE(blob.stat().st_mode) & ~WRITE_BITS)
+                return False
+
+            except FileExistsError:
+                pass
+
+            blob_stat, file_stat = blob.stat(), file_path.stat()
+
+            # Уже ссылка на блоб либо (при коллизии или порче блоба) другое содержимое - файл остается как есть
+            if blob_stat.st_ino == file_stat.st_ino or blob_stat.st_size != file_stat.st_size:
+                return blob_stat.st_ino == file_stat.st_ino
+
+            tmp_path = file_path.with_name(f'.{file_path.name}.{secrets.token_hex(4)}.link')
+
+            try:
+                os.link(blob, tmp_path)
+
+            # Блоб удалил gc между проверками - файл станет новым блобом
+            except FileNotFoundError:
+                continue
+
+            os.replace(tmp_path, file_path)
+            return True
+
+        return False
+
+    def release(self, name: str) -> None:
+        blob = self.blob_path(name)
+
+        try:
+            if blob.stat().st_nlink <= 1:
+                blob.unlink()
+
+        except FileNotFoundError:
+            pass
+
+    def gc(self) -> int:
+        if not self.__root.exists():
+            return 0
+
+        removed = 0
+
+        for blob_dir in self.__root.iterdir():
+            for blob in blob_dir.iterdir():
+                try:
+                    if blob.stat().st_nlink <= 1:
+                        blob.unlink()
+                        removed += 1
+
+                except FileNotFoundError:
+                    pass
+
+        return removed
+
+    async def intern_async(self, file_path: Path, name: str) -> Coroutine[Any, Any, bool]:
+        return await asyncio.get_running_loop().run_in_executor(self.__io_pool, self.intern, file_path, name)
+
+    async def release_async(self, name: str) -> Coroutine[Any, Any, None]:
+        await asyncio.get_running_loop().run_in_executor(self.__io_pool, self.release, name)
+
+    async def __gc_loop(self) -> Coroutine[Any, Any, None]:
+        while True:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.gc)
+
+            except OSError as e:
+                print(f'Ошибка очистки неиспользуемого содержимого в {self.__root}: {e!r}')
+
+            await asyncio.sleep(self.__gc_interval)
+
+    def start(self) -> None:
+        self.__task = asyncio.create_task(self.__gc_loop())
+
+    async def stop(self) -> Coroutine[Any, Any, None]:
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
@@ -0,0 +1,92 @@
+import mimetypes
+import zlib
+from fnmatch import fnmatch
+from typing import Any, Iterable, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Сжатие хранимых файлов. Имя кодека совпадает со значением Content-Encoding, с которым файл можно отдать как есть.
+CODECS = ('gzip', 'zstd')
+# Что сжимается по умолчанию: шаблоны MIME-типов или расширения файлов
+COMPRESS_TYPES = ('text/*', 'application/json', 'application/xml', 'application/javascript', 'image/svg+xml')
+
+
+class Codec:
+    def __init__(self, name: str, level: Optional[int] = None) -> None:
+        if name not in CODECS:
+            raise ValueError(name)
+
+        if name == 'zstd' and zstandard is None:
+            raise ImportError('zstandard')
+
+        self.name = name
+        self.__level = level
+
+    def encoder_make(self) -> Any:
+        # У обоих кодеков объекты с compress/flush и decompress, как у zlib.
+        # Заголовок gzip пишется без времени, поэтому одинаковое содержимое сжимается одинаково (см. app.uploads.blobs).
+        if self.name == 'gzip':
+            return zlib.compressobj(6 if self.__level is None else self.__level, zlib.DEFLATED, 31)
+
+        return zstandard.ZstdCompressor(level=3 if self.__level is None else self.__level).compressobj()
+
+    def decoder_make(self) -> Any:
+        if self.name == 'gzip':
+            return zlib.decompressobj(31)
+
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class CompressionPolicy:
+    # Сжимаются файлы, расширение или MIME-тип (по расширению) которых подходит под один из шаблонов types
+    def __init__(self, codec: Codec, types: Iterable[str] = COMPRESS_TYPES) -> None:
+        self.codec = codec
+        self.__types: Tuple[str, ...] = tuple(item.lower().lstrip('.') for item in types)
+
+    def codec_select(self, ext: str) -> Optional[Codec]:
+        ext = ext.lower().lstrip('.')
+        mime_type, _ = mimetypes.guess_type(f'file.{ext}')
+
+        for pattern in self.__types:
+            if '/' in pattern and mime_type is not None and fnmatch(mime_type, pattern):
+                return self.codec
+
+            if '/' not in pattern and fnmatch(ext, pattern):
+                return self.codec
+
+        return None
+
+
+def codec_get(name: str) -> Codec:
+    # Кодек, которым сжат уже сохраненный файл: уровень сжатия для чтения не нужен
+    return Codec(name)
+
+
+def encoding_accepted(accept_encoding: str, name: str) -> bool:
+    # Accept-Encoding: "gzip, deflate;q=0.5, zstd;q=0" - кодек принимается, если он (или *) указан с q > 0.
+    # Без заголовка сжатое содержимое не отдается: так curl и подобные клиенты получают файл как есть.
+    accepted = {}
+
+    for item in accept_encoding.lower().split(','):
+        token, _, params = item.strip().partition(';')
+        quality = 1.0
+
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+
+                except ValueError:
+                    quality = 0.0
+
+        accepted[token.strip()] = quality
+
+    if name in accepted:
+        return accepted[name] > 0
+
+    return accepted.get('*', 0) > 0
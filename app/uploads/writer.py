@@ -0,0 +1,107 @@
+import asyncio
+import os
+from concurrent.futures import Executor
+from typing import Any, AsyncIterator, Coroutine, Optional, Tuple
+
+
+# Размер буфера округляется до страницы: запись идет целыми выровненными блоками
+BLOCK_SIZE = 4096
+
+
+def buffer_size_align(buffer_size: int) -> int:
+    return max(BLOCK_SIZE, buffer_size // BLOCK_SIZE * BLOCK_SIZE)
+
+
+def pwrite_all(fd: int, data: memoryview, offset: int) -> None:
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+def buffer_write(
+    fd: int,
+    data: memoryview,
+    offset: int,
+    hasher: Optional[Any] = None,
+    encoder: Optional[Any] = None,
+    final: bool = False
+    ) -> int:
+
+    # Хэш и сжатие считаются в том же потоке, что и запись: буферы пишутся строго по очереди, порядок данных сохраняется.
+    # Хэш - от исходного содержимого. Возвращает кол-во записанных в файл байт.
+    if hasher is not None:
+        hasher.update(data)
+
+    if encoder is not None:
+        data = memoryview(encoder.compress(data) + (encoder.flush() if final else b''))
+
+    pwrite_all(fd, data, offset)
+
+    return len(data)
+
+
+def preallocate(fd: int, size: int) -> None:
+    # Только подсказка файловой системе: без fallocate файл просто растет по мере записи
+    try:
+        os.posix_fallocate(fd, 0, size)
+
+    except (AttributeError, OSError):
+        pass
+
+
+async def chunks_write(
+    fd: int,
+    source: AsyncIterator[bytes],
+    offset: int = 0,
+    buffer_size: int = 1048576,
+    pool: Optional[Executor] = None,
+    limit: Optional[int] = None,
+    hasher: Optional[Any] = None,
+    encoder: Optional[Any] = None
+    ) -> Coroutine[Any, Any, Tuple[int, int]]:
+
+    # Куски из сети копятся в буфер и пишутся одним pwrite в пуле ввода-вывода; пока пишется один буфер,
+    # наполняется следующий. limit - максимум байт, больше которого писать нельзя (OverflowError),
+    # hasher - объект hashlib, который получает записанные данные, encoder - объект сжатия (см. app.uploads.codecs).
+    # Возвращает кол-во полученных байт и кол-во записанных в файл (они различаются только со сжатием).
+    loop = asyncio.get_running_loop()
+    buffer_size = buffer_size_align(buffer_size)
+    buffer = bytearray()
+    pending: Optional[asyncio.Future] = None
+    total = 0
+    written = 0
+
+    try:
+        async for chunk in source:
+            total += len(chunk)
+
+            if limit is not None and total > limit:
+                raise OverflowError(total)
+
+            buffer += chunk
+
+            if len(buffer) >= buffer_size:
+                full = len(buffer) // buffer_size * buffer_size
+                data = buffer[:full]
+                del buffer[:full]
+
+                # Со сжатием смещение следующего буфера известно только после записи предыдущего
+                if pending is not None:
+                    written += await pending
+
+                pending = loop.run_in_executor(pool, buffer_write, fd, memoryview(data), offset + written, hasher, encoder)
+
+        if pending is not None:
+            written += await pending
+            pending = None
+
+        if buffer or encoder is not None:
+            written += await loop.run_in_executor(pool, buffer_write, fd, memoryview(buffer), offset + written, hasher, encoder, True)
+
+    finally:
+        # Запись, начатая до ошибки, должна завершиться до закрытия дескриптора вызывающим кодом
+        if pending is not None:
+            await asyncio.gather(pending, return_exceptions=True)
+
+    return total, written
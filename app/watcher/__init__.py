@@ -0,0 +1,316 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+from pathlib import Path
+from typing import Any, Coroutine, Dict, List, Optional, Set, Tuple
+
+from app.db import DBHandler, PageKey
+from app.db import walker
+from app.jobs import JobManager
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError('libc не найдена.')
+
+        self.__libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.__libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = self.__call(self.__libc.inotify_init1, IN_NONBLOCK | IN_CLOEXEC)
+
+    def __call(self, func: Any, *args: Any) -> int:
+        result = func(*args)
+        if result < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        return result
+
+    def add_watch(self, path: Path, mask: int = WATCH_MASK) -> int:
+        return self.__call(self.__libc.inotify_add_watch, self.fd, os.fsencode(path), mask)
+
+    def rm_watch(self, wd: int) -> None:
+        try:
+            self.__call(self.__libc.inotify_rm_watch, self.fd, wd)
+
+        # Дескриптор мог быть уже снят ядром (IN_IGNORED)
+        except OSError:
+            pass
+
+    def read_events(self) -> List[Tuple[int, int, int, str]]:
+        events = []
+
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class StorageWatcher:
+    # События файловой системы копятся в наборе "грязных" путей и раз в interval секунд применяются к БД:
+    # повторные события по одному файлу схлопываются, а итог определяется по наличию файла на момент применения.
+    # Полная сверка (потеря событий, опрос) идет задачей sync менеджера задач, как и сверка через /sync.
+    def __init__(
+        self,
+        save_dir_path: Path,
+        db_handler: DBHandler,
+        jobs: JobManager,
+        interval: float = 0.5,
+        poll_interval: float = 60.0,
+        max_pending: int = 10000
+        ) -> None:
+
+        self.__save_dir = Path(save_dir_path)
+        self.__db = db_handler
+        self.__jobs = jobs
+        self.__interval = interval
+        self.__poll_interval = poll_interval
+        self.__max_pending = max_pending
+        self.__inotify: Optional[Inotify] = None
+        self.__watches: Dict[int, str] = {}
+        self.__dirty: Dict[str, PageKey] = {}
+        self.__dirs_gone: Set[str] = set()
+        self.__resync = False
+        self.__wakeup = asyncio.Event()
+        self.__task: Optional[asyncio.Task] = None
+        self.__poll_task: Optional[asyncio.Task] = None
+        self.__dir_tasks: Set[asyncio.Task] = set()
+
+    @property
+    def mode(self) -> str:
+        return 'inotify' if self.__inotify is not None else 'polling'
+
+    @staticmethod
+    def __rel_join(rel_dir: str, name: str) -> str:
+        return name if rel_dir == '.' else f'{rel_dir}/{name}'
+
+    def __tree_watch(self, rel_dir: str) -> Tuple[List[Tuple[int, str]], List[str]]:
+        # Выполняется в потоке: ставит наблюдение на поддерево и возвращает уже лежащие в нем файлы,
+        # т.к. они могли появиться до того, как наблюдение было установлено
+        watches, files = [], []
+        stack = [rel_dir]
+
+        while stack:
+            current = stack.pop()
+
+            try:
+                watches.append((self.__inotify.add_watch(self.__save_dir.joinpath(current)), current))
+                with os.scandir(self.__save_dir.joinpath(current)) as dir_iter:
+                    for entry in dir_iter:
+                        if current == '.' and entry.name in walker.SERVICE_DIRS:
+                            continue
+
+                        rel_path = self.__rel_join(current, entry.name)
+                        stack.append(rel_path) if entry.is_dir() else files.append(rel_path)
+
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+
+            # Например, исчерпан лимит max_user_watches (ENOSPC): уже поставленные в поддереве наблюдения снимаются,
+            # иначе остались бы дескрипторы, события которых никто не разбирает. Прежние наблюдения не трогаются -
+            # для уже наблюдаемой директории ядро возвращает тот же дескриптор.
+            except OSError:
+                [self.__inotify.rm_watch(wd) for wd, _ in watches if wd not in self.__watches]
+                raise
+
+        return watches, files
+
+    async def __dir_add(self, rel_dir: str, mark_files: bool = True) -> None:
+        watches, files = await asyncio.get_running_loop().run_in_executor(None, self.__tree_watch, rel_dir)
+        self.__watches.update(watches)
+
+        if mark_files:
+            [self.__mark(rel_path) for rel_path in files]
+
+    def __dir_task_done(self, task: asyncio.Task) -> None:
+        self.__dir_tasks.discard(task)
+
+        # Например, исчерпан лимит max_user_watches: поддерево не наблюдается - оно сверяется сразу,
+        # а дальше хранилище, как и без inotify, сверяется опросом раз в poll_interval
+        if not task.cancelled() and task.exception() is not None:
+            print(f'Не удалось поставить наблюдение в {self.__save_dir}: {task.exception()!r}')
+            self.__resync = True
+            self.__wakeup.set()
+
+            if self.__poll_task is None:
+                print(f'Для {self.__save_dir} включен опрос раз в {self.__poll_interval} с.')
+                self.__poll_task = asyncio.create_task(self.__poll_loop())
+
+    def __dir_remove(self, rel_dir: str) -> None:
+        prefix = f'{rel_dir}/'
+        for wd, watched in list(self.__watches.items()):
+            if watched == rel_dir or watched.startswith(prefix):
+                self.__inotify.rm_watch(wd)
+                del self.__watches[wd]
+
+        self.__dirs_gone.add(rel_dir)
+
+    def __mark(self, rel_path: str) -> None:
+        path = Path(rel_path)
+        self.__dirty[rel_path] = walker.key_make(str(path.parent), path.name)
+        self.__wakeup.set()
+
+    def __events_handle(self) -> None:
+        for wd, mask, _, name in self.__inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # События потеряны - нужна полная сверка
+                self.__resync = True
+                self.__wakeup.set()
+                continue
+
+            if mask & IN_IGNORED:
+                self.__watches.pop(wd, None)
+                continue
+
+            rel_dir = self.__watches.get(wd)
+            if rel_dir is None or not name:
+                continue
+
+            if rel_dir == '.' and name in walker.SERVICE_DIRS:
+                continue
+
+            rel_path = self.__rel_join(rel_dir, name)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    self.__dir_remove(rel_path)
+                    self.__wakeup.set()
+
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    task = asyncio.create_task(self.__dir_add(rel_path))
+                    self.__dir_tasks.add(task)
+                    task.add_done_callback(self.__dir_task_done)
+
+            # IN_CREATE для файла не учитывается: файл еще пишется, достаточно IN_CLOSE_WRITE
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+                self.__mark(rel_path)
+
+    def __classify(self, dirty: Dict[str, PageKey]) -> Tuple[List[Tuple[PageKey, os.stat_result]], List[PageKey]]:
+        present, absent = [], []
+
+        for rel_path, key in dirty.items():
+            try:
+                file_stat = os.stat(self.__save_dir.joinpath(rel_path))
+
+            except (FileNotFoundError, NotADirectoryError):
+                absent.append(key)
+
+            else:
+                present.append((key, file_stat))
+
+        return present, absent
+
+    async def __sync(self) -> Coroutine[Any, Any, None]:
+        # Вторая сверка одновременно с идущей не начинается: их вставки строк и манифеста мешали бы друг другу.
+        # Уже идущая сверка могла пройти изменившиеся директории раньше, поэтому после нее запускается своя.
+        while True:
+            job, created = await self.__jobs.submit('sync')
+            await self.__jobs.wait(job['id'])
+
+            if created:
+                return
+
+    async def __flush(self) -> Coroutine[Any, Any, None]:
+        if self.__resync:
+            self.__resync = False
+            self.__dirty, self.__dirs_gone = {}, set()
+            await self.__sync()
+            return
+
+        dirty, self.__dirty = self.__dirty, {}
+        dirs_gone, self.__dirs_gone = self.__dirs_gone, set()
+        present, absent = await asyncio.get_running_loop().run_in_executor(None, self.__classify, dirty)
+        await self.__db.files_apply(present, absent, sorted(dirs_gone))
+
+    async def __watch_loop(self) -> Coroutine[Any, Any, None]:
+        while True:
+            await self.__wakeup.wait()
+
+            # Окно для склейки событий, при большом потоке изменений применяем сразу
+            if len(self.__dirty) < self.__max_pending:
+                await asyncio.sleep(self.__interval)
+
+            self.__wakeup.clear()
+
+            try:
+                await self.__flush()
+
+            except Exception as e:
+                print(f'Ошибка применения изменений хранилища {self.__save_dir}: {e!r}')
+
+    async def __poll_loop(self) -> Coroutine[Any, Any, None]:
+        while True:
+            await asyncio.sleep(self.__poll_interval)
+
+            try:
+                await self.__sync()
+
+            except Exception as e:
+                print(f'Ошибка сверки хранилища {self.__save_dir}: {e!r}')
+
+    async def start(self) -> Coroutine[Any, Any, None]:
+        try:
+            self.__inotify = Inotify()
+            await self.__dir_add('.', mark_files=False)
+
+        # Не Linux, нет inotify или исчерпан лимит наблюдений - остается периодическая сверка
+        except (OSError, AttributeError) as e:
+            print(f'inotify недоступен для {self.__save_dir} ({e}), используется опрос раз в {self.__poll_interval} с.')
+            if self.__inotify is not None:
+                self.__inotify.close()
+                self.__inotify = None
+                self.__watches.clear()
+
+            self.__task = asyncio.create_task(self.__poll_loop())
+            return
+
+        asyncio.get_running_loop().add_reader(self.__inotify.fd, self.__events_handle)
+        self.__task = asyncio.create_task(self.__watch_loop())
+
+    async def stop(self) -> Coroutine[Any, Any, None]:
+        if self.__inotify is not None:
+            asyncio.get_running_loop().remove_reader(self.__inotify.fd)
+            self.__inotify.close()
+            self.__inotify = None
+
+        tasks = [*self.__dir_tasks, *(task for task in (self.__task, self.__poll_task) if task is not None)]
+        [task.cancel() for task in tasks]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.__task = None
+        self.__poll_task = None
@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Coroutine, Dict, List, Tuple
+
+from aiohttp import ClientSession, FormData
+
+from benchmarks.common import bench_app
+
+
+# Запуск: python -m benchmarks.api_load --files 10000 --concurrency 32 --duration 5
+
+
+def tree_make(root: Path, files: int, per_dir: int) -> None:
+    for i in range(files):
+        dir_path = root.joinpath(f'dir_{i // per_dir:05d}')
+        if i % per_dir == 0:
+            dir_path.mkdir(parents=True)
+
+        dir_path.joinpath(f'file_{i:07d}.dat').write_bytes(b'x')
+
+
+def info_form_make() -> FormData:
+    form = FormData()
+    for key, value in (('name', 'file_0000001'), ('path', 'dir_00000'), ('ext', 'dat')):
+        form.add_field(key, value, content_type='text/plain')
+
+    return form
+
+
+async def load(
+    session: ClientSession,
+    request_make: Callable[[ClientSession], Any],
+    concurrency: int,
+    duration: float
+    ) -> Coroutine[Any, Any, Tuple[int, float]]:
+
+    deadline = time.perf_counter() + duration
+
+    async def worker() -> int:
+        done = 0
+        while time.perf_counter() < deadline:
+            async with request_make(session) as response:
+                await response.read()
+                response.raise_for_status()
+            done += 1
+
+        return done
+
+    started = time.perf_counter()
+    done = sum(await asyncio.gather(*[worker() for _ in range(concurrency)]))
+
+    return done, time.perf_counter() - started
+
+
+async def main(files: int, per_dir: int, page_size: int, concurrency: int, duration: float) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        tree_make(work_dir.joinpath('files'), files, per_dir)
+        app_vars = {'page_size': page_size, 'page_size_max': max(page_size, files)}
+
+        async with bench_app(work_dir, app_vars) as session:
+            async with session.get('/api/v1/files', params={'limit': 2}) as response:
+                file_id = (await response.json())['items'][1]['id']
+
+            scenarios: Dict[str, List[Tuple[str, Callable[[ClientSession], Any]]]] = {
+                f'страница списка ({page_size} строк)': [
+                    ('HTML', lambda s: s.get('/')),
+                    ('API', lambda s: s.get('/api/v1/files'))
+                ],
+                'инфо о файле': [
+                    ('HTML', lambda s: s.post('/info', data=info_form_make())),
+                    ('API', lambda s: s.get(f'/api/v1/files/{file_id}'))
+                ],
+                'поиск по префиксу пути': [
+                    ('HTML', lambda s: s.get('/search', params={'path': 'dir_00001'})),
+                    ('API', lambda s: s.get('/api/v1/search', params={'path': 'dir_00001'}))
+                ],
+                f'весь список ({files} строк)': [
+                    ('HTML', lambda s: s.get('/', params={'limit': files})),
+                    ('API NDJSON', lambda s: s.get('/api/v1/files', params={'format': 'ndjson'}))
+                ]
+            }
+
+            print(f'Файлов: {files}, параллельных клиентов: {concurrency}, длительность замера: {duration} с')
+
+            for name, variants in scenarios.items():
+                for variant, request_make in variants:
+                    done, elapsed = await load(session, request_make, concurrency, duration)
+                    print(f'{name:>32} {variant:>10}: {done / elapsed:,.0f} запросов/с')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Запросов в секунду: HTML-страницы против JSON API.')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--per-dir', type=int, default=1000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+    asyncio.run(main(args.files, args.per_dir, args.page_size, args.concurrency, args.duration))
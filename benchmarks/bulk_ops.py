@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Coroutine, Dict, List
+
+from aiohttp import ClientSession
+
+from benchmarks.api_load import tree_make
+from benchmarks.common import bench_app
+
+
+# Запуск: python -m benchmarks.bulk_ops --files 20000 --concurrency 32
+
+
+async def ids_get(session: ClientSession, prefix: str) -> Coroutine[Any, Any, List[str]]:
+    ids = []
+
+    async with session.get('/api/v1/files', params={'prefix': prefix, 'format': 'ndjson'}) as response:
+        async for line in response.content:
+            ids.append(json.loads(line)['id'])
+
+    return ids
+
+
+async def single_delete(session: ClientSession, ids: List[str], concurrency: int) -> Coroutine[Any, Any, None]:
+    queue = iter(ids)
+
+    async def worker() -> None:
+        for file_id in queue:
+            async with session.delete(f'/api/v1/files/{file_id}') as response:
+                await response.read()
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+async def bulk(session: ClientSession, params: Dict[str, Any]) -> Coroutine[Any, Any, Dict[str, Any]]:
+    summary = {}
+
+    async with session.post('/api/v1/bulk', json=params) as response:
+        async for line in response.content:
+            summary = json.loads(line).get('summary', summary)
+
+    return summary
+
+
+async def main(files: int, per_dir: int, concurrency: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        tree_make(work_dir.joinpath('files'), files, per_dir)
+
+        async with bench_app(work_dir) as session:
+            # Половина файлов удаляется запросом на каждый файл, вторая - одним запросом по префиксу
+            dirs = sorted({f'dir_{i // per_dir:05d}' for i in range(files)})
+            half = dirs[:len(dirs) // 2]
+            print(f'Файлов: {files}, директорий: {len(dirs)}')
+
+            ids = [file_id for prefix in half for file_id in await ids_get(session, prefix)]
+            started = time.perf_counter()
+            await single_delete(session, ids, concurrency)
+            elapsed = time.perf_counter() - started
+            print(f'{"удаление по одному":>28}: {len(ids)} файлов за {elapsed:.2f} с, {len(ids) / elapsed:,.0f} файлов/с')
+
+            for name, params in (
+                ('комментарий (bulk)', {'op': 'comment', 'prefix': 'dir_', 'comment': 'bulk'}),
+                ('перенос (bulk)', {'op': 'move', 'prefix': 'dir_', 'target': 'moved'}),
+                ('удаление (bulk)', {'op': 'delete', 'prefix': 'moved'})
+                ):
+                started = time.perf_counter()
+                summary = await bulk(session, params)
+                elapsed = time.perf_counter() - started
+                print(f'{name:>28}: {summary["done"]} файлов за {elapsed:.2f} с, {summary["done"] / elapsed:,.0f} файлов/с, ошибок: {summary["failed"]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Массовые операции: запрос на каждый файл против POST /api/v1/bulk.')
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--per-dir', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+    asyncio.run(main(args.files, args.per_dir, args.concurrency))
@@ -0,0 +1,57 @@
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from app.db import Base, DBHandler
+
+
+# Запуск: python -m benchmarks.bulk_register --files 100000
+
+
+def tree_make(root: Path, files: int, per_dir: int) -> None:
+    for i in range(files):
+        dir_path = root.joinpath(f'dir_{i // per_dir:05d}')
+        if i % per_dir == 0:
+            dir_path.mkdir(parents=True)
+
+        dir_path.joinpath(f'file_{i:07d}.dat').write_bytes(b'x' * (i % 128))
+
+
+async def register(work_dir: Path, save_dir: Path, chunk_size: int, stat_workers: int) -> float:
+    db_path = work_dir.joinpath(f'bench_{chunk_size}_{stat_workers}.sqlite')
+    db_handler = DBHandler(f'sqlite+aiosqlite:///{db_path}', insert_chunk_size=chunk_size, stat_workers=stat_workers)
+    await db_handler.create(Base)
+
+    try:
+        started = time.perf_counter()
+        await db_handler.normalize(save_dir, save_dir)
+
+        return time.perf_counter() - started
+
+    finally:
+        await db_handler.release()
+
+
+async def main(files: int, per_dir: int, chunk_sizes: list, stat_workers: list) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        save_dir = work_dir.joinpath('files')
+        tree_make(save_dir, files, per_dir)
+        print(f'Файлов: {files}, в директории: {per_dir}')
+
+        for chunk_size in chunk_sizes:
+            for workers in stat_workers:
+                elapsed = await register(work_dir, save_dir, chunk_size, workers)
+                print(f'insert_chunk_size={chunk_size:>6} stat_workers={workers:>3}: {elapsed:.2f} с, {files / elapsed:,.0f} строк/с')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Скорость регистрации новых файлов в БД при сверке с хранилищем.')
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--per-dir', type=int, default=1000)
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--stat-workers', type=int, nargs='+', default=[1, 8])
+    args = parser.parse_args()
+    asyncio.run(main(args.files, args.per_dir, args.chunk_sizes, args.stat_workers))
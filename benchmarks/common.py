@@ -0,0 +1,112 @@
+import asyncio
+import resource
+import socket
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict
+
+from aiohttp import ClientSession
+from yaml import safe_dump
+
+from app.configurator import AppConfigurator
+from app.db import Base
+
+
+APP_NAME = 'bench_app'
+
+
+def free_port_get() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+
+        return sock.getsockname()[1]
+
+
+def rss_get() -> int:
+    # Текущий RSS процесса в байтах (Linux)
+    with open('/proc/self/statm') as fd:
+        pages = int(fd.read().split()[1])
+
+    return pages * resource.getpagesize()
+
+
+def max_rss_get() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RSSSampler:
+    def __init__(self, interval: float = 0.1) -> None:
+        self.__interval = interval
+        self.__task = None
+        self.peak = 0
+
+    async def __sample(self) -> None:
+        while True:
+            self.peak = max(self.peak, rss_get())
+            await asyncio.sleep(self.__interval)
+
+    def start(self) -> None:
+        self.peak = rss_get()
+        self.__task = asyncio.create_task(self.__sample())
+
+    async def stop(self) -> None:
+        self.__task.cancel()
+        await asyncio.gather(self.__task, return_exceptions=True)
+
+
+def config_make(
+    work_dir: Path,
+    port: int,
+    app_vars: Dict[str, Any] = None,
+    db_settings: Dict[str, Any] = None,
+    app_settings: Dict[str, Any] = None
+    ) -> Path:
+
+    config = {
+        'applications': {
+            APP_NAME: {
+                'app_vars': {'save_path': str(work_dir.joinpath('files')), **(app_vars or {})},
+                'app_settings': {'host': '127.0.0.1', 'port': port, **(app_settings or {})},
+                'db_settings': {
+                    'db_type': 'SQLite',
+                    'db_path': str(work_dir.joinpath('database')),
+                    'db_name': 'bench.sqlite',
+                    **(db_settings or {})
+                }
+            }
+        }
+    }
+    config_path = work_dir.joinpath('app_config.yaml')
+    config_path.write_text(safe_dump(config, allow_unicode=True))
+
+    return config_path
+
+
+@asynccontextmanager
+async def bench_app(
+    work_dir: Path,
+    app_vars: Dict[str, Any] = None,
+    db_settings: Dict[str, Any] = None,
+    timings: Dict[str, float] = None
+    ) -> AsyncIterator[ClientSession]:
+
+    # timings получает время запуска приложения (создание схемы БД и сверка с хранилищем), секунды
+    port = free_port_get()
+    configurator = AppConfigurator(config_make(work_dir, port, app_vars, db_settings), Base)
+    started = time.perf_counter()
+    await configurator.configurate()
+
+    if timings is not None:
+        timings['startup'] = time.perf_counter() - started
+
+    tasks = configurator.sites_start_tasks_create()
+    await asyncio.sleep(0.1)
+
+    try:
+        async with ClientSession(f'http://127.0.0.1:{port}') as session:
+            yield session
+
+    finally:
+        [task.cancel() for task in tasks]
+        await asyncio.gather(*tasks, return_exceptions=True)
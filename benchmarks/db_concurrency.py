@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Coroutine, Dict, List, Optional
+
+import sqlalchemy as sql
+from sqlalchemy.exc import OperationalError
+
+from app.db import Base, DBHandler, File
+
+
+# Запуск: python -m benchmarks.db_concurrency --rows 20000 --concurrency 50 --write-ratio 0.3
+# Массовая запись: --write-ratio 1
+
+# Настройки SQLite до WAL: журнал отката и fsync на каждую фиксацию
+LEGACY_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'mmap_size': 0, 'cache_size': -2000, 'temp_store': 'DEFAULT'}
+
+# Название, PRAGMA, единственный писатель, окно групповой фиксации (с)
+VARIANTS = (
+    ('журнал DELETE', LEGACY_PRAGMAS, False, 0.0),
+    ('WAL', None, False, 0.0),
+    ('WAL, один писатель', None, True, 0.0),
+    ('WAL, окно 5 мс', None, True, 0.005)
+)
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = {'read': [], 'write': []}
+        self.locked = 0
+        self.errors = 0
+
+    def percentile(self, kind: str, value: float) -> float:
+        latencies = sorted(self.latencies[kind])
+
+        return latencies[min(len(latencies) - 1, int(len(latencies) * value))] if latencies else 0.0
+
+
+async def client(db_handler: DBHandler, dirs: int, write_ratio: float, deadline: float, stats: Stats, number: int) -> Coroutine[Any, Any, None]:
+    rnd = random.Random(number)
+    counter = 0
+
+    while time.perf_counter() < deadline:
+        path = f'dir_{rnd.randrange(dirs):05d}'
+        kind = 'write' if rnd.random() < write_ratio else 'read'
+        started = time.perf_counter()
+
+        try:
+            if kind == 'read':
+                await db_handler.listing(path, None, 50)
+
+            elif rnd.random() < 0.5:
+                counter += 1
+                await db_handler.insert(File(
+                    name=f'new_{number:04d}_{counter:07d}', ext='dat', sz=counter, path=path,
+                    create=datetime.now().isoformat(), comment='benchmark'
+                    ))
+
+            else:
+                name = f'file_{rnd.randrange(1000):07d}'
+                sql_query = sql.update(File).where(File.path == path, File.name == name).values(comment=f'c{counter}')
+                await db_handler.execute(sql_query, True, keys=[(path, name, 'dat')])
+
+        except OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                stats.locked += 1
+
+            else:
+                stats.errors += 1
+
+            continue
+
+        stats.latencies[kind].append(time.perf_counter() - started)
+
+
+async def run(
+    db_path: Path,
+    rows: int,
+    concurrency: int,
+    write_ratio: float,
+    duration: float,
+    pragmas: Optional[Dict[str, Any]],
+    single_writer: bool,
+    window: float
+    ) -> Coroutine[Any, Any, Stats]:
+
+    db_handler = DBHandler(
+        f'sqlite+aiosqlite:///{db_path}',
+        cache_size=0,
+        pool_size=concurrency,
+        sqlite_pragmas=pragmas,
+        sqlite_single_writer=single_writer,
+        group_commit_window=window
+        )
+    await db_handler.create(Base)
+
+    try:
+        dirs = max(1, rows // 1000)
+        await db_handler._rows_insert([
+            (f'file_{i % 1000:07d}', 'dat', i, f'dir_{i // 1000:05d}', '2023-01-01T00:00:00', None, 'У файла нет комментария.', None, i, None, None)
+            for i in range(rows)
+            ])
+
+        stats = Stats()
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*[client(db_handler, dirs, write_ratio, deadline, stats, i) for i in range(concurrency)])
+        write_stats = db_handler.write_stats
+
+        if write_stats:
+            print(f'{"":>20}  транзакций записи: {write_stats["batches"]}, записей: {write_stats["works"]}')
+
+        return stats
+
+    finally:
+        await db_handler.release()
+
+
+async def main(rows: int, concurrency: int, write_ratio: float, duration: float) -> None:
+    print(f'Строк: {rows}, клиентов: {concurrency}, доля записи: {write_ratio}, {duration} с на вариант')
+
+    for name, pragmas, single_writer, window in VARIANTS:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats = await run(Path(tmp_dir).joinpath('bench.sqlite'), rows, concurrency, write_ratio, duration, pragmas, single_writer, window)
+
+        reads, writes = len(stats.latencies['read']), len(stats.latencies['write'])
+        print(
+            f'{name:>20}: {(reads + writes) / duration:,.0f} оп/с (чтение {reads / duration:,.0f}, запись {writes / duration:,.0f}), '
+            f'p99 чтения {stats.percentile("read", 0.99) * 1000:.1f} мс, p99 записи {stats.percentile("write", 0.99) * 1000:.1f} мс, '
+            f'"database is locked": {stats.locked}, других ошибок: {stats.errors}'
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Смешанная нагрузка на SQLite: чтение списка и запись из многих задач сразу.')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--write-ratio', type=float, default=0.3)
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.concurrency, args.write_ratio, args.duration))
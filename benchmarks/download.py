@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Coroutine
+
+from aiohttp import ClientSession
+
+from benchmarks.common import RSSSampler, bench_app, max_rss_get, rss_get
+
+
+# Запуск: python -m benchmarks.download --size-mb 1024 --concurrency 100
+
+
+async def download(session: ClientSession, read_chunk: int) -> Coroutine[Any, Any, int]:
+    received = 0
+    params = {'path': 'bench', 'name': 'big', 'ext': 'bin'}
+
+    async with session.get('/download', params=params) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(read_chunk):
+            received += len(chunk)
+
+    return received
+
+
+async def main(size_mb: int, concurrency: int, read_chunk: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        file_path = work_dir.joinpath('files', 'bench', 'big.bin')
+        file_path.parent.mkdir(parents=True)
+
+        with open(file_path, 'wb') as fd:
+            block = bytes(range(256)) * 4096
+            for _ in range(size_mb):
+                fd.write(block)
+
+        async with bench_app(work_dir) as session:
+            rss_before = rss_get()
+            sampler = RSSSampler()
+            sampler.start()
+            started = time.perf_counter()
+            received = await asyncio.gather(*[download(session, read_chunk) for _ in range(concurrency)])
+            elapsed = time.perf_counter() - started
+            await sampler.stop()
+
+    total = sum(received)
+    print(f'Файл: {size_mb} MiB, параллельных загрузок: {concurrency}')
+    print(f'Передано: {total / 2 ** 20:.0f} MiB за {elapsed:.2f} с ({total / 2 ** 20 / elapsed:.1f} MiB/s)')
+    print(f'RSS до: {rss_before / 2 ** 20:.1f} MiB, пик во время загрузки: {sampler.peak / 2 ** 20:.1f} MiB, '
+          f'ru_maxrss: {max_rss_get() / 2 ** 20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Пропускная способность и память при параллельных загрузках одного файла.')
+    parser.add_argument('--size-mb', type=int, default=1024)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--read-chunk', type=int, default=1 << 20)
+    args = parser.parse_args()
+    asyncio.run(main(args.size_mb, args.concurrency, args.read_chunk))
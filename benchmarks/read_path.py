@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import sqlalchemy as sql
+
+from app.db import Base, DBHandler, File, Result
+
+
+# Запуск: python -m benchmarks.read_path --rows 200000
+
+
+def orm_result_make(item: File) -> dict:
+    # Прежний путь чтения: сущность ORM, затем копия атрибутов в словарь
+    return {
+        'name': item.name,
+        'ext': item.ext,
+        'size': item.sz,
+        'path': item.path,
+        'created_at': item.create,
+        'updated_at': item.update,
+        'comment': item.comment
+    }
+
+
+async def orm_read(db_handler: DBHandler, sql_query: sql.sql.Select) -> int:
+    async with db_handler.get_session() as session:
+        result = await session.execute(sql_query)
+
+        return len([orm_result_make(item) for item in result.scalars()])
+
+
+async def core_read(db_handler: DBHandler, sql_query: sql.sql.Select) -> int:
+    return len(await db_handler.execute(sql_query))
+
+
+async def stream_read(db_handler: DBHandler, sql_query: sql.sql.Select) -> int:
+    count = 0
+    async for row in db_handler.rows_stream(sql_query):
+        Result(row)
+        count += 1
+
+    return count
+
+
+async def main(rows: int, repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_handler = DBHandler(f'sqlite+aiosqlite:///{Path(tmp_dir).joinpath("bench.sqlite")}')
+        await db_handler.create(Base)
+
+        try:
+            await db_handler._rows_insert([
+                (f'file_{i:07d}', 'dat', i, f'dir_{i // 1000:05d}', '2023-01-01T00:00:00', None, 'У файла нет комментария.', None, i, None, None)
+                for i in range(rows)
+                ])
+            sql_query = sql.select(File)
+            print(f'Строк: {rows}')
+
+            for name, reader in (('ORM', orm_read), ('Core', core_read), ('Core, курсор', stream_read)):
+                best = None
+
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    count = await reader(db_handler, sql_query)
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+
+                print(f'{name:>14}: {best:.3f} с, {count / best:,.0f} строк/с')
+
+        finally:
+            await db_handler.release()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Скорость чтения строк из БД: через ORM и через Core.')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.repeat))
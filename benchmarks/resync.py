@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from app.db import Base, DBHandler
+from benchmarks.bulk_register import tree_make
+
+
+# Запуск: python -m benchmarks.resync --files 200000 --per-dir 100
+
+
+def tree_age(root: Path, seconds: float = 60.0) -> None:
+    # Только что созданные директории манифест не запоминает (см. walker.RACY_NS)
+    mtime = time.time() - seconds
+
+    for dir_path, _, _ in os.walk(root):
+        os.utime(dir_path, (mtime, mtime))
+
+
+async def resync(work_dir: Path, save_dir: Path, dir_manifest: bool, repeats: int) -> None:
+    db_path = work_dir.joinpath(f'bench_{dir_manifest}.sqlite')
+    db_handler = DBHandler(f'sqlite+aiosqlite:///{db_path}', dir_manifest=dir_manifest)
+    await db_handler.create(Base)
+
+    try:
+        started = time.perf_counter()
+        await db_handler.normalize(save_dir, save_dir)
+        print(f'dir_manifest={dir_manifest!s:>5} первая сверка: {time.perf_counter() - started:.2f} с')
+
+        for i in range(repeats):
+            # Перед последним повтором меняется одна директория
+            if i == repeats - 1:
+                save_dir.joinpath('dir_00000', 'changed.dat').write_bytes(b'x')
+
+            started = time.perf_counter()
+            await db_handler.normalize(save_dir, save_dir)
+            print(f'dir_manifest={dir_manifest!s:>5} повторная сверка: {time.perf_counter() - started:.2f} с')
+
+    finally:
+        await db_handler.release()
+
+
+async def main(files: int, per_dir: int, repeats: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        save_dir = work_dir.joinpath('files')
+        tree_make(save_dir, files, per_dir)
+        print(f'Файлов: {files}, в директории: {per_dir}')
+
+        for dir_manifest in (False, True):
+            tree_age(save_dir)
+            save_dir.joinpath('dir_00000', 'changed.dat').unlink(missing_ok=True)
+            await resync(work_dir, save_dir, dir_manifest, repeats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Повторная сверка почти неизменного хранилища: полный обход против манифеста директорий.')
+    parser.add_argument('--files', type=int, default=200000)
+    parser.add_argument('--per-dir', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=2)
+    args = parser.parse_args()
+    asyncio.run(main(args.files, args.per_dir, args.repeats))
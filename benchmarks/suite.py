@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Coroutine, Dict, List, Optional
+
+from aiohttp import ClientSession, FormData
+
+from benchmarks.api_load import tree_make
+from benchmarks.common import bench_app
+
+
+# Запуск: python -m benchmarks.suite --files 10000 --output results.json
+# Все замеры одного прогона в одном JSON: прогоны разных версий сравниваются по ключам results.*
+
+RequestMake = Callable[[ClientSession, int], Any]
+
+
+def percentile(values: List[float], value: float) -> float:
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * value))] if values else 0.0
+
+
+def latency_summary(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(max(latencies, default=0.0) * 1000, 3)
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def measure(
+    session: ClientSession,
+    request_make: RequestMake,
+    concurrency: int,
+    duration: Optional[float] = None,
+    total: Optional[int] = None
+    ) -> Coroutine[Any, Any, Dict[str, Any]]:
+
+    # Либо сколько успеется за duration секунд, либо ровно total запросов (номер запроса передается в request_make)
+    latencies: List[float] = []
+    transferred = [0]
+    numbers = iter(range(total)) if total is not None else itertools.count()
+    deadline = time.perf_counter() + duration if total is None else None
+
+    async def worker() -> None:
+        while deadline is None or time.perf_counter() < deadline:
+            number = next(numbers, None)
+            if number is None:
+                break
+
+            started = time.perf_counter()
+            async with request_make(session, number) as response:
+                body = await response.read()
+                response.raise_for_status()
+
+            latencies.append(time.perf_counter() - started)
+            transferred[0] += len(body)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    return {**latency_summary(latencies, elapsed), 'elapsed_s': round(elapsed, 3), 'bytes_received': transferred[0]}
+
+
+async def job_wait(session: ClientSession, request: Any, interval: float = 0.05) -> Coroutine[Any, Any, Dict[str, Any]]:
+    # Фоновая задача (202 и задача в ответе) опрашивается до завершения
+    async with request as response:
+        response.raise_for_status()
+        job = await response.json()
+
+    while job['status'] in ('queued', 'running'):
+        await asyncio.sleep(interval)
+
+        async with session.get(f'/api/v1/jobs/{job["id"]}') as response:
+            job = await response.json()
+
+    if job['status'] != 'done':
+        raise RuntimeError(f'Задача {job["kind"]} завершилась со статусом {job["status"]}: {job["error"]}')
+
+    return job
+
+
+def upload_form_make(number: int, payload: bytes) -> FormData:
+    form = FormData()
+    for key, value in (('name', f'upload_{number:06d}'), ('ext', 'bin'), ('path', 'bench_uploads'), ('comment', 'benchmark')):
+        form.add_field(key, value, content_type='text/plain')
+
+    form.add_field('file_choose', payload, filename='upload.bin', content_type='application/octet-stream')
+
+    return form
+
+
+async def uploads_run(
+    session: ClientSession,
+    count: int,
+    size: int,
+    concurrency: int
+    ) -> Coroutine[Any, Any, Dict[str, Any]]:
+
+    payload = bytes(range(256)) * (size // 256) + b'\0' * (size % 256)
+    result = await measure(session, lambda s, n: s.post('/api/v1/files', data=upload_form_make(n, payload)), concurrency, total=count)
+    result['mib_s'] = round(count * size / 1048576 / result['elapsed_s'], 1)
+
+    return result
+
+
+async def suite_run(
+    work_dir: Path,
+    files: int,
+    per_dir: int,
+    concurrency: int,
+    duration: float,
+    upload_count: int,
+    upload_size: int
+    ) -> Coroutine[Any, Any, Dict[str, Any]]:
+
+    tree_make(work_dir.joinpath('files'), files, per_dir)
+    timings: Dict[str, float] = {}
+    results: Dict[str, Any] = {}
+
+    async with bench_app(work_dir, {'page_size_max': 1000}, timings=timings) as session:
+        results['startup_normalize'] = {'files': files, 'elapsed_s': round(timings['startup'], 3)}
+
+        started = time.perf_counter()
+        job = await job_wait(session, session.post('/api/v1/sync'))
+        results['sync_unchanged'] = {'files': files, 'elapsed_s': round(time.perf_counter() - started, 3), 'job_s': job['duration_s']}
+
+        async with session.get('/api/v1/files', params={'limit': 2}) as response:
+            file_id = (await response.json())['items'][1]['id']
+
+        reads: Dict[str, RequestMake] = {
+            'listing_html': lambda s, n: s.get('/'),
+            'listing_api': lambda s, n: s.get('/api/v1/files'),
+            'listing_api_deep': lambda s, n: s.get('/api/v1/files', params={'prefix': f'dir_{n % max(1, files // per_dir):05d}'}),
+            'search_prefix': lambda s, n: s.get('/api/v1/search', params={'path': 'dir_00001'}),
+            'search_fts': lambda s, n: s.get('/api/v1/search', params={'q': f'file_{n % files:07d}'}),
+            'info': lambda s, n: s.get(f'/api/v1/files/{file_id}')
+        }
+
+        for name, request_make in reads.items():
+            results[name] = await measure(session, request_make, concurrency, duration)
+            print(f'{name}: {results[name]["rps"]:,.0f} запросов/с, p99 {results[name]["p99_ms"]} мс', file=sys.stderr)
+
+        results['upload'] = {**await uploads_run(session, upload_count, upload_size, concurrency), 'size': upload_size}
+
+        async with session.get('/api/v1/files', params={'prefix': 'bench_uploads', 'limit': upload_count}) as response:
+            ids = [item['id'] for item in (await response.json())['items']]
+
+        download = await measure(session, lambda s, n: s.get(f'/api/v1/files/{ids[n]}/content'), concurrency, total=len(ids))
+        download['mib_s'] = round(download['bytes_received'] / 1048576 / download['elapsed_s'], 1)
+        results['download'] = download
+
+        results['delete'] = await measure(session, lambda s, n: s.delete(f'/api/v1/files/{ids[n]}'), concurrency, total=len(ids))
+
+        for name in ('upload', 'download'):
+            print(f'{name}: {results[name]["mib_s"]} MiB/s', file=sys.stderr)
+
+        print(f'delete: p50 {results["delete"]["p50_ms"]} мс, p99 {results["delete"]["p99_ms"]} мс', file=sys.stderr)
+
+    # Повторный запуск на той же БД с fast_start: время до ответа на первый запрос и до окончания сверки
+    started = time.perf_counter()
+    async with bench_app(work_dir, {'fast_start': True}, timings=timings) as session:
+        async with session.get('/api/v1/files', params={'limit': 1}) as response:
+            await response.read()
+            response.raise_for_status()
+
+        first_request = time.perf_counter() - started
+
+        while True:
+            async with session.get('/ready', params={'reconciled': 1}) as response:
+                if response.status == 200:
+                    break
+
+            await asyncio.sleep(0.05)
+
+        results['startup_fast'] = {
+            'files': files,
+            'elapsed_s': round(timings['startup'], 3),
+            'first_request_s': round(first_request, 3),
+            'reconciled_s': round(time.perf_counter() - started, 3)
+        }
+
+    return results
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any]) -> None:
+    # Изменение относительно прежнего прогона: для rps и MiB/s больше - лучше, для времени - меньше.
+    # Длительность сравнивается только у разовых замеров (запуск, сверка), у остальных она задана параметрами.
+    for name, values in results.items():
+        for key in ('rps', 'mib_s', 'p99_ms') if 'rps' in values else ('elapsed_s',):
+            old, new = baseline.get(name, {}).get(key), values.get(key)
+
+            if old and new is not None:
+                print(f'{name}.{key}: {old} -> {new} ({(new - old) / old * 100:+.1f}%)', file=sys.stderr)
+
+
+async def main(args: argparse.Namespace) -> None:
+    params = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+    started_at = datetime.now(timezone.utc).isoformat()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = await suite_run(
+            Path(tmp_dir), args.files, args.per_dir, args.concurrency, args.duration, args.upload_count, args.upload_size)
+
+    report = {
+        'started_at': started_at,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': len(os.sched_getaffinity(0)),
+        'params': params,
+        'results': results
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text())['results'], results)
+
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Набор замеров сервиса: запуск, чтение, поиск, загрузка, отдача и удаление. Результат - JSON.')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--per-dir', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=3.0, help='секунд на каждый замер чтения')
+    parser.add_argument('--upload-count', type=int, default=200)
+    parser.add_argument('--upload-size', type=int, default=1048576)
+    parser.add_argument('--output', help='файл для JSON, по умолчанию stdout')
+    parser.add_argument('--compare', help='JSON прежнего прогона: изменения выводятся в stderr')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Coroutine, List
+
+from aiohttp import ClientSession, FormData
+
+from benchmarks.common import bench_app
+
+
+# Запуск: python -m benchmarks.upload --size-mb 64 --concurrency 50
+
+
+class LoopLagSampler:
+    # Задержка цикла событий: насколько позже запланированного просыпается sleep(interval)
+    def __init__(self, interval: float = 0.005) -> None:
+        self.__interval = interval
+        self.__task = None
+        self.lags: List[float] = []
+
+    async def __sample(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.__interval)
+            self.lags.append(loop.time() - started - self.__interval)
+
+    def start(self) -> None:
+        self.lags = []
+        self.__task = asyncio.create_task(self.__sample())
+
+    async def stop(self) -> None:
+        self.__task.cancel()
+        await asyncio.gather(self.__task, return_exceptions=True)
+
+    def percentile(self, value: float) -> float:
+        lags = sorted(self.lags)
+
+        return lags[min(len(lags) - 1, int(len(lags) * value))] if lags else 0.0
+
+
+async def payload(size: int, block: bytes) -> AsyncIterator[bytes]:
+    sent = 0
+    while sent < size:
+        chunk = block[:size - sent]
+        sent += len(chunk)
+        yield chunk
+
+
+async def upload(session: ClientSession, number: int, size: int, block: bytes) -> Coroutine[Any, Any, None]:
+    form = FormData()
+    for key, value in (('name', f'upload_{number:03d}'), ('ext', 'bin'), ('path', 'bench'), ('comment', 'benchmark')):
+        form.add_field(key, value, content_type='text/plain')
+
+    form.add_field('file_choose', payload(size, block), filename='upload.bin', content_type='application/octet-stream')
+
+    async with session.post('/api/v1/files', data=form) as response:
+        await response.read()
+        response.raise_for_status()
+
+
+async def run(work_dir: Path, buffer_size: int, size: int, concurrency: int) -> Coroutine[Any, Any, None]:
+    block = bytes(range(256)) * 1024
+
+    async with bench_app(work_dir, {'upload_buffer_size': buffer_size}) as session:
+        sampler = LoopLagSampler()
+        sampler.start()
+        started = time.perf_counter()
+        await asyncio.gather(*[upload(session, i, size, block) for i in range(concurrency)])
+        elapsed = time.perf_counter() - started
+        await sampler.stop()
+
+    total = size * concurrency / 2 ** 20
+    print(f'upload_buffer_size={buffer_size:>8}: {total / elapsed:8.1f} MiB/s, задержка цикла событий: '
+          f'p50 {sampler.percentile(0.5) * 1000:.1f} мс, p99 {sampler.percentile(0.99) * 1000:.1f} мс, '
+          f'макс. {max(sampler.lags, default=0) * 1000:.1f} мс')
+
+
+async def main(size_mb: int, concurrency: int, buffer_sizes: List[int]) -> None:
+    print(f'Параллельных загрузок: {concurrency}, размер файла: {size_mb} MiB')
+
+    for buffer_size in buffer_sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            await run(Path(tmp_dir), buffer_size, size_mb * 2 ** 20, concurrency)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Скорость загрузки файлов и задержка цикла событий при параллельных загрузках.')
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--buffer-sizes', type=int, nargs='+', default=[65536, 1048576, 8388608])
+    args = parser.parse_args()
+    asyncio.run(main(args.size_mb, args.concurrency, args.buffer_sizes))
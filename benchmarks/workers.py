@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import multiprocessing as mp
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List
+
+from aiohttp import ClientError, ClientSession
+
+from app.supervisor import Supervisor
+from benchmarks.api_load import tree_make
+from benchmarks.common import config_make, free_port_get
+
+
+# Запуск: python -m benchmarks.workers --workers 1 2 4 8 16 --clients 8
+
+
+async def client_load(url: str, path: str, concurrency: int, duration: float) -> int:
+    deadline = time.perf_counter() + duration
+
+    async with ClientSession(url) as session:
+        async def worker() -> int:
+            done = 0
+            while time.perf_counter() < deadline:
+                async with session.get(path) as response:
+                    await response.read()
+                    response.raise_for_status()
+                done += 1
+
+            return done
+
+        return sum(await asyncio.gather(*[worker() for _ in range(concurrency)]))
+
+
+def client_run(url: str, path: str, concurrency: int, duration: float) -> int:
+    return asyncio.run(client_load(url, path, concurrency, duration))
+
+
+async def server_wait(url: str, timeout: float = 120.0) -> None:
+    deadline = time.perf_counter() + timeout
+
+    async with ClientSession(url) as session:
+        while True:
+            try:
+                async with session.get('/api/v1/files', params={'limit': 1}) as response:
+                    if response.status == 200:
+                        return
+
+            except ClientError:
+                if time.perf_counter() > deadline:
+                    raise
+
+            await asyncio.sleep(0.2)
+
+
+def supervisor_run(config_path: Path) -> None:
+    Supervisor(config_path).run()
+
+
+def measure(work_dir: Path, workers: int, clients: int, concurrency: int, duration: float, paths: List[str]) -> None:
+    port = free_port_get()
+    url = f'http://127.0.0.1:{port}'
+    # Кэш запросов выключен во всех замерах: с несколькими процессами он по умолчанию выключен (см. README)
+    config_path = config_make(work_dir, port, {'page_size': 100}, {'cache_size': 0}, {'workers': workers})
+    # Супервизор запускается и с одним процессом: так все замеры идут одним путем
+    supervisor = mp.get_context('spawn').Process(target=supervisor_run, args=(config_path,))
+    supervisor.start()
+
+    try:
+        asyncio.run(server_wait(url))
+        # Клиенты - отдельные процессы, чтобы нагрузку не ограничивало одно ядро клиента
+        with ProcessPoolExecutor(clients, mp.get_context('spawn')) as pool:
+            for path in paths:
+                futures = [pool.submit(client_run, url, path, concurrency, duration) for _ in range(clients)]
+                done = sum(future.result() for future in futures)
+                print(f'workers={workers:>3} {path:>24}: {done / duration:,.0f} запросов/с')
+
+    finally:
+        supervisor.terminate()
+        supervisor.join()
+
+
+def main(files: int, workers_list: List[int], clients: int, concurrency: int, duration: float) -> None:
+    print(f'Ядер: {os.cpu_count()}, файлов: {files}, клиентских процессов: {clients} по {concurrency} соединений')
+
+    for workers in workers_list:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            work_dir = Path(tmp_dir)
+            tree_make(work_dir.joinpath('files'), files, 1000)
+            measure(work_dir, workers, clients, concurrency, duration, ['/', '/api/v1/files'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Запросов в секунду в зависимости от кол-ва рабочих процессов приложения.')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+    main(args.files, args.workers, args.clients, args.concurrency, args.duration)
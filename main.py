@@ -6,7 +6,14 @@ import app
 if __name__ == '__main__':
     try:
         print('Server - ON')
-        asyncio.run(app.app_starter())
+        
+        # Если хотя бы у одного приложения "workers" больше 1, процессами управляет супервизор
+        if app.supervisor_required():
+            app.supervisor_start()
+            print('Server - OFF')
+        
+        else:
+            asyncio.run(app.app_starter())
     
     except KeyboardInterrupt:
         print('\b\bServer - OFF')
\ No newline at end of file
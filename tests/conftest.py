@@ -0,0 +1,16 @@
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def db_url(tmp_path: Path) -> str:
+    return f'sqlite+aiosqlite:///{tmp_path.joinpath("files.sqlite")}'
+
+
+@pytest.fixture
+def save_dir(tmp_path: Path) -> Path:
+    path = tmp_path.joinpath('files')
+    path.mkdir()
+
+    return path
@@ -0,0 +1,26 @@
+import pytest
+
+from app.routes import tools as tls
+
+
+@pytest.mark.parametrize('key', [
+    ('dir', 'name', 'txt'),
+    ('.', 'file', ''),
+    ('папка/вложенная', 'имя с пробелом', 'тхт'),
+    ('a/b', 'x=y&z', '%2F'),
+])
+def test_cursor_round_trip(key):
+    cursor = tls.cursor_encode(key)
+
+    assert '=' not in cursor
+    assert tls.cursor_decode(cursor) == key
+
+
+def test_cursor_custom_size():
+    assert tls.cursor_decode(tls.cursor_encode(('100',)), 1) == ('100',)
+
+
+@pytest.mark.parametrize('cursor', [None, '', '!!!', 'bm90IGpzb24', tls.cursor_encode(('a', 'b')), tls.cursor_encode((1, 2, 3))])
+def test_cursor_broken(cursor):
+    # Битый курсор - первая страница, а не ошибка
+    assert tls.cursor_decode(cursor) is None
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+from app.db import Base, DBHandler
+from app.jobs import DONE, FAILED, QUEUED, Job, JobManager, JobProgress
+
+
+async def manager_make(db_handler: DBHandler, calls: list) -> JobManager:
+    async def work(progress: JobProgress) -> dict:
+        calls.append(1)
+        await asyncio.sleep(0.3)
+        return {'ok': True}
+
+    manager = JobManager(db_handler)
+    manager.register('sync', work)
+    await manager.start()
+
+    return manager
+
+
+def test_submit_dedup_across_managers(db_url):
+    # Два процесса (здесь - два менеджера над одной БД) одновременно создают задачу одного вида: создается одна
+    async def main():
+        db_handlers = [DBHandler(db_url) for _ in range(2)]
+        await db_handlers[0].create(Base)
+        calls = []
+        managers = [await manager_make(db_handler, calls) for db_handler in db_handlers]
+
+        submitted = await asyncio.gather(*[manager.submit('sync') for manager in managers for _ in range(3)])
+
+        assert sum(created for _, created in submitted) == 1
+        assert len({job['id'] for job, _ in submitted}) == 1
+
+        job_id = submitted[0][0]['id']
+        results = await asyncio.gather(*[manager.wait(job_id) for manager in managers])
+
+        assert [job['status'] for job in results] == [DONE, DONE]
+        assert results[0]['result'] == {'ok': True}
+        assert len(calls) == 1
+
+        # После завершения задача того же вида создается снова
+        job, created = await managers[1].submit('sync')
+        assert created and job['id'] != job_id
+        await managers[1].wait(job['id'])
+
+        for manager, db_handler in zip(managers, db_handlers):
+            await manager.stop()
+            await db_handler.release()
+
+    asyncio.run(main())
+
+
+def test_submit_replaces_dead_job(db_url):
+    # Активная задача без свежей отметки осталась от остановленного процесса - она не мешает создать новую
+    async def main():
+        db_handler = DBHandler(db_url)
+        await db_handler.create(Base)
+        manager = await manager_make(db_handler, [])
+        dead = Job('sync')
+        await db_handler.job_insert({**dead.row(), 'status': QUEUED, 'heartbeat': time.time() - 3600})
+
+        job, created = await manager.submit('sync')
+
+        assert created and job['id'] != dead.id
+        assert (await manager.get(dead.id))['status'] == FAILED
+        assert (await manager.wait(job['id']))['status'] == DONE
+        await manager.stop()
+        await db_handler.release()
+
+    asyncio.run(main())
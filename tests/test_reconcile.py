@@ -0,0 +1,93 @@
+import asyncio
+import os
+import sqlalchemy as sql
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from app.db import Base, DBHandler, File, PageKey
+
+
+def files_make(save_dir: Path, paths: List[str]) -> None:
+    for rel_path in paths:
+        path = save_dir.joinpath(rel_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(rel_path)
+
+
+async def db_make(db_url: str) -> DBHandler:
+    db_handler = DBHandler(db_url, sync_batch_size=3, insert_chunk_size=2)
+    await db_handler.create(Base)
+
+    return db_handler
+
+
+async def rows_get(db_handler: DBHandler) -> Dict[PageKey, Dict]:
+    return {item.key: item.value async for item in db_handler.listing_iterate()}
+
+
+def test_normalize_adds_and_removes(db_url, save_dir):
+    # Пачки меньше числа файлов: слияние переходит границы пачек с обеих сторон
+    files_make(save_dir, ['a.txt', 'dir/b.bin', 'dir/sub/c', 'dir2/d.txt', 'z/e.txt', 'z/f.txt'])
+
+    async def main():
+        db_handler = await db_make(db_url)
+        await db_handler.normalize(save_dir, save_dir)
+        rows = await rows_get(db_handler)
+
+        assert set(rows) == {
+            ('.', 'a', 'txt'), ('dir', 'b', 'bin'), ('dir/sub', 'c', ''), ('dir2', 'd', 'txt'), ('z', 'e', 'txt'), ('z', 'f', 'txt')
+            }
+        assert rows[('dir', 'b', 'bin')]['size'] == len('dir/b.bin')
+
+        await db_handler.execute(sql.update(File).where(File.path == 'z', File.name == 'e', File.ext == 'txt').values(comment='оставить'), True)
+        os.remove(save_dir.joinpath('dir/b.bin'))
+        files_make(save_dir, ['dir/sub/g.txt', 'y.txt'])
+        await db_handler.normalize(save_dir, save_dir)
+        rows = await rows_get(db_handler)
+
+        assert ('dir', 'b', 'bin') not in rows
+        assert {('dir/sub', 'g', 'txt'), ('.', 'y', 'txt')} <= set(rows)
+        # Неизменившиеся строки не пересоздаются
+        assert rows[('z', 'e', 'txt')]['comment'] == 'оставить'
+        await db_handler.release()
+
+    asyncio.run(main())
+
+
+def test_normalize_canonizes_paths(db_url, save_dir):
+    # Строка с путем "/dir" - тот же файл, что и "dir" в хранилище: комментарий и хэш сохраняются
+    files_make(save_dir, ['dir/a.txt'])
+
+    async def main():
+        db_handler = await db_make(db_url)
+        await db_handler.insert(File(name='a', ext='txt', sz=9, path='/dir', create=datetime.now().isoformat(), comment='c', hash='h'))
+        await db_handler.normalize(save_dir, save_dir)
+        rows = await rows_get(db_handler)
+
+        assert list(rows) == [('dir', 'a', 'txt')]
+        assert (rows[('dir', 'a', 'txt')]['comment'], rows[('dir', 'a', 'txt')]['hash']) == ('c', 'h')
+        await db_handler.release()
+
+    asyncio.run(main())
+
+
+def test_files_apply(db_url, save_dir):
+    files_make(save_dir, ['a/x.txt', 'a/b/y.txt', 'a0/z.txt', 'a-b/w.txt', 'c/v.txt'])
+
+    async def main():
+        db_handler = await db_make(db_url)
+        await db_handler.normalize(save_dir, save_dir)
+        files_make(save_dir, ['c/new.txt'])
+        os.remove(save_dir.joinpath('c/v.txt'))
+        # Уже известный файл не вставляется повторно
+        present = [(key, os.stat(save_dir.joinpath(path))) for key, path in ((('c', 'new', 'txt'), 'c/new.txt'), (('a0', 'z', 'txt'), 'a0/z.txt'))]
+
+        await db_handler.files_apply(present, [('c', 'v', 'txt')], ['a'])
+        rows = await rows_get(db_handler)
+
+        # Удаляется директория "a" со всем содержимым, но не "a0" и "a-b"
+        assert set(rows) == {('a0', 'z', 'txt'), ('a-b', 'w', 'txt'), ('c', 'new', 'txt')}
+        await db_handler.release()
+
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+import asyncio
+import os
+from pathlib import Path
+from typing import AsyncIterator
+
+import pytest
+
+from app.uploads import UPLOADS_DIR, UploadError, UploadManager
+
+
+PART_SIZE = 1024
+CONTENT = os.urandom(PART_SIZE * 3 + 100)
+
+
+async def chunks(data: bytes, size: int = 300) -> AsyncIterator[bytes]:
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def part(number: int) -> bytes:
+    return CONTENT[number * PART_SIZE:(number + 1) * PART_SIZE]
+
+
+def test_upload_resume_and_commit(save_dir: Path):
+    async def main():
+        uploads = UploadManager(save_dir, PART_SIZE)
+        session = await uploads.create({'path': 'dir', 'name': 'file', 'ext': 'bin', 'comment': '', 'size': len(CONTENT)})
+        session_id = session['id']
+
+        assert session['parts'] == 4
+
+        # Части в произвольном порядке и параллельно
+        await asyncio.gather(*[uploads.part_write(session_id, number, chunks(part(number))) for number in (3, 1)])
+
+        assert (await uploads.status(session_id))['received'] == [1, 3]
+
+        with pytest.raises(UploadError) as error:
+            await uploads.commit(session_id, save_dir.joinpath('dir', 'file.bin'))
+
+        assert error.value.status == 409
+
+        # Оборванная часть не отмечается полученной, ее присылают заново
+        with pytest.raises(UploadError):
+            await uploads.part_write(session_id, 0, chunks(part(0)[:100]))
+
+        assert (await uploads.status(session_id))['received'] == [1, 3]
+
+        await uploads.part_write(session_id, 0, chunks(part(0)))
+        await uploads.part_write(session_id, 2, chunks(part(2)))
+        # Повтор уже полученной части ничего не портит
+        await uploads.part_write(session_id, 1, chunks(part(1)))
+        await uploads.commit(session_id, save_dir.joinpath('dir', 'file.bin'))
+
+        assert save_dir.joinpath('dir', 'file.bin').read_bytes() == CONTENT
+        assert not any(save_dir.joinpath(UPLOADS_DIR).iterdir())
+
+        with pytest.raises(UploadError) as error:
+            await uploads.status(session_id)
+
+        assert error.value.status == 404
+
+    asyncio.run(main())
+
+
+def test_upload_commit_keeps_existing_file(save_dir: Path):
+    async def main():
+        uploads = UploadManager(save_dir, PART_SIZE)
+        session = await uploads.create({'path': '.', 'name': 'a', 'ext': 'txt', 'comment': '', 'size': 3})
+        await uploads.part_write(session['id'], 0, chunks(b'new'))
+        save_dir.joinpath('a.txt').write_bytes(b'old')
+
+        with pytest.raises(FileExistsError):
+            await uploads.commit(session['id'], save_dir.joinpath('a.txt'))
+
+        assert save_dir.joinpath('a.txt').read_bytes() == b'old'
+
+    asyncio.run(main())
+
+
+def test_upload_part_errors(save_dir: Path):
+    async def main():
+        uploads = UploadManager(save_dir, PART_SIZE)
+
+        with pytest.raises(UploadError):
+            await uploads.create({'size': -1})
+
+        session = await uploads.create({'path': '.', 'name': 'a', 'ext': 'txt', 'comment': '', 'size': 10})
+
+        for number, data in ((1, b'x'), (0, b'x' * 11)):
+            with pytest.raises(UploadError) as error:
+                await uploads.part_write(session['id'], number, chunks(data))
+
+            assert error.value.status == 400
+
+        await uploads.abort(session['id'])
+
+        with pytest.raises(UploadError) as error:
+            await uploads.part_write(session['id'], 0, chunks(b'x' * 10))
+
+        assert error.value.status == 404
+
+    asyncio.run(main())